@@ -0,0 +1,260 @@
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from mmx import divider_entry_points, divider_path
+
+
+# Analytical answers to "can the divider keep every channel fed?" without running a simulation.
+#
+# Marbles reach the divider at the transports' entry points and fall into the first channel that
+# accepts them, so a marble entering at s lands on channel c with probability
+#   p_c * (1-p_s) * (1-p_s+1) * ... * (1-p_c-1)
+# A channel that gets more marbles than it plays is full most of the time and passes the surplus on,
+# which we model by lowering its effective accept probability until it only accepts what it plays.
+# Channel accept probabilities are independent and uniform between the configured min and max,
+# so using their mean gives the expected landing probabilities over randomly built machines.
+#
+# Everything played comes back round and whatever falls off the end is recycled until it finds a channel, so in
+# the steady state every channel gets exactly what it plays. How well a channel is fed is its supply instead: what
+# would be offered to it with both transports releasing flat out.
+
+
+def mean_accept_p(config: SimConfig = SIM_CONFIG):
+    return np.full(config.num_channels, (config.channel_accept_prob_min + config.channel_accept_prob_max) / 2)
+
+
+# P(a marble entering at start reaches channel c) for every channel, and P(it falls off the end)
+def reach_probabilities(accept_p, start: int, config: SimConfig = SIM_CONFIG):
+    reach = np.zeros(config.num_channels)
+    p_rolling = 1.0
+    for c in divider_path(start, config):
+        reach[c] = p_rolling
+        p_rolling *= 1 - accept_p[c]
+    return reach, p_rolling
+
+
+# Marbles per beat each channel plays, averaged over one play of the song
+def channel_demand(song: MMXSong):
+    return song.effective_notes.sum(axis=0) / song.beat_count
+
+
+class FlowAnalysis(NamedTuple):
+    demand: np.ndarray              # Marbles per beat each channel plays
+    offered: np.ndarray             # Marbles per beat that roll onto each channel and would fall in if it had room
+    accepted: np.ndarray            # Marbles per beat each channel takes (at most its demand once it's full)
+    supply: np.ndarray              # Marbles per beat offered to each channel with both transports flat out
+    return_flow: float              # Marbles per beat the conveyor has to lift (everything played)
+    recycle_flow: float             # Marbles per beat falling off the end of the divider into the fishstair
+    return_capacity: float          # The most marbles per beat each transport can release
+    recycle_capacity: float
+
+    # Supply over demand: how many times over each channel could be refilled as fast as it plays
+    @property
+    def supply_ratio(self):
+        with np.errstate(divide="ignore"):
+            return np.where(self.demand > 0, self.supply / np.where(self.demand > 0, self.demand, 1), np.inf)
+
+    # Channels that can't be fed as fast as they play even with the transports flat out
+    @property
+    def starved_channels(self):
+        return np.flatnonzero(self.supply < self.demand)
+
+    def __repr__(self):
+        lines = ["Channel  Demand  Offered  Accepted  Supply  Supply/Demand"]
+        for c, (d, o, a, s, r) in enumerate(zip(self.demand, self.offered, self.accepted, self.supply,
+                                                 self.supply_ratio)):
+            if d > 0:
+                lines.append("{0:7d}  {1:6.3f}  {2:7.3f}  {3:8.3f}  {4:6.3f}  {5:13.2f}{6}".format(
+                    c + 1, d, o, a, s, r, "  STARVED" if s < d else ""))
+        lines += [
+            "",
+            "Conveyor:  {0:.2f} of {1:.2f} marbles per beat".format(self.return_flow, self.return_capacity),
+            "Fishstair: {0:.2f} of {1:.2f} marbles per beat".format(self.recycle_flow, self.recycle_capacity),
+        ]
+        return "\n".join(lines)
+
+
+def transport_capacity(t_settings: MarbleTransportSettings) -> float:
+    return t_settings.num_channels * t_settings.channel_accept_p / t_settings.beats_per_release
+
+
+# Marbles per beat reaching each channel with return_flow coming off the conveyor, and what falls off the end of
+# the divider recycled back onto it (at most recycle_capacity per beat). Returns them, the effective accept
+# probabilities (channels offered more than their demand only taking that) and the recycled flow.
+# Every transport channel is assumed to release equally often (i.e. its reservoir never runs out).
+def divider_flows(accept_p, demand, return_flow: float, recycle_capacity: float = np.inf,
+                  config: SimConfig = SIM_CONFIG, iterations=200, tolerance=1e-12):
+    entries = [
+        (1 / config.return_settings.num_channels, divider_entry_points(config.return_settings), True),
+        (1 / config.recycle_settings.num_channels, divider_entry_points(config.recycle_settings), False),
+    ]
+
+    effective_p = accept_p.copy()
+    for _ in range(iterations):
+        # Where marbles from each transport end up with the current effective accept probabilities
+        reach = {True: np.zeros(config.num_channels), False: np.zeros(config.num_channels)}
+        fall_off = {True: 0.0, False: 0.0}
+        for share, entry_points, is_return in entries:
+            for start in entry_points:
+                start_reach, start_fall_off = reach_probabilities(effective_p, start, config)
+                reach[is_return] += share * start_reach
+                fall_off[is_return] += share * start_fall_off
+
+        recycle_flow = min(return_flow * fall_off[True] / max(1 - fall_off[False], 1e-12), recycle_capacity)
+        reaching = return_flow * reach[True] + recycle_flow * reach[False]
+        offered = reaching * accept_p
+
+        # Full channels only take what they play
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new_p = accept_p * np.where(offered > demand, demand / np.where(offered > 0, offered, 1), 1)
+        converged = np.abs(new_p - effective_p).max() < tolerance
+        effective_p = new_p
+        if converged:
+            break
+    return reaching, effective_p, recycle_flow
+
+
+# Steady state marble flows through the divider for a song, and the supply of every channel
+def analyze_flow(song: MMXSong, config: SimConfig = SIM_CONFIG, accept_p=None,
+                 iterations=200, tolerance=1e-12) -> FlowAnalysis:
+    accept_p = mean_accept_p(config) if accept_p is None else np.asarray(accept_p, dtype=float)
+    demand = channel_demand(song)
+    return_flow = demand.sum()
+    return_capacity = transport_capacity(config.return_settings)
+    recycle_capacity = transport_capacity(config.recycle_settings)
+
+    reaching, effective_p, recycle_flow = divider_flows(accept_p, demand, return_flow, config=config,
+                                                        iterations=iterations, tolerance=tolerance)
+    # Upstream channels still only take what they play when the transports are flat out
+    supply_reaching, _, _ = divider_flows(accept_p, demand, return_capacity, recycle_capacity, config,
+                                          iterations, tolerance)
+    return FlowAnalysis(
+        demand, reaching * accept_p, reaching * effective_p, supply_reaching * accept_p,
+        return_flow, recycle_flow, return_capacity, recycle_capacity
+    )
+
+
+# Marbles per beat offered to every channel (rolling onto it, to fall in if it has room) on every beat of num_plays
+# plays of the song, for a machine that starts out like a real one: channels full, reservoirs at reservoir_initial
+# and nothing on the transports, so nothing that's played comes back for beats_to_transport beats.
+# The machine is run on expected values rather than whole marbles: a transport channel releases channel_accept_p
+# marbles while its reservoir lasts, a channel with room takes its share of what rolls onto it (up to its room)
+# and passes the rest on, and a channel plays as many of its notes as it has marbles for.
+def transient_offered(song: MMXSong, config: SimConfig = SIM_CONFIG, accept_p=None, num_plays: int = 1) -> np.ndarray:
+    accept_p = mean_accept_p(config) if accept_p is None else np.asarray(accept_p, dtype=float)
+    max_counts = np.array(config.max_counts, dtype=float)
+    levels = max_counts.copy()
+    transports = (config.return_settings, config.recycle_settings)
+    reservoirs = [float(t_settings.reservoir_initial) for t_settings in transports]
+    queues = [np.zeros(t_settings.beats_to_transport) for t_settings in transports]
+    paths = [[divider_path(start, config) for start in divider_entry_points(t_settings)] for t_settings in transports]
+
+    offered = np.zeros((song.beat_count * num_plays, config.num_channels))
+    for beat in range(len(offered)):
+        # As MarbleTransport.simul_step(): what comes off the end of a transport can be released on the same beat,
+        # and what's added to it on this beat comes off beats_to_transport beats later
+        slots = [beat % t_settings.beats_to_transport for t_settings in transports]
+        fell_off = 0.0
+        for t, t_settings in enumerate(transports):
+            reservoirs[t] += queues[t][slots[t]]
+            queues[t][slots[t]] = 0
+            if beat % t_settings.beats_per_release != 0:
+                continue
+            for path in paths[t]:
+                flow = min(t_settings.channel_accept_p, reservoirs[t])
+                if flow <= 0:
+                    break
+                reservoirs[t] -= flow
+                for c in path:
+                    offered[beat, c] += flow * accept_p[c]
+                    taken = min(flow * accept_p[c], max_counts[c] - levels[c])
+                    levels[c] += taken
+                    flow -= taken
+                fell_off += flow
+        queues[1][slots[1]] += fell_off
+
+        played = np.minimum(song.effective_notes[beat % song.beat_count], levels)
+        levels -= played
+        queues[0][slots[0]] += played.sum()
+    return offered
+
+
+# P(a channel has to fire while empty) within num_plays plays of the song, from a truncated Markov chain.
+# The state is the number of marbles in the channel (0..capacity), starting full unless initial is given. Each beat
+# Poisson(offered) marbles arrive (anything over capacity rolls past), then the channel plays its notes for that beat.
+# offered is either the same every beat, or given for every beat of the num_plays plays (see transient_offered()).
+# Returns the probability of running dry by the end of each play.
+def dry_out_probability(demand_per_beat: Sequence[int], offered, capacity: int,
+                        num_plays: int = 1, initial: Optional[int] = None) -> np.ndarray:
+    states = capacity + 1
+    offered = np.broadcast_to(np.asarray(offered, dtype=float), (len(demand_per_beat) * num_plays,))
+    # k / 1, k / 2, ... for the Poisson probabilities
+    k = np.arange(1, states)
+
+    distribution = np.zeros(states)
+    distribution[capacity if initial is None else initial] = 1
+
+    ran_dry = 0.0
+    dry_by_play = np.empty(num_plays)
+    beat = 0
+    for play in range(num_plays):
+        for notes in demand_per_beat:
+            poisson = np.exp(-offered[beat]) * np.concatenate(([1.0], np.cumprod(offered[beat] / k)))
+            beat += 1
+            # From i marbles to j < capacity with j - i arrivals, or to capacity with any more than that
+            # (what's left of the distribution, the chance of having run dry already being gone from it)
+            remaining = distribution.sum()
+            distribution = np.convolve(distribution, poisson)[:states]
+            distribution[capacity] = remaining - distribution[:capacity].sum()
+            if notes:
+                ran_dry += distribution[:notes].sum()
+                distribution = np.concatenate((distribution[notes:], np.zeros(notes)))
+        dry_by_play[play] = ran_dry
+    return dry_by_play
+
+
+class ChannelRisk(NamedTuple):
+    channel: int
+    supply_ratio: float
+    dry_probability: float
+
+
+# Quick design screening: "fail" if a transport can't keep up with the song, or some channel can't be fed as fast
+# as it plays even with the transports flat out or is all but sure to run dry; "ok" if both transports and every
+# channel's supply have margin to spare (and no channel is likely to run dry); "borderline" otherwise (those are
+# worth a full simulation).
+def screen(song: MMXSong, config: SimConfig = SIM_CONFIG, num_plays: int = 1,
+           margin: float = 1.2, max_dry_probability: float = 0.01):
+    flow = analyze_flow(song, config)
+    offered = transient_offered(song, config, num_plays=num_plays)
+
+    risks: List[ChannelRisk] = []
+    for c in np.flatnonzero(flow.demand):
+        p_dry = dry_out_probability(song.effective_notes[:, c], offered[:, c], config.max_counts[c], num_plays)[-1]
+        risks.append(ChannelRisk(int(c), float(flow.supply_ratio[c]), float(p_dry)))
+
+    if (flow.return_flow > flow.return_capacity or flow.recycle_flow > flow.recycle_capacity
+            or len(flow.starved_channels) > 0 or any(r.dry_probability >= 1 - max_dry_probability for r in risks)):
+        verdict = "fail"
+    elif (flow.return_flow * margin <= flow.return_capacity and flow.recycle_flow * margin <= flow.recycle_capacity
+            and all(r.supply_ratio >= margin and r.dry_probability <= max_dry_probability for r in risks)):
+        verdict = "ok"
+    else:
+        verdict = "borderline"
+    return verdict, flow, risks
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    verdict, flow, risks = screen(song)
+    print(flow)
+    print()
+    print("Channel  P(dry within one play)")
+    for risk in risks:
+        print("{0:7d}  {1:.4f}".format(risk.channel + 1, risk.dry_probability))
+    print()
+    print("Verdict:", verdict)
@@ -0,0 +1,315 @@
+import random
+from typing import List, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from mmx import SimResult, divider_entry_points, divider_path
+from rng import mt19937
+
+
+# Most random draws a single replica can make in one beat:
+# one per transport channel, plus one to pick where each released marble lands
+def max_draws_per_beat(config: SimConfig):
+    return 2 * (config.return_settings.num_channels + config.recycle_settings.num_channels)
+
+
+# One MT19937 per replica, pre-drawn into a (replicas, block) buffer.
+# Each replica reads its own row in order, so it sees exactly the same numbers as
+# an MMX built with random.Random(seed) (or rng.UniformStream(seed)) would.
+class ReplicaUniforms:
+    def __init__(self, seeds: Sequence[int], block: int = 4096):
+        self.generators = [mt19937(random.Random(seed).getstate()) for seed in seeds]
+        self.block = block
+        self.buffer = np.empty((len(self.generators), self.block))
+        self.cursor = np.zeros(len(self.generators), dtype=np.int64)
+        for generator, row in zip(self.generators, self.buffer):
+            generator.random(out=row)
+
+    # Take the next number from the stream of each replica in rows (rows must be unique)
+    def take(self, rows):
+        cursor = self.cursor[rows]
+        self.cursor[rows] = cursor + 1
+        return self.buffer[rows, cursor]
+
+    # The next n numbers of each replica in rows as a (rows, n) matrix, without taking them (see skip())
+    def peek(self, rows, n):
+        return self.buffer[rows[:, None], self.cursor[rows, None] + np.arange(n)]
+
+    def skip(self, rows, n):
+        self.cursor[rows] += n
+
+    # Make sure every replica in rows has at least n numbers left in its buffer.
+    # What's left of every row running low is moved to the front in one go and the rest of the row
+    # drawn straight into the buffer.
+    def reserve(self, rows, n):
+        low = rows[self.cursor[rows] > self.block - n]
+        if low.size == 0:
+            return
+        cursor = self.cursor[low]
+        self.buffer[low] = self.buffer[low[:, None], np.minimum(cursor[:, None] + np.arange(self.block), self.block - 1)]
+        for r, left in zip(low.tolist(), (self.block - cursor).tolist()):
+            self.generators[r].random(out=self.buffer[r, left:])
+        self.cursor[low] = 0
+
+
+# A MarbleTransport for every replica: reservoirs are a vector and the queues a
+# (replicas, beats_to_transport) matrix that all share the same head position
+class BatchTransport:
+    def __init__(self, t_settings: MarbleTransportSettings, num_replicas: int):
+        self.settings: MarbleTransportSettings = t_settings
+        self.reservoir_waiting = np.full(num_replicas, self.settings.reservoir_initial, dtype=np.int64)
+        self.queue = np.zeros((num_replicas, self.settings.beats_to_transport), dtype=np.int64)
+        self.head = 0
+
+        self.divider_entry_points = divider_entry_points(self.settings)
+
+    def pop(self):
+        self.reservoir_waiting += self.queue[:, self.head]
+        self.queue[:, self.head] = 0
+        self.head = (self.head + 1) % self.settings.beats_to_transport
+
+    def add_marbles(self, rows, n):
+        self.queue[rows, (self.head - 1) % self.settings.beats_to_transport] += n
+
+    # pop() n times in one go
+    def advance(self, n):
+        slots = (self.head + np.arange(min(n, self.settings.beats_to_transport))) % self.settings.beats_to_transport
+        self.reservoir_waiting += self.queue[:, slots].sum(axis=1)
+        self.queue[:, slots] = 0
+        self.head = (self.head + n) % self.settings.beats_to_transport
+
+    # How many pop()s return 0 for all of rows before marbles come out, or None if their queues are empty
+    def beats_until_arrival(self, rows):
+        order = (self.head + np.arange(self.settings.beats_to_transport)) % self.settings.beats_to_transport
+        arriving = self.queue[rows][:, order].any(axis=0)
+        return int(arriving.argmax()) if arriving.any() else None
+
+    @property
+    def overflowed(self):
+        return self.reservoir_waiting > self.settings.reservoir_capacity
+
+
+# Many independent MMXs playing the same song, all advanced one beat at a time together.
+# Replica r makes the same random decisions, in the same order, as MMX(song, random.Random(seeds[r])),
+# so its outcome matches run_sim(song, seed=seeds[r]).
+class BatchMMX:
+    def __init__(self, song: MMXSong, seeds: Sequence[int], config: SimConfig = SIM_CONFIG):
+        self.song = song
+        self.config: SimConfig = config
+        self.num_replicas = len(seeds)
+        self.max_draws_per_beat = max_draws_per_beat(self.config)
+        self.uniforms = ReplicaUniforms(seeds, max(4096, 2 * self.max_draws_per_beat))
+
+        all_rows = np.arange(self.num_replicas)
+        self.marble_accept_p = np.empty((self.num_replicas, self.config.num_channels))
+        for c in range(self.config.num_channels):
+            self.marble_accept_p[:, c] = self.config.channel_accept_prob_min + \
+                (self.config.channel_accept_prob_max - self.config.channel_accept_prob_min) * self.uniforms.take(all_rows)
+        self.roll_past_p = 1 - self.marble_accept_p
+        self.max_counts = np.array(self.config.max_counts, dtype=np.int64)
+        self.counts = np.tile(self.max_counts, (self.num_replicas, 1))
+        # The divider in terms of positions along it (see MMX): a marble entering at start rolls past
+        # positions start, start+1, ..., and position p is channel position_channels[p]
+        self.position_channels = np.array(divider_path(0, self.config))
+        self.position_roll_past_p = self.roll_past_p[:, self.position_channels]
+        self.position_max_counts = self.max_counts[self.position_channels]
+
+        self.return_transport = BatchTransport(self.config.return_settings, self.num_replicas)
+        self.recycle_transport = BatchTransport(self.config.recycle_settings, self.num_replicas)
+
+        # (channels, notes per channel) played on each beat of the song
+        self.beat_notes = []
+        for notes in self.song.effective_notes.astype(np.int64):
+            channels = np.flatnonzero(notes)
+            self.beat_notes.append((channels, notes[channels]))
+
+        self.song_i = 0
+
+        # run() bookkeeping, kept here so that a run can be continued
+        self.results: List[SimResult] = [None] * self.num_replicas
+        self.num_played = np.zeros(self.num_replicas, dtype=np.int64)
+        self.fishstair_overflow_beat = np.full(self.num_replicas, -1, dtype=np.int64)
+        self.conveyor_overflow_beat = np.full(self.num_replicas, -1, dtype=np.int64)
+        self.unfinished_rows = all_rows
+
+    # MarbleTransport.simul_step() for every replica in rows, and MMX.divide_marble() for every marble it releases.
+    # The transport's channels are gone through one at a time, as a marble can fill up the channel it lands in
+    # before the next is released, but every replica's marble is divided at once: a single draw per replica picks
+    # the first position (with room) where the chance of having rolled past every position so far is <= the draw.
+    def transport_step(self, transport: BatchTransport, rows):
+        transport.pop()
+
+        if (self.song_i % transport.settings.beats_per_release) != 0:
+            return
+        rows = rows[transport.reservoir_waiting[rows] > 0]
+        if rows.size == 0:
+            return
+        num_channels = transport.settings.num_channels
+
+        # Everything the step needs for rows, as (positions along the divider, rows) matrices so that running
+        # products along the divider are worked out for all rows at once
+        counts = self.counts[rows][:, self.position_channels].T.copy()
+        not_full = counts < self.position_max_counts[:, None]
+        # P(rolling past) each position, or 1 if it's full (so it's skipped)
+        roll_past_p = np.where(not_full, self.position_roll_past_p[rows].T, 1.0)
+        roll_past = np.empty_like(roll_past_p)
+        num_positions = len(self.position_channels)
+        uniforms = self.uniforms.peek(rows, 2 * num_channels).ravel()
+        reservoir = transport.reservoir_waiting[rows]
+        row_i = np.arange(rows.size) * (2 * num_channels)
+        used = np.zeros(rows.size, dtype=np.int64)
+        released = np.zeros(rows.size, dtype=np.int64)
+        landed = np.zeros(rows.size, dtype=np.int64)
+
+        for start in transport.divider_entry_points:
+            active = released < reservoir
+            if not active.any():
+                break
+            accepted = active & (uniforms.take(row_i + used) <= transport.settings.channel_accept_p)
+            used += active
+            released += accepted
+
+            # Divide every replica's marble at once (the ones that didn't release a marble just don't land it).
+            # P(rolling past) only goes down along the divider, so the marble lands at the first position where
+            # it's <= u, i.e. after all the positions where it's still > u.
+            divided = accepted & not_full[start:].any(axis=0)
+            u = uniforms.take(row_i + used)
+            used += divided
+            # (Multiplied out a position at a time for many rows, which numpy does faster than accumulating along
+            # the first axis; the products come out the same either way)
+            if rows.size < 256:
+                np.multiply.accumulate(roll_past_p[start:], axis=0, out=roll_past[start:])
+            else:
+                roll_past[start] = roll_past_p[start]
+                for i in range(start + 1, num_positions):
+                    np.multiply(roll_past[i - 1], roll_past_p[i], out=roll_past[i])
+            lands = np.flatnonzero(divided & (roll_past[-1] <= u))
+            positions = start + (roll_past[start:] > u).sum(axis=0)[lands]
+            counts[positions, lands] += 1
+            filled = counts[positions, lands] >= self.position_max_counts[positions]
+            not_full[positions[filled], lands[filled]] = False
+            roll_past_p[positions[filled], lands[filled]] = 1.0
+            landed[lands] += 1
+
+        self.counts[rows[:, None], self.position_channels] = counts.T
+        transport.reservoir_waiting[rows] -= released
+        self.uniforms.skip(rows, used)
+        self.recycle_transport.add_marbles(rows, released - landed)
+
+    # MMX.fast_forward() for all of rows at once: only skips if it is exact for every one of them
+    def fast_forward(self, rows, max_beats=None):
+        if self.return_transport.reservoir_waiting[rows].any() or self.recycle_transport.reservoir_waiting[rows].any():
+            return 0
+        beats = self.song.idle_beats[self.song_i % self.song.beat_count]
+        if max_beats is not None:
+            beats = min(beats, max_beats)
+        for transport in (self.return_transport, self.recycle_transport):
+            if beats == 0:
+                return 0
+            arrival = transport.beats_until_arrival(rows)
+            if arrival is not None:
+                beats = min(beats, arrival)
+        if beats == 0:
+            return 0
+
+        self.return_transport.advance(beats)
+        self.recycle_transport.advance(beats)
+        self.song_i += beats
+        return beats
+
+    # Advance the replicas in rows by one beat, returns (num_played, played_empty, fishstair_overflowed, conveyor_overflowed)
+    # as vectors over rows, just like MMX.simul_step
+    def simul_step(self, rows):
+        self.uniforms.reserve(rows, self.max_draws_per_beat)
+
+        self.transport_step(self.return_transport, rows)
+        self.transport_step(self.recycle_transport, rows)
+
+        fishstair_overflowed = self.recycle_transport.overflowed[rows]
+        conveyor_overflowed = self.return_transport.overflowed[rows]
+
+        channels, notes = self.beat_notes[self.song_i % self.song.beat_count]
+        num_played = np.zeros(rows.size, dtype=np.int64)
+        played_empty = np.zeros(rows.size, dtype=bool)
+        if channels.size:
+            counts = self.counts[np.ix_(rows, channels)]
+            played = np.minimum(counts, notes)
+            self.counts[np.ix_(rows, channels)] = counts - played
+            num_played = played.sum(axis=1)
+            played_empty = (counts < notes).any(axis=1)
+
+        self.return_transport.add_marbles(rows, num_played)
+
+        self.song_i += 1
+
+        return num_played, played_empty, fishstair_overflowed, conveyor_overflowed
+
+    def finish(self, rows, ran_dry):
+        for r in rows:
+            self.results[r] = SimResult(
+                ran_dry, int(self.num_played[r]), self.song_i,
+                None if self.fishstair_overflow_beat[r] < 0 else int(self.fishstair_overflow_beat[r]),
+                None if self.conveyor_overflow_beat[r] < 0 else int(self.conveyor_overflow_beat[r]),
+                int(self.return_transport.reservoir_waiting[r]), int(self.recycle_transport.reservoir_waiting[r])
+            )
+
+    @property
+    def finished(self) -> bool:
+        return self.unfinished_rows.size == 0
+
+    # The batch equivalent of the run_sim() loop, returns one SimResult per replica.
+    # With max_beats the run pauses once song_i reaches it; replicas that haven't finished
+    # yet have None as their result, and calling run() again carries on where it stopped.
+    def run(self, marble_goal=LONG_RUN_MARBLE_GOAL, max_beats=None, fast_forward=FAST_FORWARD) -> List[SimResult]:
+        rows = self.unfinished_rows
+        while rows.size and (max_beats is None or self.song_i < max_beats):
+            if fast_forward:
+                self.fast_forward(rows, None if max_beats is None else max_beats - self.song_i)
+                if max_beats is not None and self.song_i >= max_beats:
+                    break
+            num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed = self.simul_step(rows)
+
+            self.finish(rows[played_empty], True)
+            playing = ~played_empty
+            rows, num_played_incr = rows[playing], num_played_incr[playing]
+
+            self.fishstair_overflow_beat[rows[fishstair_overflowed[playing] & (self.fishstair_overflow_beat[rows] < 0)]] = self.song_i
+            self.conveyor_overflow_beat[rows[conveyor_overflowed[playing] & (self.conveyor_overflow_beat[rows] < 0)]] = self.song_i
+            self.num_played[rows] += num_played_incr
+
+            done = self.num_played[rows] > marble_goal
+            self.finish(rows[done], False)
+            rows = rows[~done]
+
+        self.unfinished_rows = rows
+        return self.results
+
+
+def run_batch(song: MMXSong, seeds: Sequence[int], marble_goal=LONG_RUN_MARBLE_GOAL,
+              config: SimConfig = SIM_CONFIG) -> List[SimResult]:
+    return BatchMMX(song, seeds, config).run(marble_goal)
+
+
+# Check the batch engine against the one-machine-at-a-time model
+def check_against_run_sim(song: MMXSong, seeds: Sequence[int], marble_goal: int,
+                          config: SimConfig = SIM_CONFIG) -> bool:
+    from mmx import run_sim
+
+    batch_results = run_batch(song, seeds, marble_goal, config)
+    matches = True
+    for seed, batch_result in zip(seeds, batch_results):
+        sim_result = run_sim(song, seed=seed, marble_goal=marble_goal, do_plotting=False, config=config,
+                             checkpoint_path=None)
+        if sim_result != batch_result:
+            print("Seed {0} differs:\n\trun_sim: {1}\n\tbatch:   {2}".format(seed, sim_result, batch_result))
+            matches = False
+    return matches
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    if check_against_run_sim(song, range(20), 20_000):
+        print("Batch engine matches run_sim")
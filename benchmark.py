@@ -0,0 +1,156 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+from settings import *
+from song import MMXSong
+from mmx import MMX
+import kernel
+
+
+# Throughput benchmarks for the simulator's hot paths, on fixed songs and seeds so runs are comparable.
+# Each run is appended to BENCHMARK_HISTORY_PATH and compared against the previous one.
+#
+#     python benchmark.py
+#
+# exits with status 1 if anything got more than BENCHMARK_REGRESSION_THRESHOLD slower.
+
+BENCHMARK_SONG_PATH = "benchmark_song.json"  # A random song that doesn't run dry with the default settings
+BENCHMARK_SEED = 0
+
+
+# Run fn (which returns {metric: amount of work done}) `repeat` times and report the best work per second
+def measure(fn: Callable[[], Dict[str, float]], repeat: int) -> Dict[str, float]:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        work = fn()
+        elapsed = time.perf_counter() - start
+        rates = {metric: amount / elapsed for metric, amount in work.items()}
+        if best is None or all(rates[m] > best[m] for m in rates):
+            best = rates
+    return best
+
+
+def bench_simul_step(song: MMXSong, beats=20_000):
+    def run():
+        mmx = MMX(song, random.Random(BENCHMARK_SEED))
+        marbles = 0
+        for _ in range(beats):
+            marbles += mmx.simul_step()[0]
+        return {"beats_per_s": beats, "marbles_per_s": marbles}
+    return run
+
+
+# Only if numba is installed (the first repeat includes compiling it, if it isn't cached yet)
+def bench_kernel(song: MMXSong, beats=200_000):
+    def run():
+        mmx = MMX(song, random.Random(BENCHMARK_SEED))
+        while mmx.song_i < beats:
+            kernel.run_beats(mmx, 0, float("inf"), beats - mmx.song_i, False, False)
+        return {"beats_per_s": beats}
+    return run
+
+
+def bench_song_construction(song: MMXSong, count=200):
+    def run():
+        for _ in range(count):
+            MMXSong(song.wheel, song.mute_instructions, song.config)
+        return {"songs_per_s": count}
+    return run
+
+
+def bench_make_random(count=20):
+    def run():
+        random.seed(BENCHMARK_SEED)
+        for _ in range(count):
+            MMXSong.make_random()
+        return {"songs_per_s": count}
+    return run
+
+
+def bench_from_json(json_str: str, count=200):
+    def run():
+        for _ in range(count):
+            MMXSong.from_json(json_str)
+        return {"songs_per_s": count}
+    return run
+
+
+def run_benchmarks(repeat=BENCHMARK_REPEAT) -> Dict[str, Dict[str, float]]:
+    with open(BENCHMARK_SONG_PATH, "r") as f:
+        json_str = f.read()
+    song = MMXSong.from_json(json_str)
+
+    benchmarks = {
+        "simul_step": bench_simul_step(song),
+        "kernel": bench_kernel(song),
+        "song_construction": bench_song_construction(song),
+        "make_random": bench_make_random(),
+        "from_json": bench_from_json(json_str),
+    }
+    if kernel.numba is None:
+        del benchmarks["kernel"]
+    results = {}
+    for name, fn in benchmarks.items():
+        results[name] = measure(fn, repeat)
+        print("{0:20s} {1}".format(name, ", ".join("{0}: {1:,.0f}".format(m, v) for m, v in results[name].items())))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path=BENCHMARK_HISTORY_PATH) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_history(history: List[dict], path=BENCHMARK_HISTORY_PATH):
+    with open(path, "w") as f:
+        json.dump(history, f, indent=4)
+
+
+# Every (benchmark, metric, old, new) where new throughput is more than threshold below old
+def find_regressions(old: Dict[str, Dict[str, float]], new: Dict[str, Dict[str, float]],
+                     threshold=BENCHMARK_REGRESSION_THRESHOLD):
+    regressions = []
+    for name, metrics in new.items():
+        for metric, value in metrics.items():
+            old_value = old.get(name, {}).get(metric)
+            if old_value and value < old_value * (1 - threshold):
+                regressions.append((name, metric, old_value, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    history = load_history()
+    results = run_benchmarks()
+    history.append({
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    })
+    save_history(history)
+
+    if len(history) > 1:
+        regressions = find_regressions(history[-2]["results"], results)
+        for name, metric, old_value, value in regressions:
+            print("REGRESSION {0} {1}: {2:,.0f} -> {3:,.0f} ({4:+.1%})".format(
+                name, metric, old_value, value, value / old_value - 1))
+        if regressions:
+            sys.exit(1)
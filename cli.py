@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Sequence
+
+from settings import *
+
+
+# Run replicas of a song headless, for batch jobs and pipelines:
+#
+#     python cli.py --song song.json --settings overrides.json --replicas 100 --output results.jsonl
+#
+# Replicas are simulated without printing or plotting, a chunk at a time: by the batch engine, or one at a time
+# (in the kernel, if numba is installed) when that's faster (see BATCH_MIN_REPLICAS). Each is written out as one
+# row as soon as its chunk of replicas is done: appended to a JSON lines file ("-", the default, for stdout), or
+# appended to a Parquet file a row group at a time (which needs pyarrow). A replica run with --seed S is the same run as
+# mmx.run_sim(seed=S); with --replicas N the seeds come from --master-seed as for sweep.py.
+# The settings override file is a JSON object of {<name>: <value>}, with names as for EXPLORE_RANGES
+# (e.g. "return.reservoir_capacity" or "max_marbles_per_channel") and values as in JSON: numbers, true or false, or
+# for the settings that are lists of numbers (e.g. "channel_max_marbles") a list, or null if they're optional.
+# Only what a run needs is imported, after the arguments are parsed, so short runs start quickly;
+# matplotlib only with --plot.
+
+OUTPUT_FORMATS = ("jsonl", "parquet")
+
+
+# Seeds are unsigned 64 bit ints, like the ones rng.replica_seeds() makes
+def seed_arg(text: str) -> int:
+    seed = int(text)
+    if not 0 <= seed < 1 << 64:
+        raise argparse.ArgumentTypeError("seeds go from 0 to 2**64 - 1, got {0}".format(seed))
+    return seed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate replicas of a Marble Machine X song.")
+    song = parser.add_mutually_exclusive_group()
+    song.add_argument("--song", default=SONG_PATH, help="song JSON file (default: SONG_PATH, or a random song made from the first --seed "
+                           "or the --master-seed)")
+    song.add_argument("--corpus", help="corpus file (see corpus.py) to take the song from, with --index")
+    parser.add_argument("--index", type=int, default=0, help="song in --corpus to run (default: %(default)s)")
+    parser.add_argument("--settings", help="JSON file of settings to override")
+    seeds = parser.add_mutually_exclusive_group()
+    seeds.add_argument("--seed", type=seed_arg, nargs="+", help="seed of every replica to run")
+    seeds.add_argument("--replicas", type=int, default=1, help="replicas to run (default: %(default)s)")
+    parser.add_argument("--master-seed", type=int, default=SWEEP_SEED,
+                        help="seed the --replicas seeds are derived from (default: %(default)s)")
+    parser.add_argument("--marble-goal", type=int, default=LONG_RUN_MARBLE_GOAL,
+                        help="stop a replica that hasn't run dry after this many marbles (default: %(default)s)")
+    parser.add_argument("--output", default="-", help="file to write results to, or - for stdout (default: -)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS,
+                        help="output format (default: from the --output extension, else jsonl)")
+    parser.add_argument("--chunk-size", type=int, default=SWEEP_CHUNK_SIZE,
+                        help="replicas simulated together and written at once (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes to simulate chunks in, 0 for one per CPU (default: %(default)s)")
+    parser.add_argument("--plot", action="store_true", help="plot the survival curve of the replicas at the end")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = "parquet" if args.output.endswith(".parquet") else "jsonl"
+    if args.format == "parquet" and args.output == "-":
+        parser.error("Parquet output needs an --output file")
+    return args
+
+
+def load_config(path, config: SimConfig = SIM_CONFIG) -> SimConfig:
+    if path is None:
+        return config
+    from explore import apply_design_point
+
+    with open(path) as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise SystemExit("{0} should be a JSON object of settings".format(path))
+    try:
+        return apply_design_point(config, overrides)
+    except (AttributeError, ValueError) as e:
+        raise SystemExit("Can't apply the settings in {0}: {1}".format(path, e))
+
+
+def load_song(args: argparse.Namespace, config: SimConfig):
+    if args.corpus is not None:
+        from corpus import open_corpus
+
+        return open_corpus(args.corpus).song(args.index, config)
+    from song import MMXSong, load_default_song
+
+    if args.song is None:
+        return load_default_song(config, args.master_seed if args.seed is None else args.seed[0])
+    return MMXSong.from_file(args.song, config)
+
+
+def _run_chunk(song, marble_goal: int, config: SimConfig, seeds: Sequence[int]):
+    one_at_a_time = len(seeds) < BATCH_MIN_REPLICAS
+    if USE_KERNEL and not one_at_a_time:
+        import kernel
+
+        one_at_a_time = kernel.numba is not None
+    if one_at_a_time:
+        from mmx import run_replica
+
+        return [run_replica(song, seed, marble_goal, config) for seed in seeds]
+    from batch import run_batch
+
+    return run_batch(song, seeds, marble_goal, config)
+
+
+# The results of every replica, a chunk at a time in order of seeds (simulated in a process pool if workers != 1)
+def run_chunks(song, seeds: Sequence[int], marble_goal: int, chunk_size: int, workers: int,
+               config: SimConfig) -> Iterator[list]:
+    from sweep import run_chunked
+
+    for _, results in run_chunked(_run_chunk, seeds, chunk_size, [(song, marble_goal, config)], workers or None):
+        yield results
+
+
+# One row per replica (plain Python values, so they go straight into JSON)
+def result_rows(results, seeds: Sequence[int], first_replica: int, beat_count: int) -> List[Dict]:
+    return [{
+        "replica": first_replica + i,
+        "seed": int(seed),
+        "ran_dry": bool(r.ran_dry),
+        "marbles_played": int(r.marbles_played),
+        "beats": int(r.beats),
+        "plays": r.beats / beat_count,
+        "fishstair_overflow_beat": None if r.fishstair_overflow_beat is None else int(r.fishstair_overflow_beat),
+        "conveyor_overflow_beat": None if r.conveyor_overflow_beat is None else int(r.conveyor_overflow_beat),
+        "conveyor_waiting": int(r.conveyor_waiting),
+        "fishstair_waiting": int(r.fishstair_waiting),
+    } for i, (seed, r) in enumerate(zip(seeds, results))]
+
+
+# Appends rows to a JSON lines file, one line per row, flushed after every chunk
+class JsonLinesWriter:
+    def __init__(self, path):
+        self.file = sys.stdout if path == "-" else open(path, "a")
+
+    def write(self, rows: List[Dict]):
+        self.file.write("".join(json.dumps(row) + "\n" for row in rows))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# Appends rows to a Parquet file, a row group per chunk.
+# Parquet files can't be added to in place, so the rows already in the file (if there is one) and the new ones are
+# written to a new file next to it, which replaces it when the writer is closed.
+class ParquetWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow), or use --format jsonl")
+        self.pyarrow = pyarrow
+        # The columns of result_rows(), typed up front as a chunk can have nothing but None in a column
+        self.schema = pyarrow.schema([
+            ("replica", pyarrow.int64()), ("seed", pyarrow.uint64()), ("ran_dry", pyarrow.bool_()),
+            ("marbles_played", pyarrow.int64()), ("beats", pyarrow.int64()), ("plays", pyarrow.float64()),
+            ("fishstair_overflow_beat", pyarrow.int64()), ("conveyor_overflow_beat", pyarrow.int64()),
+            ("conveyor_waiting", pyarrow.int64()), ("fishstair_waiting", pyarrow.int64()),
+        ])
+        existing = pyarrow.parquet.ParquetFile(path) if os.path.exists(path) else None
+        if existing is not None and not existing.schema_arrow.equals(self.schema):
+            raise SystemExit("Can't append to {0}, its columns aren't the ones written here".format(path))
+
+        self.path = path
+        self.new_path = path + ".new"
+        self.writer = pyarrow.parquet.ParquetWriter(self.new_path, self.schema)
+        if existing is not None:
+            for i in range(existing.num_row_groups):
+                self.writer.write_table(existing.read_row_group(i))
+
+    def write(self, rows: List[Dict]):
+        self.writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.new_path, self.path)
+
+
+def plot_survival(results, beat_count: int):
+    import matplotlib.pyplot as plt
+    from sweep import survival_curve
+
+    dry_beats, survival = survival_curve(results)
+    plt.step(dry_beats / beat_count, survival, where="post")
+    plt.xlabel("Plays of the song")
+    plt.ylabel("Fraction of replicas not yet dry")
+    plt.show()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = load_config(args.settings)
+    song = load_song(args, config)
+    if args.seed is not None:
+        seeds = args.seed
+    else:
+        from rng import replica_seeds
+
+        seeds = replica_seeds(args.master_seed, args.replicas)
+
+    writer = JsonLinesWriter(args.output) if args.format == "jsonl" else ParquetWriter(args.output)
+    all_results = []
+    try:
+        replica = 0
+        for results in run_chunks(song, seeds, args.marble_goal, args.chunk_size, args.workers, config):
+            writer.write(result_rows(results, seeds[replica:replica+len(results)], replica, song.beat_count))
+            replica += len(results)
+            if args.plot:
+                all_results += results
+    finally:
+        writer.close()
+
+    if args.plot:
+        plot_survival(all_results, song.beat_count)
+
+
+if __name__ == "__main__":
+    main()
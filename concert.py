@@ -0,0 +1,135 @@
+import os
+from array import array
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, idle_beats
+
+
+# A setlist of songs played one after the other, with the machine running for a few beats without playing
+# between songs, and everything (channels, transports, reservoirs) carrying over from one song to the next.
+# It has the same compiled schedule as an MMXSong (beat_offsets, beat_channels, ...), covering the whole
+# concert, so it can be used anywhere a song can: MMX, BatchMMX, the kernel, sweeps and sequential tests.
+# Like a song it repeats once it reaches the end, so simulate concert_plays=1 of it (see sequential.py)
+# or a marble goal that fits within it.
+
+
+# Songs loaded from JSON files, compiled once and reused (e.g. by every replica, or every concert using them).
+# A file is loaded again if it changes.
+class SongCache:
+    def __init__(self):
+        self.songs: Dict[Tuple[str, int, SimConfig], MMXSong] = {}
+
+    def load(self, path, config: SimConfig = SIM_CONFIG) -> MMXSong:
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns, config)
+        song = self.songs.get(key)
+        if song is None:
+            song = MMXSong.from_file(path, config)
+            self.songs[key] = song
+        return song
+
+    def clear(self):
+        self.songs.clear()
+
+
+SONG_CACHE = SongCache()
+
+
+class Concert:
+    # gap_beats is either the gap after every song, or a list with the gap after each song
+    def __init__(self, songs: Sequence[MMXSong], gap_beats: Union[int, Sequence[int]] = CONCERT_GAP_BEATS,
+                 names: Sequence[str] = None, config: SimConfig = SIM_CONFIG):
+        if not songs:
+            raise ValueError("A concert needs at least one song")
+        if isinstance(gap_beats, int):
+            gap_beats = [gap_beats] * len(songs)
+        if len(gap_beats) != len(songs):
+            raise ValueError("Got {0} gaps for {1} songs".format(len(gap_beats), len(songs)))
+
+        self.config: SimConfig = config
+        self.songs: List[MMXSong] = list(songs)
+        self.gap_beats: List[int] = list(gap_beats)
+        self.names: List[str] = list(names) if names is not None else ["Song {0}".format(i + 1) for i in range(len(songs))]
+
+        self.compile_schedule()
+
+        self.note_count = len(self.beat_channels)
+        self.npb = self.note_count / self.beat_count
+
+    # MMXSong.compile_schedule() for the whole concert, by joining the songs' schedules and the gaps together
+    def compile_schedule(self):
+        num_channels = self.config.num_channels
+        offsets = [np.zeros(1, dtype=np.uint32)]
+        enabled = []
+        effective_notes = []
+        self.song_starts: List[int] = []  # The beat each song starts on
+        beat_count = 0
+        note_total = 0
+        for song, gap in zip(self.songs, self.gap_beats):
+            self.song_starts.append(beat_count)
+            offsets.append(np.frombuffer(song.beat_offsets, dtype=np.uint32)[1:] + note_total)
+            note_total += len(song.beat_channels)
+            offsets.append(np.full(gap, note_total, dtype=np.uint32))
+            enabled += [song.enabled, np.zeros((gap, num_channels), dtype=bool)]
+            effective_notes += [song.effective_notes, np.zeros((gap, num_channels), dtype=np.uint8)]
+            beat_count += song.beat_count + gap
+        self.beat_count = beat_count
+        self.enabled = np.concatenate(enabled)
+        self.effective_notes = np.concatenate(effective_notes)
+
+        self.beat_offsets = array("I", np.concatenate(offsets).tobytes())
+        self.beat_channels = array("B", b"".join(song.beat_channels.tobytes() for song in self.songs))
+        self.beat_note_counts = array("B", self.effective_notes.tobytes())
+        self.idle_beats = idle_beats(self.beat_offsets)
+
+    # Which song is being played (or was just played, during a gap) on beat i
+    def song_on_beat(self, i) -> int:
+        return int(np.searchsorted(self.song_starts, i % self.beat_count, side="right")) - 1
+
+    def notes_on_beat(self, i):
+        i %= self.beat_count
+        return self.beat_channels[self.beat_offsets[i]:self.beat_offsets[i+1]]
+
+    # The songs in files, loaded through cache
+    @staticmethod
+    def from_files(paths: Sequence[str], gap_beats: Union[int, Sequence[int]] = CONCERT_GAP_BEATS,
+                   config: SimConfig = SIM_CONFIG, cache: SongCache = SONG_CACHE):
+        return Concert([cache.load(path, config) for path in paths], gap_beats,
+                       [os.path.splitext(os.path.basename(path))[0] for path in paths], config)
+
+    # Every song JSON file in directory, played in order of file name
+    @staticmethod
+    def from_directory(directory, gap_beats: Union[int, Sequence[int]] = CONCERT_GAP_BEATS,
+                       config: SimConfig = SIM_CONFIG, cache: SongCache = SONG_CACHE):
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".json"))
+        if not paths:
+            raise ValueError("No song JSON files in '{0}'".format(directory))
+        return Concert.from_files(paths, gap_beats, config, cache)
+
+    def __repr__(self):
+        lines = ["Concert:"]
+        for name, song, start, gap in zip(self.names, self.songs, self.song_starts, self.gap_beats):
+            lines.append("\t{0:5d}  {1:30s}  {2:5d} beats, {3:5d} notes, then {4} beats' gap".format(
+                start, name, song.beat_count, song.note_count, gap))
+        lines += [
+            "",
+            "Notes Count:        {0}".format(self.note_count),
+            "Beats Length:       {0}".format(self.beat_count),
+            "Notes per Beat:     {0:.2f}".format(self.npb),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    from sequential import sequential_test
+
+    if CONCERT_PATH is None:
+        raise ValueError("Set CONCERT_PATH in settings.py to a directory of song JSON files")
+    concert = Concert.from_directory(CONCERT_PATH)
+    print(concert)
+    result = sequential_test(concert, concert_plays=1, max_workers=None)
+    print("P(running dry during the concert) < {0}: {1} (after {2} replicas, {3} ran dry)".format(
+        SEQUENTIAL_TARGET, result.verdict, result.replicas, result.ran_dry))
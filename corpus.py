@@ -0,0 +1,140 @@
+import os
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, make_random_wheels
+
+
+# A compact binary file holding many songs, laid out so that it can be memory-mapped: opening a corpus reads
+# nothing but the header, and every process that opens the same file shares its pages, so sweep workers can
+# each pick songs out of one corpus instead of every one of them parsing JSON.
+#
+#   header          HEADER_DTYPE
+#   wheels          uint8[num_songs, num_channels, beats_per_wheel]
+#   section_starts  uint32[num_songs + 1]   song i's mute sections are sections[section_starts[i]:section_starts[i+1]]
+#   sections        SECTION_DTYPE[num_sections]
+#
+# each part starting on a multiple of 8 bytes. (JSON is still the format for swapping single songs around.)
+
+CORPUS_MAGIC = b"MMXCORP"
+CORPUS_VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"), ("version", "<u4"), ("num_songs", "<u4"),
+    ("num_channels", "<u4"), ("beats_per_wheel", "<u4"), ("num_sections", "<u4"), ("padding", "<u4"),
+])
+SECTION_NAME_BYTES = 36
+SECTION_DTYPE = np.dtype([("mask", "<u8"), ("length", "<u4"), ("name", "S{0}".format(SECTION_NAME_BYTES))])
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+# Byte offsets of the wheels, section_starts and sections
+def _layout(header):
+    wheels = _aligned(HEADER_DTYPE.itemsize)
+    section_starts = _aligned(wheels + int(header["num_songs"]) * int(header["num_channels"]) * int(header["beats_per_wheel"]))
+    sections = _aligned(section_starts + 4 * (int(header["num_songs"]) + 1))
+    return wheels, section_starts, sections
+
+
+# wheels is anything that turns into a (num_songs, num_channels, beats_per_wheel) array of note counts,
+# mute_instructions a list of SongMuteInstructions for each song
+def write_corpus(path, wheels, mute_instructions: Sequence[Sequence[SongMuteInstruction]]):
+    wheels = np.asarray(wheels)
+    if wheels.ndim != 3:
+        raise ValueError("Expected wheels as (songs, channels, beats), got shape {0}".format(wheels.shape))
+    if len(mute_instructions) != len(wheels):
+        raise ValueError("Got mute instructions for {0} songs, but {1} wheels".format(len(mute_instructions), len(wheels)))
+    if wheels.size and (wheels.min() < 0 or wheels.max() > 255):
+        raise ValueError("Note counts must fit in a byte")
+
+    section_starts = np.zeros(len(wheels) + 1, dtype="<u4")
+    section_starts[1:] = np.cumsum([len(instructions) for instructions in mute_instructions])
+    sections = np.zeros(int(section_starts[-1]), dtype=SECTION_DTYPE)
+    for i, instruction in enumerate(mi for instructions in mute_instructions for mi in instructions):
+        name = instruction.name.encode("utf-8")
+        if len(name) > SECTION_NAME_BYTES:
+            raise ValueError("Mute section name '{0}' is longer than {1} bytes".format(instruction.name, SECTION_NAME_BYTES))
+        sections[i] = (instruction.mask, instruction.length, name)
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header[0] = (CORPUS_MAGIC, CORPUS_VERSION, len(wheels), wheels.shape[1], wheels.shape[2], len(sections), 0)
+    offsets = _layout(header[0])
+
+    # Written to a temporary file first so a half written corpus is never left behind
+    with open(path + ".tmp", "wb") as f:
+        for offset, part in zip((0,) + offsets, (header, wheels.astype(np.uint8), section_starts, sections)):
+            f.write(bytes(offset - f.tell()))
+            f.write(np.ascontiguousarray(part).tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def write_songs(path, songs: Sequence[MMXSong]):
+    write_corpus(path, [song.wheel for song in songs], [song.mute_instructions for song in songs])
+
+
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+        if len(header) == 0 or header[0]["magic"] != CORPUS_MAGIC:
+            raise ValueError("'{0}' isn't an MMX song corpus".format(path))
+        header = header[0]
+        if header["version"] != CORPUS_VERSION:
+            raise ValueError("Unsupported corpus version {0}, expected {1}".format(header["version"], CORPUS_VERSION))
+
+        self.num_channels = int(header["num_channels"])
+        self.beats_per_wheel = int(header["beats_per_wheel"])
+        num_songs = int(header["num_songs"])
+        wheels, section_starts, sections = _layout(header)
+        self.wheels = self.__map(np.uint8, wheels, (num_songs, self.num_channels, self.beats_per_wheel))
+        self.section_starts = self.__map("<u4", section_starts, (num_songs + 1,))
+        self.sections = self.__map(SECTION_DTYPE, sections, (int(header["num_sections"]),))
+
+    def __map(self, dtype, offset, shape):
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)  # Can't memory-map nothing
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def __len__(self):
+        return len(self.wheels)
+
+    def mute_instructions(self, i) -> List[SongMuteInstruction]:
+        return [
+            SongMuteInstruction(int(section["mask"]), int(section["length"]), section["name"].decode("utf-8"))
+            for section in self.sections[self.section_starts[i]:self.section_starts[i + 1]]
+        ]
+
+    def song(self, i, config: SimConfig = SIM_CONFIG) -> MMXSong:
+        if (self.num_channels, self.beats_per_wheel) != (config.num_channels, config.beats_per_wheel):
+            raise ValueError("Corpus has {0} channels and {1} beats per wheel, config has {2} and {3}".format(
+                self.num_channels, self.beats_per_wheel, config.num_channels, config.beats_per_wheel))
+        return MMXSong(self.wheels[i], self.mute_instructions(i), config)
+
+    def __getitem__(self, i) -> MMXSong:
+        return self.song(i)
+
+    def __iter__(self):
+        return (self.song(i) for i in range(len(self)))
+
+
+_open_corpora: Dict[str, Corpus] = {}
+
+
+# The corpus at path, opened once per process
+def open_corpus(path) -> Corpus:
+    path = os.path.abspath(path)
+    if path not in _open_corpora:
+        _open_corpora[path] = Corpus(path)
+    return _open_corpora[path]
+
+
+if __name__ == "__main__":
+    wheels = make_random_wheels(CORPUS_SIZE)
+    write_corpus(CORPUS_PATH, wheels, [SIM_CONFIG.random_song_mute_instructions] * CORPUS_SIZE)
+    corpus = Corpus(CORPUS_PATH)
+    print("Wrote {0} random songs to {1} ({2:,} bytes)".format(len(corpus), CORPUS_PATH, os.path.getsize(CORPUS_PATH)))
@@ -0,0 +1,282 @@
+import heapq
+import random
+from array import array
+from typing import List, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, idle_beats, load_default_song
+from mmx import MMX, SimResult
+from batch import run_batch
+from rng import UniformStream, replica_seeds
+from sweep import SweepResult, run_chunked
+
+
+# A discrete-event version of the machine, in ticks of 1/ticks_per_beat of a beat instead of whole beats, to see
+# whether timing the beat model averages away (or just doesn't have) makes any difference to when it runs dry:
+#   - the notes a channel plays within a beat are spread evenly over the beat instead of all played at its start
+#   - every marble takes its own time on a transport: beats_to_transport, give or take up to transport_jitter beats
+#   - marbles take divider_beats_per_channel beats to roll past each divider channel, so they land some time after
+#     being released (meanwhile they already count towards filling the channel they are heading for, but can't
+#     be played yet) or fall off the end and go round to the recycle transport some time later
+#   - with stepped_transports marbles are only picked up when the transport steps at the start of a beat (like
+#     the beat model), otherwise they set off as soon as they reach it
+# Everything still waiting to happen is kept in a timer wheel of counts per tick (so all the marbles arriving
+# somewhere on the same tick are one event, however many there are), with a heap of the ticks that have
+# something on them so that the ticks where nothing happens are skipped.
+#
+# With one tick per beat, no jitter, no time on the divider and stepped transports it is exactly the beat model,
+# random draw for random draw (see check_against_beat_model()).
+class EventMMX(MMX):
+    def __init__(self, song, rng=random, config: SimConfig = SIM_CONFIG, ticks_per_beat=EVENT_TICKS_PER_BEAT,
+                 transport_jitter=EVENT_TRANSPORT_JITTER, divider_beats_per_channel=EVENT_DIVIDER_BEATS_PER_CHANNEL,
+                 stepped_transports=EVENT_STEPPED_TRANSPORTS):
+        super().__init__(song, rng, config)
+        self.ticks_per_beat = ticks_per_beat
+        self.jitter_ticks = round(transport_jitter * ticks_per_beat)
+        self.divider_ticks_per_channel = divider_beats_per_channel * ticks_per_beat
+        self.stepped_transports = stepped_transports
+        self.compile_ticks()
+
+        transports = (self.return_transport, self.recycle_transport)
+        self.reservoirs = [transport.reservoir_waiting for transport in transports]
+        self.transport_ticks = [transport.settings.beats_to_transport * ticks_per_beat for transport in transports]
+        self.reserved = list(self.counts)   # Marbles in each channel plus those on the divider heading for it
+
+        # Far enough ahead for anything that can be scheduled
+        self.horizon = max(self.transport_ticks) + ticks_per_beat + self.jitter_ticks + \
+            round(self.config.num_channels * self.divider_ticks_per_channel) + 2
+        self.transport_wheel = [[0] * self.horizon, [0] * self.horizon]
+        self.divider_wheel = [None] * self.horizon  # {channel (or -1 for falling off the end): marbles}
+        self.scheduled: List[int] = []              # Heap of the ticks with something on the wheels
+        self.tick = 0
+
+    # MMXSong.compile_schedule() in ticks: tick_channels[tick_offsets[i]:tick_offsets[i+1]] are the channels fired
+    # on tick i of the song, the notes a channel plays within a beat going evenly through the beat
+    def compile_ticks(self):
+        tpb = self.ticks_per_beat
+        beats, channels = np.nonzero(self.song.effective_notes)
+        notes = self.song.effective_notes[beats, channels].astype(np.int64)
+        beats, channels, per_beat = np.repeat(beats, notes), np.repeat(channels, notes), np.repeat(notes, notes)
+        nth = np.arange(len(beats)) - np.repeat(np.cumsum(notes) - notes, notes)
+        ticks = beats * tpb + nth * tpb // per_beat
+        order = np.lexsort((channels, ticks))
+
+        self.song_ticks = self.song.beat_count * tpb
+        self.tick_channels = array("B", channels[order].astype(np.uint8).tobytes())
+        self.tick_offsets = array("I", np.concatenate((
+            [0], np.cumsum(np.bincount(ticks, minlength=self.song_ticks)))).astype(np.uint32).tobytes())
+        self.idle_ticks = idle_beats(self.tick_offsets)
+
+    def __schedule(self, tick):
+        heapq.heappush(self.scheduled, tick)
+
+    # A marble reaches transport t at tick (after_step: once the transport has already stepped on that tick)
+    def send(self, t, tick, after_step, n=1):
+        tpb = self.ticks_per_beat
+        if self.stepped_transports:
+            pickup = tick if tick % tpb == 0 and not after_step else (tick // tpb + 1) * tpb
+            arrival = pickup + self.transport_ticks[t] - tpb
+        else:
+            arrival = tick + self.transport_ticks[t]
+        wheel = self.transport_wheel[t]
+        if not self.jitter_ticks:
+            arrival = max(arrival, tick + 1)
+            if not wheel[arrival % self.horizon]:
+                self.__schedule(arrival)
+            wheel[arrival % self.horizon] += n
+            return
+        rand = self.rng.random
+        spread = 2 * self.jitter_ticks + 1
+        for _ in range(n):
+            jittered = max(arrival + int(rand() * spread) - self.jitter_ticks, tick + 1)
+            if not wheel[jittered % self.horizon]:
+                self.__schedule(jittered)
+            wheel[jittered % self.horizon] += 1
+
+    # MMX.divide_marble(), except that the marble takes a while to get where it's going
+    def release_marble(self, start: int, tick, after_step):
+        candidates = (self.not_full >> start) << start
+        landed = -1
+        p = self.config.num_channels - 1
+        if candidates:
+            u = self.rng.random()
+            roll_past = 1.0
+            while candidates:
+                lowest = candidates & -candidates
+                p = lowest.bit_length() - 1
+                roll_past *= self.roll_past_p[p]
+                if roll_past <= u:
+                    landed = self.position_channels[p]
+                    self.reserved[landed] += 1
+                    if self.reserved[landed] >= self.max_counts[landed]:
+                        self.not_full ^= lowest
+                    break
+                candidates ^= lowest
+            else:
+                p = self.config.num_channels - 1
+
+        travel = round((p - start + 1) * self.divider_ticks_per_channel)
+        if travel == 0:
+            if landed >= 0:
+                self.counts[landed] += 1
+            else:
+                self.send(1, tick, after_step)
+            return
+        arrival = tick + travel
+        slot = self.divider_wheel[arrival % self.horizon]
+        if slot is None:
+            slot = self.divider_wheel[arrival % self.horizon] = {}
+            self.__schedule(arrival)
+        slot[landed] = slot.get(landed, 0) + 1
+
+    # The first tick from tick on where anything can happen
+    def next_tick(self, tick):
+        next_tick = self.scheduled[0] if self.scheduled else float("inf")
+        if self.song.note_count:
+            next_tick = min(next_tick, tick + self.idle_ticks[tick % self.song_ticks])
+        for t, transport in enumerate((self.return_transport, self.recycle_transport)):
+            if self.reservoirs[t] > 0:
+                every = transport.settings.beats_per_release
+                beat = -(-tick // self.ticks_per_beat)
+                next_tick = min(next_tick, -(-beat // every) * every * self.ticks_per_beat)
+        return next_tick
+
+    # Simulate until a channel is played empty, more than marble_goal marbles have been played or
+    # max_beats have gone by, and report like run_sim() does (beats are the beats started)
+    def run(self, marble_goal=LONG_RUN_MARBLE_GOAL, max_beats=None) -> SimResult:
+        tpb = self.ticks_per_beat
+        transports = (self.return_transport, self.recycle_transport)
+        counts, reserved, empty_fires, channel_bits = self.counts, self.reserved, self.empty_fires, self.channel_bits
+        tick_offsets, tick_channels = self.tick_offsets, self.tick_channels
+        num_played = 0
+        ran_dry = False
+        overflow_beats = [None, None]
+        tick = self.tick
+
+        while True:
+            next_tick = self.next_tick(tick)
+            if max_beats is not None and next_tick >= max_beats * tpb:
+                tick = max_beats * tpb
+                break
+            if next_tick == float("inf"):
+                break  # Nothing left to happen, ever
+            tick = next_tick
+            slot = tick % self.horizon
+
+            # Marbles reaching the end of the divider, then the reservoirs
+            while self.scheduled and self.scheduled[0] == tick:
+                heapq.heappop(self.scheduled)
+            arrivals = self.divider_wheel[slot]
+            if arrivals is not None:
+                self.divider_wheel[slot] = None
+                for c, n in arrivals.items():
+                    if c >= 0:
+                        counts[c] += n
+                    else:
+                        self.send(1, tick, False, n)
+            for t in range(2):
+                self.reservoirs[t] += self.transport_wheel[t][slot]
+                self.transport_wheel[t][slot] = 0
+
+            # Releases onto the divider, at the start of a beat
+            if tick % tpb == 0:
+                beat = tick // tpb
+                for t, transport in enumerate(transports):
+                    if beat % transport.settings.beats_per_release:
+                        continue
+                    rand = self.rng.random
+                    channel_accept_p = transport.settings.channel_accept_p
+                    for start in transport.divider_entry_points:
+                        if self.reservoirs[t] <= 0:
+                            break
+                        if rand() <= channel_accept_p:
+                            self.reservoirs[t] -= 1
+                            self.release_marble(start, tick, t == 1)
+            overflowed = [self.reservoirs[t] > transports[t].settings.reservoir_capacity for t in range(2)]
+
+            # Notes
+            song_tick = tick % self.song_ticks
+            played = 0
+            played_empty = False
+            for c in tick_channels[tick_offsets[song_tick]:tick_offsets[song_tick + 1]]:
+                if counts[c] <= 0:
+                    empty_fires[c] += 1
+                    played_empty = True
+                    continue
+                counts[c] -= 1
+                reserved[c] -= 1
+                self.not_full |= channel_bits[c]
+                played += 1
+            if played:
+                self.send(0, tick, True, played)
+
+            tick += 1
+            if played_empty:
+                ran_dry = True
+                break
+            for t in range(2):
+                if overflowed[t] and overflow_beats[t] is None:
+                    overflow_beats[t] = -(-tick // tpb)
+            num_played += played
+            if num_played > marble_goal:
+                break
+
+        self.tick = tick
+        self.song_i = -(-tick // tpb)
+        for t, transport in enumerate(transports):
+            transport.reservoir_waiting = self.reservoirs[t]
+        return SimResult(ran_dry, num_played, self.song_i, overflow_beats[1], overflow_beats[0],
+                         self.reservoirs[0], self.reservoirs[1])
+
+
+def run_event_sim(song: MMXSong, seed: int, marble_goal=LONG_RUN_MARBLE_GOAL, config: SimConfig = SIM_CONFIG,
+                  **timing) -> SimResult:
+    return EventMMX(song, UniformStream(seed), config, **timing).run(marble_goal)
+
+
+def _run_chunk(song: MMXSong, marble_goal: int, config: SimConfig, timing: dict, seeds: Sequence[int]):
+    return [run_event_sim(song, seed, marble_goal, config, **timing) for seed in seeds]
+
+
+# run_event_sim() for every seed, in parallel
+def run_event_replicas(song: MMXSong, seeds: Sequence[int], marble_goal=EVENT_MARBLE_GOAL,
+                       config: SimConfig = SIM_CONFIG, max_workers=None, chunk_size=SWEEP_CHUNK_SIZE,
+                       **timing) -> List[SimResult]:
+    results: List[SimResult] = []
+    for _, chunk_results in run_chunked(_run_chunk, seeds, chunk_size, [(song, marble_goal, config, timing)],
+                                        max_workers):
+        results += chunk_results
+    return results
+
+
+# With the beat model's timing the event engine should give exactly the same results as the beat model
+def check_against_beat_model(song: MMXSong, seeds: Sequence[int], marble_goal: int,
+                             config: SimConfig = SIM_CONFIG) -> bool:
+    expected = run_batch(song, seeds, marble_goal, config)
+    matches = True
+    for seed, beat_result in zip(seeds, expected):
+        event_result = run_event_sim(song, seed, marble_goal, config, ticks_per_beat=1, transport_jitter=0,
+                                     divider_beats_per_channel=0, stepped_transports=True)
+        if event_result != beat_result:
+            print("Seed {0} differs:\n\tbeat model:   {1}\n\tevent engine: {2}".format(seed, beat_result, event_result))
+            matches = False
+    return matches
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    if check_against_beat_model(song, range(10), 20_000):
+        print("Event engine with beat model timing matches the beat model")
+
+    seeds = replica_seeds(SWEEP_SEED, EVENT_REPLICAS)
+    print()
+    print("Beat model:")
+    print(SweepResult(run_batch(song, seeds, EVENT_MARBLE_GOAL), song.beat_count))
+    print()
+    print("Event engine ({0} ticks per beat, +-{1} beats transport jitter, {2} beats per divider channel{3}):".format(
+        EVENT_TICKS_PER_BEAT, EVENT_TRANSPORT_JITTER, EVENT_DIVIDER_BEATS_PER_CHANNEL,
+        ", stepped transports" if EVENT_STEPPED_TRANSPORTS else ""))
+    print(SweepResult(run_event_replicas(song, seeds), song.beat_count))
@@ -0,0 +1,164 @@
+import csv
+import itertools
+import random
+from typing import Dict, List, Sequence, Tuple, Union, get_args, get_origin, get_type_hints
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from batch import BatchMMX
+from rng import replica_seeds
+from sweep import run_chunked
+
+
+# Design point names like "return.beats_to_transport" refer to a field of one of the transports
+TRANSPORT_PREFIXES = {
+    "return": "return_settings",
+    "recycle": "recycle_settings",
+}
+
+
+def get_setting(config: SimConfig, name: str):
+    prefix, _, field = name.rpartition(".")
+    if prefix:
+        if prefix not in TRANSPORT_PREFIXES:
+            raise ValueError("Unknown transport '{0}' in '{1}'".format(prefix, name))
+        return getattr(getattr(config, TRANSPORT_PREFIXES[prefix]), field)
+    return getattr(config, field)
+
+
+# Convert a value from a design to the type of the setting it is for (rounding ints and bools).
+# Settings that are tuples of ints (like channel_max_marbles) take a list of numbers, and optional ones None;
+# other kinds of settings (like the random song settings) can't be set this way.
+def cast_setting(config: SimConfig, name: str, value):
+    get_setting(config, name)
+    prefix, _, field = name.rpartition(".")
+    owner = getattr(config, TRANSPORT_PREFIXES[prefix]) if prefix else config
+    setting_type = get_type_hints(type(owner))[field]
+    if get_origin(setting_type) is Union and type(None) in get_args(setting_type):
+        if value is None:
+            return None
+        setting_type, = (arg for arg in get_args(setting_type) if arg is not type(None))
+
+    if setting_type in (int, bool, float):
+        if not isinstance(value, (int, float)):
+            raise ValueError("Setting '{0}' takes a number, got {1!r}".format(name, value))
+        return setting_type(round(value)) if setting_type in (int, bool) else float(value)
+    if setting_type == Tuple[int, ...]:
+        if not isinstance(value, (list, tuple)) or not all(isinstance(v, (int, float)) for v in value):
+            raise ValueError("Setting '{0}' takes a list of numbers, got {1!r}".format(name, value))
+        return tuple(int(round(v)) for v in value)
+    raise ValueError("Setting '{0}' can't be set from a design or settings file".format(name))
+
+
+def apply_design_point(config: SimConfig, point: Dict[str, float]) -> SimConfig:
+    changes = {}
+    transport_changes = {field: {} for field in TRANSPORT_PREFIXES.values()}
+    for name, value in point.items():
+        value = cast_setting(config, name, value)
+        prefix, _, field = name.rpartition(".")
+        if prefix:
+            transport_changes[TRANSPORT_PREFIXES[prefix]][field] = value
+        else:
+            changes[field] = value
+
+    for transport_field, fields in transport_changes.items():
+        if fields:
+            changes[transport_field] = getattr(config, transport_field)._replace(**fields)
+    return config._replace(**changes)
+
+
+# Every combination of `levels` evenly spaced values of each range
+def grid_design(ranges: Dict[str, Tuple[float, float]], levels: int,
+                config: SimConfig = SIM_CONFIG) -> List[Dict[str, float]]:
+    axes = []
+    for name, (low, high) in ranges.items():
+        values = []
+        for value in np.linspace(low, high, levels):
+            value = cast_setting(config, name, value)
+            if value not in values:
+                values.append(value)
+        axes.append(values)
+    return [dict(zip(ranges.keys(), values)) for values in itertools.product(*axes)]
+
+
+# num_points points where every range is split into num_points strata and each stratum is used exactly once
+def latin_hypercube_design(ranges: Dict[str, Tuple[float, float]], num_points: int, rng=random,
+                           config: SimConfig = SIM_CONFIG) -> List[Dict[str, float]]:
+    design = [{} for _ in range(num_points)]
+    for name, (low, high) in ranges.items():
+        strata = list(range(num_points))
+        rng.shuffle(strata)
+        for point, stratum in zip(design, strata):
+            value = low + (high - low) * (stratum + rng.random()) / num_points
+            point[name] = cast_setting(config, name, value)
+    return design
+
+
+# Simulate one design point and summarise it as a row of the results table.
+# If at least fail_fraction of the replicas run dry within the first play of the song
+# the point is considered hopeless and the remaining replicas are not simulated
+# (stopped_early is only set if that actually left some unfinished).
+def evaluate_design_point(song: MMXSong, config: SimConfig, marble_goal: int, fail_fraction: float,
+                          seeds: Sequence[int]) -> Dict[str, float]:
+    batch = BatchMMX(song, seeds, config)
+    results = batch.run(marble_goal, max_beats=song.beat_count)
+    if sum(r is not None and r.ran_dry for r in results) < fail_fraction * len(seeds):
+        results = batch.run(marble_goal)
+    stopped_early = any(r is None for r in results)
+
+    finished = [r for r in results if r is not None]
+    dry_beats = [r.beats for r in finished if r.ran_dry]
+    return {
+        "stopped_early": stopped_early,
+        "beats_simulated": batch.song_i,
+        "replicas_finished": len(finished),
+        "dry_fraction": len(dry_beats) / len(seeds),
+        "median_dry_beat": float(np.median(dry_beats)) if dry_beats else None,
+        "fishstair_overflow_fraction": float(np.mean(batch.fishstair_overflow_beat >= 0)),
+        "conveyor_overflow_fraction": float(np.mean(batch.conveyor_overflow_beat >= 0)),
+        "median_conveyor_waiting": float(np.median([r.conveyor_waiting for r in finished])) if finished else None,
+        "median_fishstair_waiting": float(np.median([r.fishstair_waiting for r in finished])) if finished else None,
+    }
+
+
+# Run every design point (in parallel) and write one row per point to results_path.
+# All points use the same replica seeds so that they are compared on the same random numbers.
+def explore(song: MMXSong, design: List[Dict[str, float]], num_replicas=EXPLORE_REPLICAS,
+            marble_goal=EXPLORE_MARBLE_GOAL, fail_fraction=EXPLORE_FAIL_FRACTION, master_seed=SWEEP_SEED,
+            results_path=EXPLORE_RESULTS_PATH, max_workers=None,
+            config: SimConfig = SIM_CONFIG) -> List[Dict[str, float]]:
+    seeds = replica_seeds(master_seed, num_replicas)
+    point_settings = [apply_design_point(config, point) for point in design]
+
+    rows = []
+    with open(results_path, "w", newline="") as f:
+        writer = None
+        # Every point is one chunk of all the seeds, as it's stopped early on all of its replicas at once
+        evaluations = run_chunked(evaluate_design_point, seeds, len(seeds),
+                                  [(song, c, marble_goal, fail_fraction) for c in point_settings], max_workers)
+        for i, evaluation in evaluations:
+            row = {"point": i, **design[i], **evaluation}
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
+            f.flush()
+            rows.append(row)
+            print("Point {0}/{1}: {2}".format(i + 1, len(design), row))
+
+    return rows
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    if EXPLORE_DESIGN == "grid":
+        design = grid_design(EXPLORE_RANGES, EXPLORE_GRID_LEVELS)
+    elif EXPLORE_DESIGN == "lhs":
+        design = latin_hypercube_design(EXPLORE_RANGES, EXPLORE_POINTS, random.Random(SWEEP_SEED))
+    else:
+        raise ValueError("Unknown design '{0}'".format(EXPLORE_DESIGN))
+
+    explore(song, design)
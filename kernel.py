@@ -0,0 +1,260 @@
+import random
+from typing import Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from mmx import MMX, run_sim
+from batch import max_draws_per_beat
+from rng import mt19937, advance
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# The run_sim() beat loop compiled with numba, on plain arrays pulled out of an MMX and written back afterwards.
+# It does exactly what MMX.simul_step() does, random draw for random draw: the draws come from a numpy MT19937
+# started from the MMX's random.Random (or UniformStream) state, which produces the same numbers, and the MMX's
+# generator is moved on by however many were used. Without numba run_sim() just uses the MMX classes.
+#
+#     python kernel.py
+#
+# checks the two give identical results (as does tests/test_kernel.py, for the compiled kernel and for the beat loop
+# as plain Python).
+
+# Slots of the int64 state array shared with the kernel
+SONG_I, NUM_PLAYED, CURSOR, NUM_SAMPLES, LAST_INCR, PLAYED_EMPTY, FISHSTAIR_OVERFLOWED, CONVEYOR_OVERFLOWED = range(8)
+
+# Why the kernel returned
+STOPPED, OUT_OF_UNIFORMS, SAMPLES_FULL = range(3)
+
+UNIFORMS_BLOCK = 1 << 16
+SAMPLES_BLOCK = 1 << 14
+
+
+def _run_beats(st, counts, max_counts, empty_fires, position_channels, channel_positions, roll_past_p, not_full,
+               reservoirs, heads, queue_lengths, queues, release_every, transport_channels, capacities, entry_points,
+               transport_accept_p, beat_offsets, beat_channels, uniforms, max_draws, stop_played, max_beats,
+               stop_on_fishstair, stop_on_conveyor, sample_stride, samples):
+    num_channels = counts.shape[0]
+    beat_count = beat_offsets.shape[0] - 1
+    beats_run = 0
+    while True:
+        if st[CURSOR] + max_draws > uniforms.shape[0]:
+            return OUT_OF_UNIFORMS
+        if sample_stride > 0 and st[NUM_SAMPLES] == samples.shape[0]:
+            return SAMPLES_FULL
+
+        cursor = st[CURSOR]
+        song_i = st[SONG_I]
+
+        # MarbleTransport.simul_step() for the return then the recycle transport, dividing each marble released
+        for t in range(2):
+            head = heads[t]
+            reservoirs[t] += queues[t, head]
+            queues[t, head] = 0
+            heads[t] = (head + 1) % queue_lengths[t]
+
+            if song_i % release_every[t] == 0:
+                for k in range(transport_channels[t]):
+                    if reservoirs[t] <= 0:
+                        break
+                    u = uniforms[cursor]
+                    cursor += 1
+                    if u > transport_accept_p[t]:
+                        continue
+                    reservoirs[t] -= 1
+
+                    # MMX.divide_marble()
+                    p = entry_points[t, k]
+                    while p < num_channels and not not_full[p]:
+                        p += 1
+                    landed = False
+                    if p < num_channels:
+                        u = uniforms[cursor]
+                        cursor += 1
+                        roll_past = 1.0
+                        while p < num_channels:
+                            if not_full[p]:
+                                roll_past *= roll_past_p[p]
+                                if roll_past <= u:
+                                    c = position_channels[p]
+                                    counts[c] += 1
+                                    if counts[c] >= max_counts[c]:
+                                        not_full[p] = False
+                                    landed = True
+                                    break
+                            p += 1
+                    if not landed:
+                        queues[1, (heads[1] - 1) % queue_lengths[1]] += 1
+
+        fishstair_overflowed = reservoirs[1] > capacities[1]
+        conveyor_overflowed = reservoirs[0] > capacities[0]
+
+        # MMX.play_notes()
+        incr = 0
+        played_empty = False
+        b = song_i % beat_count
+        for k in range(beat_offsets[b], beat_offsets[b + 1]):
+            c = beat_channels[k]
+            if counts[c] <= 0:
+                empty_fires[c] += 1
+                played_empty = True
+                continue
+            counts[c] -= 1
+            not_full[channel_positions[c]] = True
+            incr += 1
+        queues[0, (heads[0] - 1) % queue_lengths[0]] += incr
+
+        song_i += 1
+        st[SONG_I] = song_i
+        st[CURSOR] = cursor
+        beats_run += 1
+
+        # Hand the last beat back to run_sim() if it has something to do with it
+        if (played_empty or (fishstair_overflowed and stop_on_fishstair) or (conveyor_overflowed and stop_on_conveyor)
+                or st[NUM_PLAYED] + incr > stop_played or beats_run >= max_beats):
+            st[LAST_INCR] = incr
+            st[PLAYED_EMPTY] = played_empty
+            st[FISHSTAIR_OVERFLOWED] = fishstair_overflowed
+            st[CONVEYOR_OVERFLOWED] = conveyor_overflowed
+            return STOPPED
+        st[NUM_PLAYED] += incr
+
+        if sample_stride > 0 and song_i % sample_stride == 0:
+            row = st[NUM_SAMPLES]
+            samples[row, 0] = song_i
+            samples[row, 1] = st[NUM_PLAYED]
+            samples[row, 2] = counts.min()
+            samples[row, 3] = reservoirs[0]
+            samples[row, 4] = reservoirs[1]
+            st[NUM_SAMPLES] = row + 1
+
+
+if numba is not None:
+    _run_beats = numba.njit(cache=True)(_run_beats)
+
+
+# Can run_beats() take over from simul_step() for this machine?
+# (Not while its numbers are being recorded, since the kernel draws them itself.)
+def can_run(mmx: MMX) -> bool:
+    return (numba is not None and type(mmx) is MMX and hasattr(mmx.rng, "getstate") and hasattr(mmx.rng, "setstate")
+            and getattr(mmx.rng, "recording", None) is None)
+
+
+# Run mmx's beat loop in the kernel until the beat where it runs dry, overflows (only if stop_on_... is set),
+# plays num_played past stop_played or max_beats have gone by. Returns the number of marbles played before
+# that beat, and what simul_step() returned for it, for run_sim() to deal with.
+# If a recorder is passed every beat but the last is recorded with it.
+def run_beats(mmx: MMX, num_played: int, stop_played: float, max_beats=None,
+              stop_on_fishstair=True, stop_on_conveyor=True, recorder=None):
+    config = mmx.config
+    song = mmx.song
+    transports = (mmx.return_transport, mmx.recycle_transport)
+
+    st = np.zeros(8, dtype=np.int64)
+    st[SONG_I] = mmx.song_i
+    st[NUM_PLAYED] = num_played
+    counts = np.array(mmx.counts, dtype=np.int64)
+    empty_fires = np.array(mmx.empty_fires, dtype=np.int64)
+    position_channels = np.array(mmx.position_channels, dtype=np.int64)
+    channel_positions = np.argsort(position_channels)
+    not_full = np.array([bool((mmx.not_full >> p) & 1) for p in range(config.num_channels)])
+
+    queue_states = [transport.queue.__getstate__() for transport in transports]
+    queues = np.zeros((2, max(length for length, _, _ in queue_states)), dtype=np.int64)
+    for t, (length, _, data) in enumerate(queue_states):
+        queues[t, :length] = data
+    entry_points = np.zeros((2, max(len(transport.divider_entry_points) for transport in transports)), dtype=np.int64)
+    for t, transport in enumerate(transports):
+        entry_points[t, :len(transport.divider_entry_points)] = transport.divider_entry_points
+    reservoirs = np.array([transport.reservoir_waiting for transport in transports], dtype=np.int64)
+    heads = np.array([head for _, head, _ in queue_states], dtype=np.int64)
+
+    sample_stride = 0
+    samples = np.zeros((SAMPLES_BLOCK if recorder is not None else 0, 5), dtype=np.int64)
+    if recorder is not None:
+        sample_stride = 1 if recorder.decimate == "minmax" else recorder.stride
+
+    machine = (
+        st, counts, np.array(mmx.max_counts, dtype=np.int64), empty_fires, position_channels, channel_positions,
+        np.array(mmx.roll_past_p), not_full, reservoirs, heads,
+        np.array([length for length, _, _ in queue_states], dtype=np.int64), queues,
+        np.array([transport.settings.beats_per_release for transport in transports], dtype=np.int64),
+        np.array([transport.settings.num_channels for transport in transports], dtype=np.int64),
+        np.array([transport.settings.reservoir_capacity for transport in transports], dtype=np.int64),
+        entry_points, np.array([transport.settings.channel_accept_p for transport in transports]),
+        np.frombuffer(song.beat_offsets, dtype=np.uint32).astype(np.int64),
+        np.frombuffer(song.beat_channels, dtype=np.uint8).astype(np.int64),
+    )
+
+    rng_state = mmx.rng.getstate()
+    beats_left = max_beats if max_beats is not None else np.iinfo(np.int64).max
+    while True:
+        uniforms = mt19937(rng_state).random(UNIFORMS_BLOCK)
+        song_i = st[SONG_I]
+        st[CURSOR] = 0
+        reason = _run_beats(*machine, uniforms, max_draws_per_beat(config), stop_played, beats_left,
+                            stop_on_fishstair, stop_on_conveyor, sample_stride, samples)
+        rng_state = advance(rng_state, st[CURSOR])
+        beats_left -= st[SONG_I] - song_i
+
+        if recorder is not None and (reason != OUT_OF_UNIFORMS or st[NUM_SAMPLES] == len(samples)):
+            recorder.record_many(*samples[:st[NUM_SAMPLES]].T)
+            st[NUM_SAMPLES] = 0
+        if reason == STOPPED:
+            break
+
+    # Write everything back into mmx
+    mmx.song_i = int(st[SONG_I])
+    mmx.counts[:] = counts.tolist()
+    mmx.empty_fires[:] = empty_fires.tolist()
+    mmx.update_not_full()
+    for t, transport in enumerate(transports):
+        length = queue_states[t][0]
+        transport.reservoir_waiting = int(reservoirs[t])
+        transport.queue.__setstate__((length, int(heads[t]), queues[t, :length].tolist()))
+    mmx.rng.setstate(rng_state)
+
+    return int(st[NUM_PLAYED]), (int(st[LAST_INCR]), bool(st[PLAYED_EMPTY]),
+                                 bool(st[FISHSTAIR_OVERFLOWED]), bool(st[CONVEYOR_OVERFLOWED]))
+
+
+# Compare run_sim() with and without the kernel (results, and the whole machine state after a fixed number of beats)
+def check_parity(song: MMXSong, seeds: Sequence[int], marble_goal: int, config: SimConfig = SIM_CONFIG,
+                 beats: int = 5000) -> bool:
+    matches = True
+    for seed in seeds:
+        results = [
+            run_sim(song, seed=seed, marble_goal=marble_goal, do_plotting=False, config=config,
+                    checkpoint_path=None, use_kernel=use_kernel)
+            for use_kernel in (False, True)
+        ]
+        if results[0] != results[1]:
+            print("Seed {0} differs:\n\tclasses: {1}\n\tkernel:  {2}".format(seed, *results))
+            matches = False
+
+        stepped = MMX(song, random.Random(seed), config)
+        for _ in range(beats):
+            stepped.simul_step()
+        compiled = MMX(song, random.Random(seed), config)
+        while compiled.song_i < beats:
+            run_beats(compiled, 0, float("inf"), beats - compiled.song_i, False, False)
+        if (repr(stepped) != repr(compiled) or stepped.song_i != compiled.song_i or
+                stepped.empty_fires != compiled.empty_fires or stepped.not_full != compiled.not_full or
+                stepped.rng.getstate() != compiled.rng.getstate()):
+            print("Seed {0}: machine state differs after {1} beats".format(seed, beats))
+            matches = False
+    return matches
+
+
+if __name__ == "__main__":
+    if numba is None:
+        print("numba isn't installed, run_sim() will use the MMX classes")
+    else:
+        song = load_default_song()
+        if check_parity(song, range(10), 20_000):
+            print("Kernel matches the MMX classes")
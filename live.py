@@ -0,0 +1,333 @@
+import asyncio
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import time
+from typing import Dict, List, Sequence
+
+from settings import *
+from song import MMXSong, load_default_song
+from recorder import Recorder
+from rng import replica_seeds
+
+
+# Watch runs as they go: every run is simulated in its own process and streams a decimated trace (min marbles,
+# reservoir levels, marbles dropped) through one bounded queue to a small asyncio web server, which pushes it
+# to any number of browsers as server-sent events. Nothing waits on anything slower than itself: a run drops
+# samples when the queue is full, and the server drops events for a browser that isn't keeping up, so
+# watching never slows a run down.
+#
+#     python live.py
+#
+# runs LIVE_RUNS replicas of the song and serves the dashboard on http://LIVE_HOST:LIVE_PORT/.
+
+
+# Sends the rows of a run to a live feed (rather than a file), at least every flush_interval seconds.
+# Like the rows, the run's start and done events never hold the run up for long: a start that doesn't fit in the
+# feed goes before the next rows instead (which are dropped until it does), and done waits at most flush_interval.
+class LiveRecorder(Recorder):
+    def __init__(self, feed, run_id, stride=LIVE_STRIDE, decimate=TRACE_DECIMATION,
+                 flush_interval=LIVE_FLUSH_INTERVAL):
+        super().__init__(stride, decimate, chunk_size=1 << 10)
+        self.feed = feed
+        self.run_id = run_id
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.rows_dropped = 0
+        self.pending_start = None
+
+    def record(self, *values):
+        super().record(*values)
+        self.__maybe_flush()
+
+    def record_many(self, *columns):
+        super().record_many(*columns)
+        self.__maybe_flush()
+
+    def __maybe_flush(self):
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.last_flush = now
+            self.flush()
+
+    def start(self, info):
+        self.pending_start = ("start", self.run_id, info)
+        self.__send_start()
+
+    # Has the start event gone (now, or before)?
+    def __send_start(self) -> bool:
+        if self.pending_start is not None:
+            try:
+                self.feed.put_nowait(self.pending_start)
+            except queue.Full:
+                return False
+            self.pending_start = None
+        return True
+
+    def write_rows(self, rows):
+        try:
+            if not self.__send_start():
+                raise queue.Full
+            self.feed.put_nowait(("rows", self.run_id, rows.copy(), self.rows_dropped))
+        except queue.Full:
+            self.rows_dropped += len(rows)
+
+    # Returns whether the done event made it into the feed
+    def done(self, info) -> bool:
+        try:
+            if self.__send_start():
+                self.feed.put(("done", self.run_id, info), timeout=self.flush_interval)
+                return True
+        except queue.Full:
+            pass
+        return False
+
+
+def _run_live(feed, run_id, song: MMXSong, seed: int, marble_goal: int, stride: int, config: SimConfig):
+    from mmx import run_sim
+
+    recorder = LiveRecorder(feed, run_id, stride)
+    recorder.start({"seed": seed, "marble_goal": marble_goal, "song_beats": song.beat_count})
+    # Progress goes to the dashboard, not to every run printing over each other
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = run_sim(song, seed, marble_goal, do_plotting=False, config=config, checkpoint_path=None,
+                         collect_metrics=False, recorder=recorder)
+    recorder.done({
+        "ran_dry": result.ran_dry, "marbles_played": result.marbles_played, "beats": result.beats,
+        "fishstair_overflow_beat": result.fishstair_overflow_beat,
+        "conveyor_overflow_beat": result.conveyor_overflow_beat,
+    })
+
+
+# Simulate song once for every seed, each in its own process, streaming to feed (a multiprocessing queue)
+def start_runs(feed, song: MMXSong, seeds: Sequence[int], marble_goal=LONG_RUN_MARBLE_GOAL, stride=LIVE_STRIDE,
+               config: SimConfig = SIM_CONFIG) -> List[multiprocessing.Process]:
+    processes = []
+    for run_id, seed in enumerate(seeds):
+        process = multiprocessing.Process(target=_run_live, args=(feed, run_id, song, seed, marble_goal, stride, config),
+                                          daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+class LiveServer:
+    def __init__(self, feed, history=LIVE_HISTORY, client_queue_size=LIVE_CLIENT_QUEUE_SIZE):
+        self.feed = feed
+        self.client_queue_size = client_queue_size
+        self.runs: Dict[int, dict] = {}     # What a browser that connects now needs to catch up on every run
+        self.history = history
+        self.clients: List[asyncio.Queue] = []
+        self.events_dropped = 0
+
+    # Move everything from the feed to the browsers
+    async def pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.__get)
+            if message is None:
+                continue
+            kind, run_id, data = message[:3]
+            if kind == "start":
+                self.runs[run_id] = {"start": dict(data, run=run_id), "rows": collections.deque(maxlen=self.history),
+                                     "done": None}
+                self.broadcast(self.runs[run_id]["start"], "start")
+            elif kind == "rows" and run_id in self.runs:
+                event = self.__rows_event(run_id, data, message[3])
+                self.runs[run_id]["rows"].append(event)
+                self.broadcast(event, "rows")
+            elif kind == "done" and run_id in self.runs:
+                self.runs[run_id]["done"] = dict(data, run=run_id)
+                self.broadcast(self.runs[run_id]["done"], "done")
+
+    def __get(self):
+        try:
+            return self.feed.get(timeout=0.2)
+        except queue.Empty:
+            return None
+
+    @staticmethod
+    def __rows_event(run_id, rows, rows_dropped):
+        event = {"run": run_id, "rows_dropped": rows_dropped}
+        for field in rows.dtype.names:
+            event[field] = rows[field].tolist()
+        return event
+
+    @staticmethod
+    def __sse(event, kind):
+        return "event: {0}\ndata: {1}\n\n".format(kind, json.dumps(event)).encode()
+
+    def broadcast(self, event, kind):
+        data = self.__sse(event, kind)
+        for client in self.clients:
+            try:
+                client.put_nowait(data)
+            except asyncio.QueueFull:
+                self.events_dropped += 1
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers
+            path = request.split()[1].decode() if len(request.split()) > 1 else ""
+
+            if path == "/":
+                body = DASHBOARD_HTML.replace("{history}", str(self.history)).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            elif path == "/events":
+                await self.__stream(writer)
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def __stream(self, writer: asyncio.StreamWriter):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+        client = asyncio.Queue(self.client_queue_size)
+        for run in list(self.runs.values()):
+            writer.write(self.__sse(run["start"], "start"))
+            for event in run["rows"]:
+                writer.write(self.__sse(event, "rows"))
+            if run["done"] is not None:
+                writer.write(self.__sse(run["done"], "done"))
+        self.clients.append(client)
+        try:
+            while True:
+                writer.write(await client.get())
+                await writer.drain()
+        finally:
+            self.clients.remove(client)
+
+    async def serve(self, host=LIVE_HOST, port=LIVE_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        pump = asyncio.create_task(self.pump())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            pump.cancel()
+
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>MMX live</title>
+<style>
+  body { font-family: sans-serif; margin: 1em; background: #fafafa; }
+  #runs { display: grid; grid-template-columns: repeat(auto-fill, minmax(420px, 1fr)); gap: 1em; }
+  .run { background: white; border: 1px solid #ddd; padding: 0.5em; }
+  .run h3 { margin: 0 0 0.3em 0; font-size: 1em; }
+  .status { font-size: 0.85em; color: #555; margin-bottom: 0.3em; }
+  .dry { color: #c00; }
+  canvas { width: 100%; height: 260px; }
+</style>
+</head>
+<body>
+<h2>MMX live</h2>
+<div id="runs"></div>
+<script>
+const HISTORY = {history};
+const PLOTS = [
+  ["Min marbles in a channel", "min_marbles_lo", "min_marbles_hi", "#1f77b4"],
+  ["Conveyor waiting", "conveyor_waiting_lo", "conveyor_waiting_hi", "#ff7f0e"],
+  ["Fishstair waiting", "fishstair_waiting_lo", "fishstair_waiting_hi", "#2ca02c"],
+  ["Marbles dropped", "marbles_dropped", "marbles_dropped", "#9467bd"],
+];
+const runs = {};
+let dirty = false;
+
+function card(start) {
+  const div = document.createElement("div");
+  div.className = "run";
+  div.innerHTML = "<h3>Run " + start.run + " (seed " + start.seed + ")</h3><div class='status'></div><canvas></canvas>";
+  document.getElementById("runs").appendChild(div);
+  return {start: start, div: div, status: div.querySelector(".status"), canvas: div.querySelector("canvas"),
+          chunks: [], points: 0, done: null, rows_dropped: 0};
+}
+
+function draw(run) {
+  const canvas = run.canvas, ctx = canvas.getContext("2d");
+  canvas.width = canvas.clientWidth; canvas.height = canvas.clientHeight;
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  const beats = [].concat(...run.chunks.map(c => c.beat));
+  if (beats.length === 0) return;
+  const x0 = beats[0], x1 = Math.max(beats[beats.length - 1], x0 + 1);
+  const band = canvas.height / PLOTS.length;
+  PLOTS.forEach(([title, lo_field, hi_field, colour], i) => {
+    const lo = [].concat(...run.chunks.map(c => c[lo_field])), hi = [].concat(...run.chunks.map(c => c[hi_field]));
+    const y0 = Math.min(...lo), y1 = Math.max(Math.max(...hi), y0 + 1);
+    const x = b => (b - x0) / (x1 - x0) * canvas.width;
+    const y = v => i * band + band - 4 - (v - y0) / (y1 - y0) * (band - 16);
+    ctx.strokeStyle = colour; ctx.fillStyle = colour;
+    ctx.beginPath();
+    beats.forEach((b, k) => ctx.lineTo(x(b), y(hi[k])));
+    for (let k = beats.length - 1; k >= 0; k--) ctx.lineTo(x(beats[k]), y(lo[k]));
+    ctx.closePath(); ctx.globalAlpha = 0.4; ctx.fill(); ctx.globalAlpha = 1; ctx.stroke();
+    ctx.fillStyle = "#333";
+    ctx.fillText(title + "  " + lo[lo.length - 1] + "  (" + y0 + " - " + y1 + ")", 4, i * band + 11);
+  });
+}
+
+function status(run) {
+  const chunk = run.chunks[run.chunks.length - 1];
+  let text = chunk ? "beat " + chunk.beat[chunk.beat.length - 1] + ", " +
+                     chunk.marbles_dropped[chunk.marbles_dropped.length - 1] + " / " + run.start.marble_goal + " marbles"
+                   : "starting";
+  if (run.rows_dropped) text += ", " + run.rows_dropped + " samples dropped";
+  if (run.done) text = (run.done.ran_dry ? "<span class='dry'>ran dry</span>" : "never ran dry") +
+                       " after " + run.done.marbles_played + " marbles, " + run.done.beats + " beats";
+  run.status.innerHTML = text;
+}
+
+const events = new EventSource("/events");
+events.addEventListener("start", e => {
+  const start = JSON.parse(e.data);
+  if (runs[start.run]) runs[start.run].div.remove();
+  runs[start.run] = card(start);
+  dirty = true;
+});
+events.addEventListener("rows", e => {
+  const rows = JSON.parse(e.data), run = runs[rows.run];
+  if (!run) return;
+  run.chunks.push(rows); run.points += rows.beat.length; run.rows_dropped = rows.rows_dropped;
+  while (run.chunks.length > HISTORY) run.chunks.shift();
+  run.dirty = dirty = true;
+});
+events.addEventListener("done", e => {
+  const done = JSON.parse(e.data);
+  if (runs[done.run]) { runs[done.run].done = done; runs[done.run].dirty = dirty = true; }
+});
+
+function frame() {
+  if (dirty) {
+    dirty = false;
+    Object.values(runs).forEach(run => { status(run); if (run.dirty) { run.dirty = false; draw(run); } });
+  }
+  setTimeout(() => requestAnimationFrame(frame), 250);
+}
+frame();
+</script>
+</body>
+</html>
+"""
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    feed = multiprocessing.Queue(LIVE_QUEUE_SIZE)
+    start_runs(feed, song, replica_seeds(SWEEP_SEED, LIVE_RUNS))
+    print("Dashboard on http://{0}:{1}/ (Ctrl+C to stop)".format(LIVE_HOST, LIVE_PORT))
+    try:
+        asyncio.run(LiveServer(feed).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,149 @@
+import os
+import random
+import time
+from typing import List
+
+from settings import *
+from mmx import MMX
+
+
+# Counters for what goes on inside MMX.simul_step(). They're only collected by InstrumentedMMX,
+# so a plain MMX runs at full speed.
+class SimMetrics:
+    PHASES = ("transport", "divide", "play")
+
+    def __init__(self, num_channels: int):
+        self.beats = 0                                  # Beats simul_step()ed
+        self.fast_forwarded_beats = 0                   # Beats skipped by fast_forward() (not in the counters below)
+        self.marbles_divided = 0                        # Marbles released onto the divider
+        self.marbles_recycled = 0                       # ... that fell off the end
+        self.marbles_accepted: List[int] = [0] * num_channels
+        self.channels_rolled_past = 0                   # Total divider channels marbles went past (including the one they landed in)
+        self.longest_roll = 0
+        self.conveyor_high_water = 0                    # Most marbles ever waiting in each reservoir
+        self.fishstair_high_water = 0
+        self.empty_fires: List[int] = [0] * num_channels  # Kept up to date by MMX itself (see MMX.empty_fires)
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+
+    @property
+    def recycle_rate(self) -> float:
+        return self.marbles_recycled / self.marbles_divided if self.marbles_divided else 0.0
+
+    @property
+    def mean_roll(self) -> float:
+        return self.channels_rolled_past / self.marbles_divided if self.marbles_divided else 0.0
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP mmx_{0} {1}".format(name, help_text))
+            lines.append("# TYPE mmx_{0} {1}".format(name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{0}="{1}"'.format(k, v) for k, v in labels.items())
+                lines.append("mmx_{0}{1} {2}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+        metric("beats_total", "counter", "Beats simulated one at a time.", [({}, self.beats)])
+        metric("fast_forwarded_beats_total", "counter", "Beats skipped by fast-forwarding.",
+               [({}, self.fast_forwarded_beats)])
+        metric("marbles_divided_total", "counter", "Marbles released onto the divider.", [({}, self.marbles_divided)])
+        metric("marbles_recycled_total", "counter", "Marbles that fell off the end of the divider.",
+               [({}, self.marbles_recycled)])
+        metric("recycle_rate", "gauge", "Fraction of divided marbles that were recycled.", [({}, self.recycle_rate)])
+        metric("marbles_accepted_total", "counter", "Marbles each channel accepted from the divider.",
+               [({"channel": c + 1}, n) for c, n in enumerate(self.marbles_accepted)])
+        metric("divider_mean_roll", "gauge", "Mean number of divider channels a marble rolls past.",
+               [({}, self.mean_roll)])
+        metric("divider_longest_roll", "gauge", "Most divider channels a marble has rolled past.",
+               [({}, self.longest_roll)])
+        metric("reservoir_high_water", "gauge", "Most marbles ever waiting in a reservoir.",
+               [({"transport": "conveyor"}, self.conveyor_high_water),
+                ({"transport": "fishstair"}, self.fishstair_high_water)])
+        metric("empty_fires_total", "counter", "Times each channel fired while empty.",
+               [({"channel": c + 1}, n) for c, n in enumerate(self.empty_fires) if n])
+        metric("phase_seconds_total", "counter", "Wall time spent in each phase of a beat.",
+               [({"phase": phase}, seconds) for phase, seconds in self.phase_seconds.items()])
+        return "\n".join(lines) + "\n"
+
+    # Written to a temporary file first so whatever reads it never sees half a file
+    def export(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+
+
+# An MMX that fills in a SimMetrics as it goes (with exactly the same outcome as a plain MMX)
+class InstrumentedMMX(MMX):
+    def __init__(self, song, rng=random, config: SimConfig = SIM_CONFIG):
+        super().__init__(song, rng, config)
+        self.metrics = SimMetrics(self.config.num_channels)
+        self.metrics.empty_fires = self.empty_fires
+
+    # Start collecting metrics on an existing machine (e.g. one loaded from a snapshot)
+    @classmethod
+    def instrument(cls, mmx: MMX):
+        if isinstance(mmx, cls):
+            return mmx
+        instrumented = cls.__new__(cls)
+        instrumented.__dict__.update(mmx.__dict__)
+        instrumented.metrics = SimMetrics(instrumented.config.num_channels)
+        instrumented.metrics.empty_fires = instrumented.empty_fires
+        return instrumented
+
+    def divide_marble(self, start: int):
+        start_time = time.perf_counter()
+        p = super().divide_marble(start)
+        self.metrics.phase_seconds["divide"] += time.perf_counter() - start_time
+
+        self.metrics.marbles_divided += 1
+        if p is None:
+            self.metrics.marbles_recycled += 1
+            rolled_past = self.config.num_channels - start
+        else:
+            self.metrics.marbles_accepted[self.position_channels[p]] += 1
+            rolled_past = p - start + 1
+        self.metrics.channels_rolled_past += rolled_past
+        if rolled_past > self.metrics.longest_roll:
+            self.metrics.longest_roll = rolled_past
+        return p
+
+    def fast_forward(self, max_beats=None):
+        beats = super().fast_forward(max_beats)
+        self.metrics.fast_forwarded_beats += beats
+        return beats
+
+    def simul_step(self):
+        metrics = self.metrics
+        phase_seconds = metrics.phase_seconds
+
+        start_time = time.perf_counter()
+        divide_seconds = phase_seconds["divide"]
+        self.release_marbles()
+        release_time = time.perf_counter()
+        phase_seconds["transport"] += release_time - start_time - (phase_seconds["divide"] - divide_seconds)
+
+        result = self.play_notes()
+        phase_seconds["play"] += time.perf_counter() - release_time
+
+        metrics.beats += 1
+        metrics.conveyor_high_water = max(metrics.conveyor_high_water, self.return_transport.reservoir_waiting)
+        metrics.fishstair_high_water = max(metrics.fishstair_high_water, self.recycle_transport.reservoir_waiting)
+        return result
+
+
+# Writes metrics to a Prometheus text file (for node_exporter's textfile collector or similar)
+# at most once every interval seconds
+class PrometheusExporter:
+    def __init__(self, path, interval: float = METRICS_EXPORT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.last_export = None
+
+    def maybe_export(self, metrics: SimMetrics):
+        now = time.monotonic()
+        if self.last_export is None or now - self.last_export >= self.interval:
+            self.export(metrics)
+
+    def export(self, metrics: SimMetrics):
+        metrics.export(self.path)
+        self.last_export = time.monotonic()
@@ -1,23 +1,42 @@
-from dataclasses import dataclass
 import random
 import math
-from typing import List, Tuple, Dict
+import signal
+import threading
+from typing import List, Tuple, Dict, NamedTuple, Optional
 
 from settings import *
-from song import MMXSong
+from song import MMXSong, load_default_song
 from utils import *
 
-if DO_PLOTTING:
-    import matplotlib.pyplot as plt
 
-
-# A single channel of the MMX
-@dataclass
+# A single channel of the MMX, as a view onto the MMX's channel arrays (for code that doesn't care about speed)
 class Channel:
-    index: int
-    marble_accept_p: float
-    count: int = MAX_MARBLES_PER_CHANNEL
-    max_count: int = MAX_MARBLES_PER_CHANNEL
+    __slots__ = ("mmx", "index")
+
+    def __init__(self, mmx, index: int):
+        self.mmx = mmx
+        self.index = index
+
+    @property
+    def count(self) -> int:
+        return self.mmx.counts[self.index]
+
+    @count.setter
+    def count(self, value: int):
+        self.mmx.counts[self.index] = value
+        self.mmx.update_not_full()
+
+    @property
+    def max_count(self) -> int:
+        return self.mmx.max_counts[self.index]
+
+    @property
+    def marble_accept_p(self) -> float:
+        return self.mmx.marble_accept_p[self.index]
+
+    def __repr__(self):
+        return "Channel(index={0}, marble_accept_p={1}, count={2}, max_count={3})".format(
+            self.index, self.marble_accept_p, self.count, self.max_count)
 
 
 # 'Circular Queue'-like object representing the marbles on their journey to the end of the Marble Transport
@@ -35,43 +54,117 @@ class TransportQueue:
 
     def add_to_tail(self, count):
         self.__data[(self.__head - 1) % self.__length] += count
+
+    # pop() n times in one go, returning the total
+    def advance(self, n):
+        if n >= self.__length:
+            total = sum(self.__data)
+            self.__data = [0] * self.__length
+        else:
+            end = self.__head + n
+            total = sum(self.__data[self.__head:end]) + sum(self.__data[:max(end - self.__length, 0)])
+            self.__data[self.__head:end] = [0] * (min(end, self.__length) - self.__head)
+            self.__data[:max(end - self.__length, 0)] = [0] * max(end - self.__length, 0)
+        self.__head = (self.__head + n) % self.__length
+        return total
+
+    # How many pop()s will return 0 before marbles come out, or None if the queue is empty
+    def beats_until_arrival(self):
+        for i, count in enumerate(self):
+            if count:
+                return i
+        return None
     
     def __iter__(self):
         return iter(self.__data[self.__head:] + self.__data[:self.__head])
 
+    def __getstate__(self):
+        return self.__length, self.__head, self.__data
+
+    def __setstate__(self, state):
+        self.__length, self.__head, self.__data = state
+
+
+# Which divider channel each channel of a transport puts its marbles onto
+def divider_entry_points(t_settings: MarbleTransportSettings) -> List[int]:
+    return [
+        int(t_settings.divider_entry_start +
+            (t_settings.divider_entry_end-t_settings.divider_entry_start)*(i/(t_settings.num_channels-1)))
+        for i in range(t_settings.num_channels)
+    ]
+
+
+# The channels a marble entering the divider at start rolls past, in order
+def divider_path(start: int, config: SimConfig = SIM_CONFIG) -> List[int]:
+    if not config.reverse_divider:
+        return list(range(start, config.num_channels))
+    return list(range(config.num_channels - start - 1, -1, -1))
+
 
 # Marble return or recycle (i.e. fishstair or conveyor)
 class MarbleTransport:
-    def __init__(self, t_settings: MarbleTransportSettings):
+    def __init__(self, t_settings: MarbleTransportSettings, rng=random):
         self.settings: MarbleTransportSettings = t_settings
+        self.rng = rng
         self.reservoir_waiting: int = self.settings.reservoir_initial
         self.queue: TransportQueue = TransportQueue(self.settings.beats_to_transport)
 
-        self.divider_entry_points = [
-            int(self.settings.divider_entry_start +
-                (self.settings.divider_entry_end-self.settings.divider_entry_start)*(i/(self.settings.num_channels-1)))
-            for i in range(self.settings.num_channels)
-        ]
+        self.divider_entry_points = divider_entry_points(self.settings)
 
     def simul_step(self, song_i):
         self.reservoir_waiting += self.queue.pop()
 
         if (song_i % self.settings.beats_per_release) == 0:
+            rand = self.rng.random
+            channel_accept_p = self.settings.channel_accept_p
             for c in range(self.settings.num_channels):
                 if self.reservoir_waiting <= 0:
                     break
 
-                if bernoulli(self.settings.channel_accept_p):
+                if rand() <= channel_accept_p:  # bernoulli(), without the calls in between
                     self.reservoir_waiting -= 1
                     yield self.divider_entry_points[c]
 
     def add_marbles(self, n):
         self.queue.add_to_tail(n)
 
+    # simul_step() for when every divider channel is full, so whatever is released just goes round again.
+    # Makes the same random draws as simul_step(), but returns how many marbles were released instead of
+    # yielding where each one enters the divider.
+    def simul_step_saturated(self, song_i):
+        self.reservoir_waiting += self.queue.pop()
+
+        released = 0
+        if (song_i % self.settings.beats_per_release) == 0:
+            rand = self.rng.random
+            channel_accept_p = self.settings.channel_accept_p
+            for c in range(self.settings.num_channels):
+                if self.reservoir_waiting <= 0:
+                    break
+
+                if rand() <= channel_accept_p:  # bernoulli(), without the calls in between
+                    self.reservoir_waiting -= 1
+                    released += 1
+        return released
+
+    # simul_step() for n beats where no marbles are released (only valid if the reservoir is empty and
+    # stays that way, i.e. nothing comes off the queue in that time)
+    def skip_beats(self, n):
+        self.reservoir_waiting += self.queue.advance(n)
+
     @property
     def overflowed(self) -> bool:
         return self.reservoir_waiting > self.settings.reservoir_capacity
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["rng"] = rng_to_state(self.rng)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = rng_from_state(state["rng"])
+
     def __repr__(self):
         return "MarbleTransport [\n\tWaiting: {0}\n\tQueue: [{1}]\n]".format(
             self.reservoir_waiting,
@@ -80,51 +173,145 @@ class MarbleTransport:
 
 # The actual MMX
 class MMX:
-    def __init__(self, song):
-        self.channels: List[Channel] = [Channel(i, randf(
-            CHANNEL_ACCEPT_PROB_MIN, CHANNEL_ACCEPT_PROB_MAX)) for i in range(NUM_CHANNELS)]
+    # rng is anything with a random() method (the random module, a random.Random, an rng.UniformStream, ...)
+    def __init__(self, song, rng=random, config: SimConfig = SIM_CONFIG):
+        self.rng = rng
+        self.config: SimConfig = config
+
+        # State of each channel as flat vectors indexed by channel (see Channel for a view of one channel).
+        # Plain lists rather than array.array, as indexing them is faster in the hot loop.
+        self.marble_accept_p: List[float] = [
+            randf(self.config.channel_accept_prob_min, self.config.channel_accept_prob_max, rng)
+            for _ in range(self.config.num_channels)
+        ]
+        self.max_counts: List[int] = list(self.config.max_counts)
+        self.counts: List[int] = list(self.max_counts)
+        self.empty_fires: List[int] = [0] * self.config.num_channels  # How many times each channel fired while empty
         
-        self.return_transport = MarbleTransport(MARBLE_RETURN_SETTINGS)
-        self.recycle_transport = MarbleTransport(MARBLE_RECYCLE_SETTINGS)
+        self.return_transport = MarbleTransport(self.config.return_settings, rng)
+        self.recycle_transport = MarbleTransport(self.config.recycle_settings, rng)
+
+        # The divider is worked with in terms of positions along it: a marble entering at start rolls past
+        # positions start, start+1, ... (position p is channel p, or channel num_channels-1-p if reversed)
+        self.position_channels: List[int] = divider_path(0, self.config)
+        self.roll_past_p: List[float] = [1 - self.marble_accept_p[c] for c in self.position_channels]
+        self.channel_bits: List[int] = [0] * self.config.num_channels
+        for p, c in enumerate(self.position_channels):
+            self.channel_bits[c] = 1 << p
+        self.update_not_full()
 
         self.song = song
         self.song_i = 0
 
+    @property
+    def channels(self) -> List[Channel]:
+        return [Channel(self, c) for c in range(self.config.num_channels)]
+
+    # Bit p of not_full is set if the channel at divider position p has room for another marble.
+    # Kept up to date by divide_marble() and simul_step(), call this after changing counts directly.
+    def update_not_full(self):
+        self.not_full = 0
+        for p, c in enumerate(self.position_channels):
+            if self.counts[c] < self.max_counts[c]:
+                self.not_full |= 1 << p
+
+    # A marble rolls past every channel from start onwards and falls into the first one that accepts it.
+    # Full channels are skipped using not_full, and instead of a draw per channel a single draw u picks the
+    # landing channel: the marble lands at the first channel where P(rolling past everything so far) <= u,
+    # which gives each channel exactly the same chance as trying them one at a time.
+    # Returns the divider position the marble landed at, or None if it was recycled.
     def divide_marble(self, start: int):
-        loop = None
-        if not REVERSE_DIVIDER:
-            loop = range(start, NUM_CHANNELS)
-        else:
-            loop = range(NUM_CHANNELS - start - 1, -1, -1)
-        
-        for c in loop:
-            if self.channels[c].count >= self.channels[c].max_count:
-                continue
-            if bernoulli(self.channels[c].marble_accept_p):
-                self.channels[c].count += 1
-                break
-        else:
-            self.recycle_transport.add_marbles(1)
+        candidates = (self.not_full >> start) << start
+        if candidates:
+            u = self.rng.random()
+            roll_past = 1.0
+            while candidates:
+                lowest = candidates & -candidates
+                p = lowest.bit_length() - 1
+                roll_past *= self.roll_past_p[p]
+                if roll_past <= u:
+                    c = self.position_channels[p]
+                    self.counts[c] += 1
+                    if self.counts[c] >= self.max_counts[c]:
+                        self.not_full ^= lowest
+                    return p
+                candidates ^= lowest
+        self.recycle_transport.add_marbles(1)
+        return None
+
+    # Get through beats where no notes are played faster than simul_step(), with exactly the same outcome
+    # (including which random numbers are drawn). Returns how many beats were fast-forwarded.
+    #  - If both reservoirs are empty and no marbles come off either queue nothing happens at all,
+    #    so those beats are skipped in one go.
+    #  - If every channel is full, released marbles can only be recycled, so only the transports are stepped
+    #    (as long as neither reservoir could overflow in that time, as run_sim() wants to know when that happens).
+    def fast_forward(self, max_beats=None):
+        beats = self.song.idle_beats[self.song_i % self.song.beat_count]
+        if max_beats is not None:
+            beats = min(beats, max_beats)
+        if beats == 0:
+            return 0
+
+        if self.return_transport.reservoir_waiting <= 0 and self.recycle_transport.reservoir_waiting <= 0:
+            for transport in (self.return_transport, self.recycle_transport):
+                arrival = transport.queue.beats_until_arrival()
+                if arrival is not None:
+                    beats = min(beats, arrival)
+            if beats == 0:
+                return 0
+
+            self.return_transport.skip_beats(beats)
+            self.recycle_transport.skip_beats(beats)
+            self.song_i += beats
+            return beats
+
+        if self.not_full:
+            return 0
+        return_total = self.return_transport.reservoir_waiting + sum(self.return_transport.queue)
+        recycle_total = self.recycle_transport.reservoir_waiting + sum(self.recycle_transport.queue)
+        if (return_total > self.return_transport.settings.reservoir_capacity or
+                return_total + recycle_total > self.recycle_transport.settings.reservoir_capacity):
+            return 0
+
+        for _ in range(beats):
+            self.recycle_transport.add_marbles(self.return_transport.simul_step_saturated(self.song_i))
+            self.recycle_transport.add_marbles(self.recycle_transport.simul_step_saturated(self.song_i))
+            self.song_i += 1
+        return beats
+
+    # Draw random numbers from rng from now on (e.g. to send copies of one machine down different paths)
+    def set_rng(self, rng):
+        self.rng = rng
+        self.return_transport.rng = rng
+        self.recycle_transport.rng = rng
 
     def simul_step(self):
-        # Return and recycle transports are simul_step()ed and we divide their marbles
+        self.release_marbles()
+        return self.play_notes()
+
+    # Return and recycle transports are simul_step()ed and we divide their marbles
+    def release_marbles(self):
         for marble_start in self.return_transport.simul_step(self.song_i):
             self.divide_marble(marble_start)
         for marble_start in self.recycle_transport.simul_step(self.song_i):
             self.divide_marble(marble_start)
 
-        # Play Notes
+    # Play the notes on this beat and move on to the next one
+    def play_notes(self):
         num_played = 0
         played_empty = False
         fishstair_overflowed = self.recycle_transport.overflowed
         conveyor_overflowed = self.return_transport.overflowed
 
-        for c in self.song.notes_on_beat(self.song_i):
-            if self.channels[c].count <= 0:
-                print("Fired an empty channel")
+        counts = self.counts
+        song_i = self.song_i % self.song.beat_count
+        for c in self.song.beat_channels[self.song.beat_offsets[song_i]:self.song.beat_offsets[song_i+1]]:
+            if counts[c] <= 0:
+                self.empty_fires[c] += 1
                 played_empty = True
                 continue
-            self.channels[c].count -= 1
+            counts[c] -= 1
+            self.not_full |= self.channel_bits[c]
             num_played += 1
         
         self.return_transport.add_marbles(num_played)
@@ -133,91 +320,240 @@ class MMX:
 
         return num_played, played_empty, fishstair_overflowed, conveyor_overflowed
 
+    # Everything needed to carry on exactly where this machine left off, see snapshot.py
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["rng"] = rng_to_state(self.rng)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = rng_from_state(state["rng"])
+
     def __repr__(self):
         return "MMX [\n\tChannels: [{0}], \n\tReturn: {1}, \n\tRecycle: {2}, \n]".format(
-            ", ".join(str(channel.count) for channel in self.channels),
+            ", ".join(map(str, self.counts)),
             repr(self.return_transport).replace("\n", "\n\t"),
             repr(self.recycle_transport).replace("\n", "\n\t"),
         )
 
 
-def run_sim():
-    song = None
-    if SONG_PATH == None:
-        song = MMXSong.make_random()
+# What happened to a single machine over a run_sim() call
+class SimResult(NamedTuple):
+    ran_dry: bool
+    marbles_played: int
+    beats: int
+    fishstair_overflow_beat: Optional[int]  # None if it never overflowed
+    conveyor_overflow_beat: Optional[int]
+    conveyor_waiting: int                   # Reservoir levels at the end of the run
+    fishstair_waiting: int
+    metrics: Optional["SimMetrics"] = None  # Only if collect_metrics was set
+
+
+# Every run is seeded (with a new seed, which is printed, if seed is None) so it can be repeated, random song and all,
+# or give it an rng to draw from instead (e.g. an rng.ReplayStream of the numbers a run saved to record_draws_path,
+# with the run's seed if it played a random song).
+# The state of the run is saved to checkpoint_path every checkpoint_interval beats and when it's interrupted,
+# and with resume=True the run carries on from there instead (song, seed and config then come from the checkpoint).
+# With collect_metrics the run is instrumented (see metrics.py) and the counts written to metrics_path as it goes.
+# With use_kernel the beats are run by kernel.py if it can (i.e. numba is installed).
+# Passing a recorder (see recorder.py) streams the run to it instead of plotting it (e.g. to live.py's dashboard).
+def run_sim(song=None, seed=SEED, marble_goal=LONG_RUN_MARBLE_GOAL, do_plotting=DO_PLOTTING,
+            config: SimConfig = SIM_CONFIG, fast_forward=FAST_FORWARD,
+            checkpoint_path=CHECKPOINT_PATH, checkpoint_interval=CHECKPOINT_INTERVAL, resume=RESUME_FROM_CHECKPOINT,
+            collect_metrics=COLLECT_METRICS, metrics_path=METRICS_PATH, use_kernel=USE_KERNEL, recorder=None,
+            rng=None, record_draws_path=RECORD_DRAWS_PATH):
+    if resume and checkpoint_path is None:
+        raise ValueError("Can't resume a run without a checkpoint_path to resume from")
+    if checkpoint_path is not None:
+        import snapshot
+
+    if resume:
+        mmx, run_state = snapshot.load(checkpoint_path)
+        song = mmx.song
+        num_played = run_state["num_played"]
+        conveyor_overflow_beat = run_state["conveyor_overflow_beat"]
+        fishstair_overflow_beat = run_state["fishstair_overflow_beat"]
+        last_report = run_state["last_report"]
+        print(song)
+        print("Resuming from {0} after {1} marbles dropped, {2} crank turns, or {3:.2f} plays of the song".format(
+            checkpoint_path, num_played, mmx.song_i, mmx.song_i / song.beat_count))
     else:
-        song = MMXSong.from_file(SONG_PATH)
+        if rng is None:
+            from rng import UniformStream
 
-    print(song)
+            rng = UniformStream(seed, record=record_draws_path is not None)
+        if song is None:
+            if CONCERT_PATH is not None:
+                from concert import Concert
 
-    #with open("song.txt", "w") as f:
-    #    f.write(repr(song))
+                song = Concert.from_directory(CONCERT_PATH, CONCERT_GAP_BEATS, config)
+            else:
+                song = load_default_song(config, getattr(rng, "seed", seed))
+
+        print(song)
+
+        #with open("song.txt", "w") as f:
+        #    f.write(repr(song))
+
+        if hasattr(rng, "seed"):
+            print("Seed: {0}".format(rng.seed))
+        mmx = MMX(song, rng, config)
+        num_played = 0
+
+        conveyor_overflow_beat = None
+        fishstair_overflow_beat = None
+
+        last_report = 0
 
-    mmx = MMX(song)
-    num_played = 0
     ran_dry = False
 
-    conveyor_overflow_already = False
-    fishstair_overflow_already = False
+    exporter = None
+    if collect_metrics:
+        from metrics import InstrumentedMMX, PrometheusExporter
+
+        mmx = InstrumentedMMX.instrument(mmx)
+        if metrics_path is not None:
+            exporter = PrometheusExporter(metrics_path)
 
-    last_report = 0
+    if use_kernel:
+        import kernel
 
-    if DO_PLOTTING:
-        marbles_dropped_list = []
-        min_marbles_list = []
-        conveyor_waiting_list = []
-        fishstair_waiting_list = []
+        use_kernel = kernel.can_run(mmx)
 
-        fig, (min_marbles_ax, conveyor_ax, fishstair_ax,
-              marble_ax) = plt.subplots(4, sharex=True)
-        min_marbles_ax.set_title('Min marbles in a channel')
-        conveyor_ax.set_title('Conveyor waiting')
-        fishstair_ax.set_title('Fishstair waiting')
-        marble_ax.set_title('Marbles Dropped')
+    def save_checkpoint():
+        snapshot.save(checkpoint_path, mmx, num_played=num_played, conveyor_overflow_beat=conveyor_overflow_beat,
+                      fishstair_overflow_beat=fishstair_overflow_beat, last_report=last_report)
+    next_checkpoint = mmx.song_i + checkpoint_interval
+
+    # Ctrl+C only stops the run between beats, so the checkpoint it saves is consistent
+    interrupted = False
+    def on_interrupt(signum, frame):
+        nonlocal interrupted
+        interrupted = True
+    catch_interrupts = checkpoint_path is not None and threading.current_thread() is threading.main_thread()
+    if catch_interrupts:
+        previous_handler = signal.signal(signal.SIGINT, on_interrupt)
+
+    do_plotting = do_plotting and recorder is None
+    if do_plotting:
+        from recorder import TraceRecorder, plot_trace
+
+        recorder = TraceRecorder(TRACE_PATH, TRACE_STRIDE, TRACE_DECIMATION)
 
     print()
 
-    while num_played <= LONG_RUN_MARBLE_GOAL:
-        num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed = mmx.simul_step()
+    while num_played <= marble_goal:
+        if checkpoint_path is not None and (mmx.song_i >= next_checkpoint or interrupted):
+            save_checkpoint()
+            next_checkpoint = mmx.song_i + checkpoint_interval
+            if interrupted:
+                signal.signal(signal.SIGINT, previous_handler)
+                print("Interrupted, saved the run to {0}".format(checkpoint_path))
+                raise KeyboardInterrupt
+        if use_kernel:
+            num_played, (num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed) = kernel.run_beats(
+                mmx, num_played, min(marble_goal, last_report + marble_goal/REPORT_COUNT),
+                next_checkpoint - mmx.song_i if checkpoint_path is not None else None,
+                fishstair_overflow_beat is None, conveyor_overflow_beat is None, recorder)
+        else:
+            if fast_forward:
+                mmx.fast_forward()
+            num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed = mmx.simul_step()
         if played_empty:
             print("Ran dry after {0} marbles dropped, {1} crank turns, or {2:.2f} plays of the song".format(
                 num_played, mmx.song_i, mmx.song_i / song.beat_count))
             ran_dry = True
             break
-        if fishstair_overflowed and not fishstair_overflow_already:
-            fishstair_overflow_already = True
+        if fishstair_overflowed and fishstair_overflow_beat is None:
+            fishstair_overflow_beat = mmx.song_i
             print("Fishstair overflowed after {0} marbles dropped, {1} crank turns, or {2:.2f} plays of the song".format(
                 num_played, mmx.song_i, mmx.song_i / song.beat_count))
-        if conveyor_overflowed and not conveyor_overflow_already:
-            conveyor_overflow_already = True
+        if conveyor_overflowed and conveyor_overflow_beat is None:
+            conveyor_overflow_beat = mmx.song_i
             print("Conveyor overflowed after {0} marbles dropped, {1} crank turns, or {2:.2f} plays of the song".format(
                 num_played, mmx.song_i, mmx.song_i / song.beat_count))
         num_played += num_played_incr
 
-        if DO_PLOTTING:
-            marbles_dropped_list.append(num_played)
-            min_marbles_list.append(min(c.count for c in mmx.channels))
-            conveyor_waiting_list.append(mmx.return_transport.reservoir_waiting)
-            fishstair_waiting_list.append(mmx.recycle_transport.reservoir_waiting)
+        if recorder is not None and recorder.due(mmx.song_i):
+            recorder.record(mmx.song_i, num_played, min(mmx.counts),
+                            mmx.return_transport.reservoir_waiting, mmx.recycle_transport.reservoir_waiting)
 
-        if num_played > (last_report + (LONG_RUN_MARBLE_GOAL/REPORT_COUNT)):
-            last_report += LONG_RUN_MARBLE_GOAL/REPORT_COUNT
+        if exporter is not None:
+            exporter.maybe_export(mmx.metrics)
+
+        if num_played > (last_report + (marble_goal/REPORT_COUNT)):
+            last_report += marble_goal/REPORT_COUNT
             print("Played {0} marbles, {1} crank turns, or {2:.2f} plays of the song".format(
                 num_played, mmx.song_i, mmx.song_i / song.beat_count))
 
+    if catch_interrupts:
+        signal.signal(signal.SIGINT, previous_handler)
+    if checkpoint_path is not None and not ran_dry:
+        save_checkpoint()
+
     if not ran_dry:
         print("Never ran dry")
     print()
     print(repr(mmx))
 
-    if DO_PLOTTING:
-        min_marbles_ax.plot(range(len(marbles_dropped_list)), min_marbles_list)
-        conveyor_ax.plot(range(len(marbles_dropped_list)),
-                         conveyor_waiting_list)
-        fishstair_ax.plot(range(len(marbles_dropped_list)),
-                          fishstair_waiting_list)
-        marble_ax.plot(range(len(marbles_dropped_list)), marbles_dropped_list)
-        plt.show()
+    if exporter is not None:
+        exporter.export(mmx.metrics)
+
+    if record_draws_path is not None and getattr(mmx.rng, "recording", None) is not None:
+        mmx.rng.save_draws(record_draws_path)
+        print("Saved the {0} random numbers drawn to {1}".format(len(mmx.rng.draws()), record_draws_path))
+
+    if recorder is not None:
+        recorder.close()
+    if do_plotting:
+        plot_trace(TRACE_PATH)
+
+    return SimResult(
+        ran_dry, num_played, mmx.song_i,
+        fishstair_overflow_beat, conveyor_overflow_beat,
+        mmx.return_transport.reservoir_waiting, mmx.recycle_transport.reservoir_waiting,
+        mmx.metrics if collect_metrics else None
+    )
+
+# run_sim(song, seed=seed) without the printing, plotting, checkpoints or metrics, for running many replicas one
+# at a time (for chunks too small for the batch engine to be worth it, or when the kernel is there to run them)
+def run_replica(song: MMXSong, seed: int, marble_goal=LONG_RUN_MARBLE_GOAL, config: SimConfig = SIM_CONFIG,
+                fast_forward=FAST_FORWARD, use_kernel=USE_KERNEL) -> SimResult:
+    from rng import UniformStream
+
+    mmx = MMX(song, UniformStream(seed), config)
+    if use_kernel:
+        import kernel
+
+        use_kernel = kernel.can_run(mmx)
+
+    num_played = 0
+    ran_dry = False
+    fishstair_overflow_beat = None
+    conveyor_overflow_beat = None
+    while num_played <= marble_goal:
+        if use_kernel:
+            num_played, (num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed) = kernel.run_beats(
+                mmx, num_played, marble_goal, None, fishstair_overflow_beat is None, conveyor_overflow_beat is None)
+        else:
+            if fast_forward:
+                mmx.fast_forward()
+            num_played_incr, played_empty, fishstair_overflowed, conveyor_overflowed = mmx.simul_step()
+        if played_empty:
+            ran_dry = True
+            break
+        if fishstair_overflowed and fishstair_overflow_beat is None:
+            fishstair_overflow_beat = mmx.song_i
+        if conveyor_overflowed and conveyor_overflow_beat is None:
+            conveyor_overflow_beat = mmx.song_i
+        num_played += num_played_incr
+
+    return SimResult(
+        ran_dry, num_played, mmx.song_i,
+        fishstair_overflow_beat, conveyor_overflow_beat,
+        mmx.return_transport.reservoir_waiting, mmx.recycle_transport.reservoir_waiting
+    )
 
 if __name__ == "__main__":
     run_sim()
@@ -0,0 +1,169 @@
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from batch import BatchMMX
+from rng import replica_seeds
+
+
+# Search for a wheel that plays the same song but runs dry less often, by simulated annealing over two kinds of move:
+#   - swap the parts of two channel pairs in the same mute group (which moves them along the divider)
+#   - move one note to the other channel of its pair, if that channel can still play it
+#     (i.e. its notes stay at least MIN_DISTANCE_BETWEEN_NOTES apart, see playable())
+# Pairs are only swapped within their mute group since which channels a song section mutes is fixed by MUTE_GROUPS.
+# Every wheel is scored on the same replica seeds (see wheel_fitness()) and scores are cached by wheel,
+# and each step scores OPTIMIZE_CANDIDATES neighbours in parallel and moves to the best of them (or not, by the
+# usual Metropolis rule). The best wheels found are then measured again on fresh seeds, since the ones that
+# looked best on the search seeds were partly just lucky with them.
+
+
+class WheelFitness(NamedTuple):
+    cost: float             # Mean fraction of the OPTIMIZE_PLAYS plays of the song lost to running dry (0 is never dry)
+    dry_fraction: float     # Fraction of replicas that ran dry
+    replicas: int
+
+
+class RankedWheel(NamedTuple):
+    wheel: np.ndarray       # (channels, beats per wheel)
+    search: WheelFitness    # Measured on the search seeds
+    validation: WheelFitness  # ... and on fresh ones
+
+
+# Can every channel of wheel (a row of it, or all of them) play its notes at least min_distance_between_notes
+# points apart at song writing resolution? Placing every note as early as it can go finds a way if there is one.
+def playable(wheel, config: SimConfig = SIM_CONFIG) -> bool:
+    resolution = config.random_song_writing_resolution
+    for row in np.atleast_2d(wheel):
+        last = -config.min_distance_between_notes
+        for beat in np.flatnonzero(row):
+            for _ in range(row[beat]):
+                last = max(beat * resolution, last + config.min_distance_between_notes)
+                if last >= (beat + 1) * resolution:
+                    return False
+    return True
+
+
+# For every mute group, the channel pairs whose channels are both in it (by the pair's first channel)
+def swappable_pairs(config: SimConfig = SIM_CONFIG) -> List[List[int]]:
+    groups = []
+    for mute_group in config.mute_groups:
+        in_group = [(mute_group >> (config.num_channels - 1 - c)) & 1 for c in range(config.num_channels)]
+        pairs = [c for c in range(0, config.num_channels - 1, 2) if in_group[c] and in_group[c + 1]]
+        if len(pairs) >= 2:
+            groups.append(pairs)
+    return groups
+
+
+# A random wheel one move away from wheel (or wheel itself if no move was found)
+def neighbour(wheel: np.ndarray, rng=random, pair_swap_p=OPTIMIZE_PAIR_SWAP_P, config: SimConfig = SIM_CONFIG):
+    wheel = wheel.copy()
+    groups = swappable_pairs(config)
+    if groups and rng.random() < pair_swap_p:
+        a, b = rng.sample(rng.choice(groups), 2)
+        wheel[[a, a + 1, b, b + 1]] = wheel[[b, b + 1, a, a + 1]]
+        return wheel
+
+    channels, beats = np.nonzero(wheel[:config.num_channels // 2 * 2])
+    if len(channels) == 0:
+        return wheel
+    for _ in range(100):
+        i = rng.randrange(len(channels))
+        c, beat = channels[i], beats[i]
+        wheel[c, beat] -= 1
+        wheel[c ^ 1, beat] += 1
+        if playable(wheel[c ^ 1], config):
+            return wheel
+        wheel[c, beat] += 1
+        wheel[c ^ 1, beat] -= 1
+    return wheel
+
+
+# How badly do replicas of song (with wheel instead of its own) run dry within plays plays of it?
+def wheel_fitness(wheel: np.ndarray, song: MMXSong, seeds: Sequence[int], plays: int,
+                  config: SimConfig = SIM_CONFIG) -> WheelFitness:
+    candidate = MMXSong(wheel.tolist(), song.mute_instructions, config)
+    max_beats = plays * candidate.beat_count
+    results = BatchMMX(candidate, seeds, config).run(np.iinfo(np.int64).max, max_beats=max_beats)
+    lost = [1 - r.beats / max_beats if r is not None and r.ran_dry else 0.0 for r in results]
+    return WheelFitness(float(np.mean(lost)), float(np.mean([l > 0 for l in lost])), len(seeds))
+
+
+# wheel_fitness() for every wheel not already in cache (in parallel if there's an executor), then from the cache
+def _evaluate(wheels: List[np.ndarray], cache: Dict[bytes, WheelFitness], executor, song: MMXSong,
+              seeds: Sequence[int], plays: int, config: SimConfig) -> List[WheelFitness]:
+    keys = [wheel.tobytes() for wheel in wheels]
+    new = list({key: wheel for key, wheel in zip(keys, wheels) if key not in cache}.items())
+    args = ([wheel for _, wheel in new], [song]*len(new), [seeds]*len(new), [plays]*len(new), [config]*len(new))
+    for (key, _), fitness in zip(new, executor.map(wheel_fitness, *args) if executor is not None
+                                 else map(wheel_fitness, *args)):
+        cache[key] = fitness
+    return [cache[key] for key in keys]
+
+
+# Anneal song's wheel for iterations steps, and return the keep best wheels seen, best first by their
+# validation score. Pass the same cache to carry on where an earlier search (with the same settings) left off.
+def optimize_wheel(song: MMXSong, iterations=OPTIMIZE_ITERATIONS, candidates=OPTIMIZE_CANDIDATES,
+                   num_replicas=OPTIMIZE_REPLICAS, plays=OPTIMIZE_PLAYS,
+                   start_temperature=OPTIMIZE_START_TEMPERATURE, end_temperature=OPTIMIZE_END_TEMPERATURE,
+                   pair_swap_p=OPTIMIZE_PAIR_SWAP_P, keep=OPTIMIZE_KEEP,
+                   validation_replicas=OPTIMIZE_VALIDATION_REPLICAS, master_seed=SWEEP_SEED, max_workers=None,
+                   cache: Dict[bytes, WheelFitness] = None, config: SimConfig = SIM_CONFIG) -> List[RankedWheel]:
+    if not np.any(np.array(song.wheel, dtype=np.uint8)[:config.num_channels // 2 * 2]):
+        raise ValueError("The wheel has no notes on its channel pairs, so there's nothing to move")
+    all_seeds = replica_seeds(master_seed, num_replicas + validation_replicas)
+    seeds, validation_seeds = all_seeds[:num_replicas], all_seeds[num_replicas:]
+    rng = random.Random(master_seed)
+    cache = {} if cache is None else cache
+    wheels: Dict[bytes, np.ndarray] = {}
+
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+    try:
+        current = np.array(song.wheel, dtype=np.uint8)
+        wheels[current.tobytes()] = current
+        current_fitness, = _evaluate([current], cache, executor, song, seeds, plays, config)
+        print("Start: cost {0:.4f}, {1:.1%} ran dry".format(current_fitness.cost, current_fitness.dry_fraction))
+
+        for i in range(iterations):
+            temperature = start_temperature * (end_temperature / start_temperature) ** (i / max(1, iterations - 1))
+            proposals = [neighbour(current, rng, pair_swap_p, config) for _ in range(candidates)]
+            fitnesses = _evaluate(proposals, cache, executor, song, seeds, plays, config)
+            for proposal in proposals:
+                wheels.setdefault(proposal.tobytes(), proposal)
+
+            best = min(range(candidates), key=lambda k: fitnesses[k].cost)
+            delta = fitnesses[best].cost - current_fitness.cost
+            if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+                current, current_fitness = proposals[best], fitnesses[best]
+            print("Step {0}/{1}: cost {2:.4f}, {3:.1%} ran dry (temperature {4:.4f}, {5} wheels scored)".format(
+                i + 1, iterations, current_fitness.cost, current_fitness.dry_fraction, temperature, len(cache)))
+
+        ranked = sorted(wheels, key=lambda key: cache[key].cost)[:keep]
+        validation = _evaluate([wheels[key] for key in ranked], {}, executor, song, validation_seeds, plays, config)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return sorted((RankedWheel(wheels[key], cache[key], fitness) for key, fitness in zip(ranked, validation)),
+                  key=lambda ranked_wheel: (ranked_wheel.validation.cost, ranked_wheel.search.cost))
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    ranked = optimize_wheel(song)
+    os.makedirs(OPTIMIZE_OUTPUT_DIR, exist_ok=True)
+    print()
+    print("Rank  Search cost  Search dry  Validation cost  Validation dry")
+    for rank, ranked_wheel in enumerate(ranked):
+        print("{0:4d}  {1:11.4f}  {2:10.1%}  {3:15.4f}  {4:14.1%}".format(
+            rank + 1, ranked_wheel.search.cost, ranked_wheel.search.dry_fraction,
+            ranked_wheel.validation.cost, ranked_wheel.validation.dry_fraction))
+        MMXSong(ranked_wheel.wheel.tolist(), song.mute_instructions).to_file(
+            os.path.join(OPTIMIZE_OUTPUT_DIR, "wheel_{0:02d}.json".format(rank + 1)))
+    print("Wheels written to {0}".format(OPTIMIZE_OUTPUT_DIR))
@@ -0,0 +1,188 @@
+import numpy as np
+
+from settings import *
+
+
+# One row of a trace. Every signal is stored as the lowest and highest value seen over the
+# beats the row covers; when sampling every `stride` beats both are just the sampled value.
+TRACE_DTYPE = np.dtype([
+    ("beat", np.int64),
+    ("marbles_dropped", np.int64),
+    ("min_marbles_lo", np.int32), ("min_marbles_hi", np.int32),
+    ("conveyor_waiting_lo", np.int32), ("conveyor_waiting_hi", np.int32),
+    ("fishstair_waiting_lo", np.int32), ("fishstair_waiting_hi", np.int32),
+])
+
+DECIMATION_MODES = ("stride", "minmax")
+
+
+# Decimates the time series of a run into TRACE_DTYPE rows and hands them to write_rows() a chunk at a time,
+# so memory use doesn't grow with the length of the run.
+#   decimate="stride":  keep every stride-th beat
+#   decimate="minmax":  keep the min and max of each window of stride beats (so spikes aren't lost)
+class Recorder:
+    def __init__(self, stride=1, decimate="stride", chunk_size=1 << 16):
+        if decimate not in DECIMATION_MODES:
+            raise ValueError("Unknown decimation mode '{0}', expected one of {1}".format(decimate, DECIMATION_MODES))
+        self.stride = stride
+        self.decimate = decimate
+        self.chunk = np.zeros(chunk_size, dtype=TRACE_DTYPE)
+        self.chunk_used = 0
+        self.rows_written = 0
+        self.window = None
+
+    # Does record() want to hear about this beat? (so callers can skip working the values out)
+    def due(self, beat) -> bool:
+        return self.decimate == "minmax" or beat % self.stride == 0
+
+    def record(self, beat, marbles_dropped, min_marbles, conveyor_waiting, fishstair_waiting):
+        if self.decimate == "stride":
+            self.__append((beat, marbles_dropped, min_marbles, min_marbles,
+                           conveyor_waiting, conveyor_waiting, fishstair_waiting, fishstair_waiting))
+            return
+
+        window = self.window
+        if window is None:
+            self.window = [beat, marbles_dropped, min_marbles, min_marbles,
+                           conveyor_waiting, conveyor_waiting, fishstair_waiting, fishstair_waiting, 1]
+            window = self.window
+        else:
+            window[1] = marbles_dropped
+            if min_marbles < window[2]: window[2] = min_marbles
+            if min_marbles > window[3]: window[3] = min_marbles
+            if conveyor_waiting < window[4]: window[4] = conveyor_waiting
+            if conveyor_waiting > window[5]: window[5] = conveyor_waiting
+            if fishstair_waiting < window[6]: window[6] = fishstair_waiting
+            if fishstair_waiting > window[7]: window[7] = fishstair_waiting
+            window[8] += 1
+        if window[8] >= self.stride:
+            self.__flush_window()
+
+    # record() for many beats at once, each argument an array with a value per beat
+    # (every beat for "minmax", or at least the beats due() for "stride")
+    def record_many(self, beats, marbles_dropped, min_marbles, conveyor_waiting, fishstair_waiting):
+        columns = (beats, marbles_dropped, min_marbles, conveyor_waiting, fishstair_waiting)
+        if self.decimate == "stride":
+            due = beats % self.stride == 0
+            self.__append_rows(self.__rows(*(column[due] for column in columns)))
+            return
+
+        # Finish off the window that's already open one beat at a time, then do whole windows at once
+        i = 0
+        while self.window is not None and i < len(beats):
+            self.record(*(column[i] for column in columns))
+            i += 1
+        num_windows = (len(beats) - i) // self.stride
+        end = i + num_windows * self.stride
+        windows = [column[i:end].reshape(num_windows, self.stride) for column in columns]
+        rows = self.__rows(windows[0][:, 0], windows[1][:, -1], *(window.min(axis=1) for window in windows[2:]))
+        for field, window in zip(("min_marbles", "conveyor_waiting", "fishstair_waiting"), windows[2:]):
+            rows[field + "_hi"] = window.max(axis=1)
+        self.__append_rows(rows)
+        for i in range(end, len(beats)):
+            self.record(*(column[i] for column in columns))
+
+    @staticmethod
+    def __rows(beats, marbles_dropped, min_marbles, conveyor_waiting, fishstair_waiting):
+        rows = np.zeros(len(beats), dtype=TRACE_DTYPE)
+        rows["beat"] = beats
+        rows["marbles_dropped"] = marbles_dropped
+        for field, values in (("min_marbles", min_marbles), ("conveyor_waiting", conveyor_waiting),
+                              ("fishstair_waiting", fishstair_waiting)):
+            rows[field + "_lo"] = values
+            rows[field + "_hi"] = values
+        return rows
+
+    def __flush_window(self):
+        if self.window is not None:
+            self.__append(tuple(self.window[:8]))
+            self.window = None
+
+    def __append(self, row):
+        self.chunk[self.chunk_used] = row
+        self.chunk_used += 1
+        if self.chunk_used == len(self.chunk):
+            self.__write_chunk()
+
+    def __append_rows(self, rows):
+        while len(rows):
+            n = min(len(rows), len(self.chunk) - self.chunk_used)
+            self.chunk[self.chunk_used:self.chunk_used + n] = rows[:n]
+            self.chunk_used += n
+            rows = rows[n:]
+            if self.chunk_used == len(self.chunk):
+                self.__write_chunk()
+
+    def __write_chunk(self):
+        if self.chunk_used:
+            self.write_rows(self.chunk[:self.chunk_used])
+        self.rows_written += self.chunk_used
+        self.chunk_used = 0
+
+    # Pass on the rows finished so far without waiting for the chunk to fill up
+    # (an open "minmax" window stays open)
+    def flush(self):
+        self.__write_chunk()
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        self.__flush_window()
+        self.__write_chunk()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Streams a run to a binary file of TRACE_DTYPE rows
+class TraceRecorder(Recorder):
+    def __init__(self, path, stride=1, decimate="stride", chunk_size=1 << 16):
+        super().__init__(stride, decimate, chunk_size)
+        self.path = path
+        self.file = open(path, "wb")
+
+    def write_rows(self, rows):
+        rows.tofile(self.file)
+
+    def close(self):
+        if self.file.closed:
+            return
+        super().close()
+        self.file.close()
+
+
+# Memory-map a trace written by TraceRecorder (nothing is read until it is used)
+def load_trace(path):
+    return np.memmap(path, dtype=TRACE_DTYPE, mode="r")
+
+
+def plot_trace(path, show=True):
+    import matplotlib.pyplot as plt
+
+    trace = load_trace(path)
+    fig, axes = plt.subplots(4, sharex=True)
+    for ax, (title, field) in zip(axes, [
+        ("Min marbles in a channel", "min_marbles"),
+        ("Conveyor waiting", "conveyor_waiting"),
+        ("Fishstair waiting", "fishstair_waiting"),
+    ]):
+        ax.set_title(title)
+        lo, hi = trace[field + "_lo"], trace[field + "_hi"]
+        if np.array_equal(lo, hi):
+            ax.plot(trace["beat"], lo)
+        else:
+            ax.fill_between(trace["beat"], lo, hi, step="post")
+    axes[3].set_title("Marbles Dropped")
+    axes[3].plot(trace["beat"], trace["marbles_dropped"])
+
+    if show:
+        plt.show()
+    return fig
+
+
+if __name__ == "__main__":
+    plot_trace(TRACE_PATH)
@@ -0,0 +1,154 @@
+import itertools
+import operator
+import random
+from typing import List, Optional
+
+import numpy as np
+
+from settings import *
+
+
+# Random numbers for the simulation.
+# A UniformStream gives exactly the numbers random.Random(seed) would, but draws them from numpy in blocks of
+# block_size at a time, so taking one is a C-level call with no Python in between (and bulk draws are cheap).
+# Streams for parallel replicas come from spawn() / replica_seeds(), and a stream created with record=True keeps
+# every number it hands out so a run (e.g. one that ran dry) can be replayed exactly with a ReplayStream.
+#
+# Since the numbers are the same, random.Random(seed), UniformStream(seed), the batch engine and the kernel
+# all simulate the same run for the same seed.
+
+
+# numpy's MT19937 is the same generator as random.Random's, so it can carry on from a random.Random state
+def mt19937(rng_state) -> np.random.Generator:
+    version, internal_state, gauss_next = rng_state
+    bit_generator = np.random.MT19937()
+    bit_generator.state = {
+        "bit_generator": "MT19937",
+        "state": {"key": np.array(internal_state[:-1], dtype=np.uint32), "pos": internal_state[-1]},
+    }
+    return np.random.Generator(bit_generator)
+
+
+# The random.Random state of generator (made by mt19937(rng_state))
+def random_state(generator: np.random.Generator, rng_state):
+    state = generator.bit_generator.state["state"]
+    return rng_state[0], tuple(int(x) for x in state["key"]) + (int(state["pos"]),), rng_state[2]
+
+
+# The random.Random state after drawing n numbers from rng_state
+def advance(rng_state, n):
+    generator = mt19937(rng_state)
+    generator.random(n)
+    return random_state(generator, rng_state)
+
+
+# A seed nobody has used before (for runs that weren't given one)
+def new_seed() -> int:
+    return int(np.random.SeedSequence().entropy)
+
+
+# Derive a seed for every replica from a master seed.
+# Seeds depend only on the replica's index, never on which worker runs it.
+def replica_seeds(master_seed: int, num_replicas: int) -> List[int]:
+    return [
+        int(seed_seq.generate_state(1, np.uint64)[0])
+        for seed_seq in np.random.SeedSequence(master_seed).spawn(num_replicas)
+    ]
+
+
+# The random.Random a run with this seed makes its random song with (if it needs one), so the song is the same
+# every time too. It is seeded differently from the run's own stream so the two don't draw the same numbers.
+def song_random(seed) -> random.Random:
+    return random.Random("song:{0}".format(seed))
+
+
+class UniformStream:
+    def __init__(self, seed=None, block_size=RNG_BLOCK_SIZE, record=False):
+        self.seed = new_seed() if seed is None else seed
+        self.block_size = block_size
+        # Blocks handed out so far and their iterators (None once used up), if recording
+        self.recording: Optional[list] = [] if record else None
+        self.setstate(random.Random(self.seed).getstate())
+
+    # Like random.Random.setstate() (and so is getstate())
+    def setstate(self, rng_state):
+        self.__block_state = rng_state     # State at the start of the current block
+        self.__current = None               # Iterator over what's left of the current block
+        if self.recording:
+            self.recording = [(block, None) for block in self.draws_blocks()]
+        self.__numbers = itertools.chain.from_iterable(self.__blocks())
+        self.random = self.__numbers.__next__
+
+    def __blocks(self):
+        while True:
+            generator = mt19937(self.__block_state)
+            block = generator.random(self.block_size)
+            self.__current = iter(block.tolist())
+            if self.recording is not None:
+                self.recording.append((block, self.__current))
+            yield self.__current
+            self.__block_state = random_state(generator, self.__block_state)
+
+    def __used(self) -> int:
+        return 0 if self.__current is None else self.block_size - operator.length_hint(self.__current)
+
+    def getstate(self):
+        return advance(self.__block_state, self.__used())
+
+    # The next n numbers as an array
+    def draw(self, n) -> np.ndarray:
+        return np.fromiter(itertools.islice(self.__numbers, n), dtype=np.float64, count=n)
+
+    # Independent streams (seeded from this one's seed)
+    def spawn(self, n) -> List["UniformStream"]:
+        return [UniformStream(seed, self.block_size) for seed in replica_seeds(self.seed, n)]
+
+    def draws_blocks(self) -> List[np.ndarray]:
+        return [block if numbers is None else block[:self.block_size - operator.length_hint(numbers)]
+                for block, numbers in self.recording]
+
+    # Every number handed out since the stream was created (only if recording)
+    def draws(self) -> np.ndarray:
+        if self.recording is None:
+            raise ValueError("The stream isn't recording")
+        blocks = self.draws_blocks()
+        return np.concatenate(blocks) if blocks else np.zeros(0)
+
+    def save_draws(self, path):
+        with open(path, "wb") as f:
+            np.save(f, self.draws())
+
+    def __getstate__(self):
+        return self.seed, self.block_size, self.getstate(), None if self.recording is None else self.draws()
+
+    def __setstate__(self, state):
+        self.seed, self.block_size, rng_state, draws = state
+        self.recording = None if draws is None else [(draws, None)]
+        self.setstate(rng_state)
+
+
+# Hands out recorded numbers (see UniformStream(record=True)) in the same order again.
+# It has no getstate(), so a run replaying one never uses the kernel (which needs to draw numbers itself).
+class ReplayStream:
+    def __init__(self, draws, position=0):
+        self.__draws = np.asarray(draws, dtype=np.float64)
+        self.__numbers = iter(self.__draws[position:].tolist())
+        self.random = itertools.chain(self.__numbers, self.__run_out()).__next__
+
+    def __run_out(self):
+        raise ValueError("Replayed all {0} recorded numbers".format(len(self.__draws)))
+        yield
+
+    @property
+    def position(self) -> int:
+        return len(self.__draws) - operator.length_hint(self.__numbers)
+
+    @staticmethod
+    def load(path):
+        return ReplayStream(np.load(path))
+
+    def __getstate__(self):
+        return self.__draws, self.position
+
+    def __setstate__(self, state):
+        self.__init__(*state)
@@ -0,0 +1,150 @@
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from batch import BatchMMX
+from explore import TRANSPORT_PREFIXES, get_setting, apply_design_point
+from rng import replica_seeds
+from sweep import run_chunked
+
+
+# Which setting helps most? Every setting is nudged down and up by its step and the change in each metric is
+# estimated by central finite differences. All the runs use the same replica seeds (common random numbers), so a
+# replica's runs at the lower and upper setting start out identical and only drift apart because of the setting,
+# and the difference between them is far less noisy than between independent runs. The standard error comes
+# from those paired differences.
+#
+# Setting names are as for explore.py, plus "return.divider_entry_spread" / "recycle.divider_entry_spread": the
+# distance between a transport's first and last divider entry points, widened or narrowed around its centre.
+
+# Metrics worked out for every replica (averaged over replicas)
+METRICS = {
+    "ran_dry": "P(ran dry)",
+    "beats": "Beats before dry",            # Or until the marble goal was reached
+    "fishstair_overflowed": "P(fishstair overflowed)",
+    "conveyor_overflowed": "P(conveyor overflowed)",
+}
+
+
+class Sensitivity(NamedTuple):
+    setting: str
+    value: float                                    # The setting as it is
+    low: float                                      # ... and nudged down and up (after rounding and clamping)
+    high: float
+    effects: Dict[str, Tuple[float, float]]         # Metric -> (change per unit of the setting, standard error)
+
+    # Change in metric for one step of size step
+    def per_step(self, metric: str, step: float) -> float:
+        return self.effects[metric][0] * step
+
+
+def get_value(config: SimConfig, name: str):
+    prefix, _, field = name.rpartition(".")
+    if field == "divider_entry_spread":
+        transport = getattr(config, TRANSPORT_PREFIXES[prefix])
+        return transport.divider_entry_end - transport.divider_entry_start
+    return get_setting(config, name)
+
+
+# config with setting name at value (rounded to an int if it is one, and kept to what makes sense)
+def set_value(config: SimConfig, name: str, value) -> SimConfig:
+    prefix, _, field = name.rpartition(".")
+    if field == "divider_entry_spread":
+        transport_field = TRANSPORT_PREFIXES[prefix]
+        transport = getattr(config, transport_field)
+        centre = (transport.divider_entry_start + transport.divider_entry_end) / 2
+        start, end = (min(max(round(centre + side * value / 2), 0), config.num_channels - 1) for side in (-1, 1))
+        return config._replace(**{transport_field: transport._replace(divider_entry_start=start, divider_entry_end=end)})
+    if field.endswith("_p"):
+        value = min(max(value, 0.0), 1.0)
+    elif isinstance(get_setting(config, name), int):
+        value = max(value, 1 if field.startswith("beats") else 0)
+    return apply_design_point(config, {name: value})
+
+
+_song: MMXSong = None
+
+
+# The song is sent to every worker once, rather than with every chunk of work
+def _set_song(song: MMXSong):
+    global _song
+    _song = song
+
+
+def _evaluate(config: SimConfig, marble_goal: int, seeds: Sequence[int]) -> Dict[str, np.ndarray]:
+    batch = BatchMMX(_song, seeds, config)
+    results = batch.run(marble_goal)
+    return {
+        "ran_dry": np.array([r.ran_dry for r in results], dtype=float),
+        "beats": np.array([r.beats for r in results], dtype=float),
+        "fishstair_overflowed": (batch.fishstair_overflow_beat >= 0).astype(float),
+        "conveyor_overflowed": (batch.conveyor_overflow_beat >= 0).astype(float),
+    }
+
+
+def sensitivity(song: MMXSong, steps: Dict[str, float] = SENSITIVITY_STEPS, num_replicas=SENSITIVITY_REPLICAS,
+                marble_goal=SENSITIVITY_MARBLE_GOAL, master_seed=SWEEP_SEED, chunk_size=SWEEP_CHUNK_SIZE,
+                max_workers=None, config: SimConfig = SIM_CONFIG) -> Tuple[Dict[str, float], List[Sensitivity]]:
+    # The standard errors come from the spread of the paired differences, which takes two replicas at least
+    if num_replicas < 2:
+        raise ValueError("Sensitivities need at least 2 replicas for their standard errors, got {0}".format(
+            num_replicas))
+    seeds = replica_seeds(master_seed, num_replicas)
+    configs = [config]
+    for name, step in steps.items():
+        value = get_value(config, name)
+        configs += [set_value(config, name, value - step), set_value(config, name, value + step)]
+
+    # Every chunk of replicas of every configuration is a separate task, all in one pool
+    per_config = [[] for _ in configs]
+    for i, evaluation in run_chunked(_evaluate, seeds, chunk_size, [(c, marble_goal) for c in configs], max_workers,
+                                     initializer=_set_song, initargs=(song,)):
+        per_config[i].append(evaluation)
+    evaluations = [{metric: np.concatenate([e[metric] for e in chunk_evaluations]) for metric in METRICS}
+                   for chunk_evaluations in per_config]
+
+    baseline = {metric: float(np.mean(values)) for metric, values in evaluations[0].items()}
+    sensitivities = []
+    for k, name in enumerate(steps):
+        low_config, high_config = configs[1 + 2*k], configs[2 + 2*k]
+        low, high = get_value(low_config, name), get_value(high_config, name)
+        effects = {}
+        for metric in METRICS:
+            if high == low:
+                effects[metric] = (float("nan"), float("nan"))
+                continue
+            differences = evaluations[2 + 2*k][metric] - evaluations[1 + 2*k][metric]
+            effects[metric] = (float(np.mean(differences)) / (high - low),
+                               float(np.std(differences, ddof=1) / np.sqrt(num_replicas)) / (high - low))
+        sensitivities.append(Sensitivity(name, get_value(config, name), low, high, effects))
+    return baseline, sensitivities
+
+
+def report(baseline: Dict[str, float], sensitivities: List[Sensitivity], steps: Dict[str, float] = SENSITIVITY_STEPS):
+    lines = ["Baseline: " + ", ".join("{0} {1:.4g}".format(METRICS[metric], value) for metric, value in baseline.items()),
+             "",
+             "Change for one step up (+- standard error), most helpful against running dry first:"]
+    header = "{0:32s} {1:>10s} {2:>8s}".format("Setting", "Value", "Step")
+    for title in METRICS.values():
+        header += " {0:>26s}".format(title)
+    lines.append(header)
+
+    def dry_effect(s: Sensitivity):
+        effect = s.per_step("ran_dry", steps[s.setting])
+        return (np.isnan(effect), effect, -s.per_step("beats", steps[s.setting]))
+
+    for s in sorted(sensitivities, key=dry_effect):
+        line = "{0:32s} {1:10.4g} {2:8.4g}".format(s.setting, s.value, steps[s.setting])
+        for metric in METRICS:
+            mean, error = s.effects[metric]
+            line += " {0:>26s}".format("{0:+.4g} +- {1:.2g}".format(mean * steps[s.setting], error * steps[s.setting]))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    print(report(*sensitivity(song)))
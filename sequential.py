@@ -0,0 +1,136 @@
+import math
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from batch import BatchMMX
+from rng import replica_seeds
+from sweep import run_chunked
+
+
+# Is P(running dry within a concert) below a target? Instead of simulating a fixed (large) number of replicas,
+# replicas are simulated a batch at a time and the test stops as soon as the answer is settled, which for
+# clearly good or clearly bad configurations takes a handful of replicas instead of thousands.
+#   "sprt": Wald's sequential probability ratio test of p = target*(1-indifference) against p = target*(1+indifference),
+#           with error rates alpha (calling a good configuration bad) and beta (calling a bad one good)
+#   "ci":   stop once the Wilson score interval for p at confidence 1-alpha is entirely on one side of target
+#           (simpler, but looking at the interval after every replica makes it somewhat optimistic)
+# Outcomes are looked at one replica at a time in seed order, so the answer (and how many replicas it took) only
+# depends on master_seed, not on the batch size or the number of workers.
+
+SEQUENTIAL_METHODS = ("sprt", "ci")
+
+
+class SequentialResult(NamedTuple):
+    verdict: str            # "pass" (P(dry) is below target), "fail", or "undecided" if max_replicas ran out first
+    replicas: int           # Replicas the decision was made on
+    ran_dry: int            # ... and how many of them ran dry within the concert
+    ci_low: float           # Wilson score interval for P(dry) from those replicas
+    ci_high: float
+    replicas_simulated: int # Including the rest of the last batch
+
+    @property
+    def dry_fraction(self) -> float:
+        return self.ran_dry / self.replicas if self.replicas else 0.0
+
+
+def wilson_interval(ran_dry, replicas, alpha: float):
+    z = _normal_quantile(1 - alpha / 2)
+    ran_dry = np.asarray(ran_dry, dtype=float)
+    replicas = np.asarray(replicas, dtype=float)
+    p = ran_dry / replicas
+    centre = (p + z*z / (2*replicas)) / (1 + z*z / replicas)
+    half_width = z * np.sqrt(p*(1 - p) / replicas + z*z / (4*replicas*replicas)) / (1 + z*z / replicas)
+    return centre - half_width, centre + half_width
+
+
+# Inverse of the standard normal CDF, by bisection on math.erf (plenty fast enough for a handful of calls)
+def _normal_quantile(q: float) -> float:
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < q:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+# Whether each replica runs dry within concert_plays plays of the song
+def _run_chunk(song: MMXSong, concert_plays: int, config: SimConfig, seeds: Sequence[int]) -> List[bool]:
+    batch = BatchMMX(song, seeds, config)
+    results = batch.run(np.iinfo(np.int64).max, max_beats=concert_plays * song.beat_count)
+    return [r is not None and r.ran_dry for r in results]
+
+
+# The P(dry) the SPRT tells apart: p0 (good enough) and p1 (too high), which have to be 0 < p0 < p1 < 1
+def sprt_hypotheses(target: float, indifference: float):
+    p0 = target * (1 - indifference)
+    p1 = target * (1 + indifference)
+    if not 0 < p0 < p1 < 1:
+        raise ValueError("The SPRT needs 0 < p0 < p1 < 1 (0 < indifference < 1 and target * (1 + indifference) < 1), "
+                         "got p0 = {0:g} and p1 = {1:g}".format(p0, p1))
+    return p0, p1
+
+
+# The first replica count at which the rule is settled, and the verdict, or (None, None)
+def _decide(ran_dry: np.ndarray, target: float, method: str, alpha: float, beta: float, indifference: float):
+    n = np.arange(1, len(ran_dry) + 1)
+    dry = np.cumsum(ran_dry)
+
+    if method == "sprt":
+        p0, p1 = sprt_hypotheses(target, indifference)
+        llr = dry * math.log(p1 / p0) + (n - dry) * math.log((1 - p1) / (1 - p0))
+        fail = llr >= math.log((1 - beta) / alpha)
+        passed = llr <= math.log(beta / (1 - alpha))
+    elif method == "ci":
+        low, high = wilson_interval(dry, n, alpha)
+        fail = low > target
+        passed = high < target
+    else:
+        raise ValueError("Unknown method '{0}', expected one of {1}".format(method, SEQUENTIAL_METHODS))
+
+    settled = np.flatnonzero(fail | passed)
+    if settled.size == 0:
+        return None, None
+    i = int(settled[0])
+    return i + 1, "fail" if fail[i] else "pass"
+
+
+def sequential_test(song: MMXSong, target=SEQUENTIAL_TARGET, concert_plays=SEQUENTIAL_CONCERT_PLAYS,
+                    method=SEQUENTIAL_METHOD, alpha=SEQUENTIAL_ALPHA, beta=SEQUENTIAL_BETA,
+                    indifference=SEQUENTIAL_INDIFFERENCE, batch_size=SEQUENTIAL_BATCH_SIZE,
+                    max_replicas=SEQUENTIAL_MAX_REPLICAS, master_seed=SWEEP_SEED, max_workers=1,
+                    config: SimConfig = SIM_CONFIG) -> SequentialResult:
+    if not 0 < target < 1:
+        raise ValueError("target must be between 0 and 1, got {0}".format(target))
+    if method == "sprt":
+        sprt_hypotheses(target, indifference)
+    seeds = replica_seeds(master_seed, max_replicas)
+
+    # See if that's enough to decide after every batch (the batches still to come are cancelled once it is)
+    ran_dry: List[bool] = []
+    verdict = None
+    for _, chunk_ran_dry in run_chunked(_run_chunk, seeds, batch_size, [(song, concert_plays, config)], max_workers):
+        ran_dry += chunk_ran_dry
+        replicas, verdict = _decide(np.array(ran_dry), target, method, alpha, beta, indifference)
+        if verdict is not None:
+            break
+
+    if verdict is None:
+        replicas, verdict = len(ran_dry), "undecided"
+    dry = int(np.sum(ran_dry[:replicas]))
+    low, high = wilson_interval(dry, replicas, alpha)
+    return SequentialResult(verdict, replicas, dry, float(low), float(high), len(ran_dry))
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    result = sequential_test(song, max_workers=None)
+    print("P(running dry within {0} plays of the song) < {1}: {2}".format(SEQUENTIAL_CONCERT_PLAYS, SEQUENTIAL_TARGET,
+                                                                          result.verdict))
+    print("Decided after {0} replicas ({1} simulated), {2} ran dry, {3:.0%} interval {4:.4f} - {5:.4f}".format(
+        result.replicas, result.replicas_simulated, result.ran_dry, 1 - SEQUENTIAL_ALPHA, result.ci_low, result.ci_high))
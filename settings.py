@@ -25,11 +25,47 @@ LONG_RUN_MARBLE_GOAL = 1_000_000
 # How often to issue reports about progress?
 REPORT_COUNT = 20
 
+# Seed for the random numbers of a run, or None for a new one every run (it's printed, so the run can be repeated)
+SEED = None
+# Save every random number a run draws to this file (as a .npy array) to replay it with rng.ReplayStream, or None
+RECORD_DRAWS_PATH = None
+# Random numbers are drawn this many at a time (see rng.py)
+RNG_BLOCK_SIZE = 1 << 16
+
+# Jump straight over stretches where nothing can happen (no notes played, nothing waiting for or on the transports)
+FAST_FORWARD = True
+
+# Run the beat loop in a compiled kernel when numba is installed (see kernel.py), which is much faster
+# and gives exactly the same results (it can't be used while collecting metrics)
+USE_KERNEL = True
+
 # Display plots using matplotlib?
 DO_PLOTTING = True
+# Where the time series for the plots is streamed to while the simulation runs (plot it again with recorder.py)
+TRACE_PATH = "run.trace"
+# Keep one point every TRACE_STRIDE beats: either just that beat ("stride"), or the min and max over those beats ("minmax")
+TRACE_STRIDE = 16
+TRACE_DECIMATION = "minmax"
+
+# Save the whole state of the simulation here every CHECKPOINT_INTERVAL beats (and when interrupted), e.g.
+# "run.checkpoint", or None to not bother
+CHECKPOINT_PATH = None
+CHECKPOINT_INTERVAL = 1_000_000
+# Carry on from the state saved in CHECKPOINT_PATH instead of starting a new run
+RESUME_FROM_CHECKPOINT = False
+
+# Count what goes on inside each beat (see metrics.py), which slows the simulation down a bit
+COLLECT_METRICS = False
+# Where to write those counts in Prometheus text format while the simulation runs, or None to not bother
+METRICS_PATH = "mmx_metrics.prom"
+# How often to write them, in seconds
+METRICS_EXPORT_INTERVAL = 10.0
 
 # How many marbles are in the pipe from the divider to gate?
 MAX_MARBLES_PER_CHANNEL = 32
+# The pipes on the real machine aren't all the same length: a list of NUM_CHANNELS capacities (first channel first)
+# to use instead of MAX_MARBLES_PER_CHANNEL for each channel, or None to give every channel MAX_MARBLES_PER_CHANNEL
+CHANNEL_MAX_MARBLES = None
 
 
 # The probability that a marble going past an empty channel in the divider will fall in
@@ -85,7 +121,6 @@ MARBLE_RECYCLE_SETTINGS = MarbleTransportSettings(
     reservoir_initial=4*60,     # How many marbles start waiting for the fishstair?
 )
 
-
 # Old reference video: https://www.youtube.com/watch?v=5ZBb0jidgwQ
 # TODO: Could also refer to the original marble machine and scale up by how much more capable MMX should ideally be
 
@@ -157,3 +192,173 @@ RANDOM_SONG_WRITING_RESOLUTION = 4
 MIN_DISTANCE_BETWEEN_NOTES = 3
 
 
+# All of the above in one place, this is what the simulation actually uses
+SIM_CONFIG = SimConfig(
+    num_channels=NUM_CHANNELS,
+    beats_per_wheel=BEATS_PER_WHEEL,
+    mute_groups=tuple(MUTE_GROUPS),
+
+    max_marbles_per_channel=MAX_MARBLES_PER_CHANNEL,
+    channel_max_marbles=None if CHANNEL_MAX_MARBLES is None else tuple(CHANNEL_MAX_MARBLES),
+    channel_accept_prob_min=CHANNEL_ACCEPT_PROB_MIN,
+    channel_accept_prob_max=CHANNEL_ACCEPT_PROB_MAX,
+    reverse_divider=REVERSE_DIVIDER,
+    return_settings=MARBLE_RETURN_SETTINGS,
+    recycle_settings=MARBLE_RECYCLE_SETTINGS,
+
+    random_song_instrument_settings=tuple(RANDOM_SONG_INSTRUMENT_SETTINGS),
+    random_song_mute_instructions=tuple(RANDOM_SONG_MUTE_INSTRUCTIONS),
+    random_song_writing_resolution=RANDOM_SONG_WRITING_RESOLUTION,
+    min_distance_between_notes=MIN_DISTANCE_BETWEEN_NOTES,
+)
+
+
+# ----- MONTE CARLO SWEEP SETTINGS (see sweep.py) -----
+
+# How many independent machines to simulate (each gets freshly drawn channel accept probabilities)
+SWEEP_REPLICAS = 1000
+# Every replica's random seed is derived from this, so a sweep can be reproduced exactly
+SWEEP_SEED = 0
+# How many marbles each replica tries to drop
+SWEEP_MARBLE_GOAL = 100_000
+# How many replicas each worker process simulates at once with the batch engine
+SWEEP_CHUNK_SIZE = 64
+# cli.py runs chunks of fewer replicas than this one replica at a time (see mmx.run_replica()), as the batch engine
+# is slower for them; with numba installed it runs every chunk that way, in the kernel (see kernel.py)
+BATCH_MIN_REPLICAS = 32
+
+
+# ----- SEQUENTIAL TEST SETTINGS (see sequential.py) -----
+
+# Is P(running dry within SEQUENTIAL_CONCERT_PLAYS plays of the song) below SEQUENTIAL_TARGET?
+SEQUENTIAL_TARGET = 0.01
+SEQUENTIAL_CONCERT_PLAYS = 1
+# "sprt" for a sequential probability ratio test, or "ci" to stop once a confidence interval is clear of the target
+SEQUENTIAL_METHOD = "sprt"
+# Chance of calling a good configuration bad (and 1 - confidence of the interval), and of calling a bad one good
+SEQUENTIAL_ALPHA = 0.05
+SEQUENTIAL_BETA = 0.05
+# The test only has to tell P(dry) <= SEQUENTIAL_TARGET*(1-x) apart from P(dry) >= SEQUENTIAL_TARGET*(1+x)
+SEQUENTIAL_INDIFFERENCE = 0.5
+# Replicas simulated at a time, and the most to simulate before giving up ("undecided")
+SEQUENTIAL_BATCH_SIZE = 64
+SEQUENTIAL_MAX_REPLICAS = 20_000
+
+
+# ----- CONCERT SETTINGS (see concert.py) -----
+
+# A directory of song JSON files to play one after the other (in order of file name) instead of SONG_PATH, or None
+CONCERT_PATH = None
+# How many beats the machine keeps turning without playing between songs
+CONCERT_GAP_BEATS = 32
+
+
+# ----- CORPUS SETTINGS (see corpus.py) -----
+
+# Binary file of many songs, memory-mapped by sweep workers (python corpus.py writes CORPUS_SIZE random songs to it)
+CORPUS_PATH = "songs.mmxc"
+CORPUS_SIZE = 1000
+
+
+# ----- EVENT ENGINE SETTINGS (see events.py) -----
+
+# Ticks the event engine splits every beat into
+EVENT_TICKS_PER_BEAT = RANDOM_SONG_WRITING_RESOLUTION
+# Each marble's time on a transport is beats_to_transport give or take up to this many beats (evenly spread)
+EVENT_TRANSPORT_JITTER = 2.0
+# Beats a marble takes to roll past one divider channel
+# (beats_to_transport includes the time on the divider for the beat model, so take it out again if this is set)
+EVENT_DIVIDER_BEATS_PER_CHANNEL = 0.1
+# Only pick marbles up when a transport steps at the start of a beat (like the beat model), rather than whenever they arrive
+EVENT_STEPPED_TRANSPORTS = False
+# How many replicas python events.py compares the event engine and the beat model on, and for how many marbles
+EVENT_REPLICAS = 64
+EVENT_MARBLE_GOAL = 200_000
+
+
+# ----- LIVE DASHBOARD SETTINGS (see live.py) -----
+
+# python live.py simulates LIVE_RUNS replicas at once and serves their progress on http://LIVE_HOST:LIVE_PORT/
+LIVE_HOST = "127.0.0.1"
+LIVE_PORT = 8765
+LIVE_RUNS = 4
+# Runs send one point every LIVE_STRIDE beats (decimated as TRACE_DECIMATION), at least every LIVE_FLUSH_INTERVAL seconds
+LIVE_STRIDE = 256
+LIVE_FLUSH_INTERVAL = 0.25
+# Chunks of points waiting for the server, and events waiting for each browser, before new ones are dropped
+LIVE_QUEUE_SIZE = 256
+LIVE_CLIENT_QUEUE_SIZE = 256
+# Chunks of points kept for each run (for browsers that connect later, and on the dashboard)
+LIVE_HISTORY = 2000
+
+
+# ----- PARAMETER EXPLORER SETTINGS (see explore.py) -----
+
+# "grid" to try every combination of EXPLORE_GRID_LEVELS values per range, or "lhs" for a Latin hypercube
+EXPLORE_DESIGN = "lhs"
+# How many design points a Latin hypercube design has
+EXPLORE_POINTS = 32
+# How many values of each range a grid design tries
+EXPLORE_GRID_LEVELS = 3
+# Ranges to explore, as {<name>: (<low>, <high>)}
+# Names are SimConfig fields, or "return."/"recycle." followed by a MarbleTransportSettings field
+EXPLORE_RANGES = {
+    "max_marbles_per_channel": (16, 64),
+    "return.beats_to_transport": (24, 64),
+    "recycle.reservoir_initial": (0, 280),
+}
+# How many replicas to simulate at each design point, and for how many marbles
+EXPLORE_REPLICAS = 64
+EXPLORE_MARBLE_GOAL = 50_000
+# Give up on a design point if at least this fraction of replicas ran dry within the first play of the song
+EXPLORE_FAIL_FRACTION = 0.5
+# Where to write the results table (CSV)
+EXPLORE_RESULTS_PATH = "explore_results.csv"
+
+
+# ----- SENSITIVITY SETTINGS (see sensitivity.py) -----
+
+# Settings to nudge up and down, and by how much, as {<name>: <step>} (names as for EXPLORE_RANGES, plus
+# "return.divider_entry_spread"/"recycle.divider_entry_spread" for the distance between a transport's first and
+# last divider entry points). max_marbles_per_channel does nothing while CHANNEL_MAX_MARBLES is set.
+SENSITIVITY_STEPS = {
+    "return.reservoir_capacity": 4,
+    "recycle.reservoir_capacity": 20,
+    "return.beats_to_transport": 4,
+    "recycle.beats_to_transport": 2,
+    "return.channel_accept_p": 0.02,
+    "max_marbles_per_channel": 4,
+    "return.divider_entry_spread": 4,
+}
+# Replicas simulated for every nudged setting (the same ones each time), and for how many marbles
+SENSITIVITY_REPLICAS = 128
+SENSITIVITY_MARBLE_GOAL = 50_000
+
+
+# ----- WHEEL OPTIMIZER SETTINGS (see optimize.py) -----
+
+# Annealing steps, and neighbouring wheels scored (in parallel) at every step
+OPTIMIZE_ITERATIONS = 200
+OPTIMIZE_CANDIDATES = 8
+# Fraction of moves that swap two channel pairs, the rest move a single note to the other channel of its pair
+OPTIMIZE_PAIR_SWAP_P = 0.2
+# Every wheel is scored on OPTIMIZE_REPLICAS replicas playing the song OPTIMIZE_PLAYS times
+OPTIMIZE_REPLICAS = 64
+OPTIMIZE_PLAYS = 4
+# The temperature falls geometrically from start to end (costs are fractions of the song lost to running dry)
+OPTIMIZE_START_TEMPERATURE = 0.02
+OPTIMIZE_END_TEMPERATURE = 0.0005
+# How many of the best wheels to measure again on OPTIMIZE_VALIDATION_REPLICAS fresh replicas, and write out as songs
+OPTIMIZE_KEEP = 10
+OPTIMIZE_VALIDATION_REPLICAS = 256
+OPTIMIZE_OUTPUT_DIR = "optimized"
+
+
+# ----- BENCHMARK SETTINGS (see benchmark.py) -----
+
+# Each benchmark is run this many times and the fastest run is kept
+BENCHMARK_REPEAT = 3
+# Where the results of every benchmark run are kept
+BENCHMARK_HISTORY_PATH = "benchmark_history.json"
+# Flag a regression if throughput drops by more than this fraction since the last run
+BENCHMARK_REGRESSION_THRESHOLD = 0.10
@@ -1,4 +1,4 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional, Tuple
 
 class InstrumentSettings(NamedTuple):
     num_cps: int
@@ -26,3 +26,33 @@ class MarbleTransportSettings(NamedTuple):
     reservoir_capacity: int
     reservoir_initial: int
 
+# Everything the simulation needs to know, passed explicitly into MMX, MMXSong, etc.
+# instead of being read from the settings module, so several configurations can be used in one process.
+# (See SIM_CONFIG in settings.py for what each field means)
+class SimConfig(NamedTuple):
+    num_channels: int
+    beats_per_wheel: int
+    mute_groups: Tuple[int, ...]
+
+    max_marbles_per_channel: int
+    channel_max_marbles: Optional[Tuple[int, ...]]  # Overrides max_marbles_per_channel for each channel if set
+    channel_accept_prob_min: float
+    channel_accept_prob_max: float
+    reverse_divider: bool
+    return_settings: MarbleTransportSettings
+    recycle_settings: MarbleTransportSettings
+
+    random_song_instrument_settings: Tuple[InstrumentSettings, ...]
+    random_song_mute_instructions: Tuple[SongMuteInstruction, ...]
+    random_song_writing_resolution: int
+    min_distance_between_notes: int
+
+    # How many marbles each channel holds
+    @property
+    def max_counts(self) -> Tuple[int, ...]:
+        if self.channel_max_marbles is None:
+            return (self.max_marbles_per_channel,) * self.num_channels
+        if len(self.channel_max_marbles) != self.num_channels:
+            raise ValueError("channel_max_marbles has {0} channels, expected {1}".format(
+                len(self.channel_max_marbles), self.num_channels))
+        return tuple(self.channel_max_marbles)
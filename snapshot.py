@@ -0,0 +1,57 @@
+import os
+import pickle
+import zlib
+from typing import List, Tuple
+
+from settings import *
+from mmx import MMX
+from rng import UniformStream
+
+
+# Snapshots of a whole simulation: the MMX (channels, transports and their queues, where it is in the song),
+# the song itself and the state of its random number generator, plus whatever run_sim() needs to carry on.
+# Loading one and continuing gives exactly the same results as never having stopped.
+#
+# The format is SNAPSHOT_MAGIC, a version byte, then a zlib compressed pickle, so only load snapshots you trust.
+
+SNAPSHOT_MAGIC = b"MMXSNAP"
+SNAPSHOT_VERSION = 4
+
+
+def dumps(mmx: MMX, **run_state) -> bytes:
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + zlib.compress(
+        pickle.dumps((mmx, run_state), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data: bytes) -> Tuple[MMX, dict]:
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Not an MMX snapshot")
+    version = data[len(SNAPSHOT_MAGIC)]
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version {0}, expected {1}".format(version, SNAPSHOT_VERSION))
+    return pickle.loads(zlib.decompress(data[len(SNAPSHOT_MAGIC) + 1:]))
+
+
+# Written to a temporary file first so being interrupted while saving doesn't lose the last snapshot
+def save(path, mmx: MMX, **run_state):
+    data = dumps(mmx, **run_state)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def load(path) -> Tuple[MMX, dict]:
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+# Independent copies of the machine in a snapshot, one per seed, to see where the same starting state can go
+# (a seed of None keeps the snapshot's random state, so that copy carries on exactly like the original would)
+def fork(data: bytes, seeds) -> List[MMX]:
+    machines = []
+    for seed in seeds:
+        mmx, _ = loads(data)
+        if seed is not None:
+            mmx.set_rng(UniformStream(seed))
+        machines.append(mmx)
+    return machines
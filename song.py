@@ -1,16 +1,22 @@
 import math
+import random
+from array import array
 from dataclasses import dataclass
 from utils import *
 from settings import *
 import json
 from typing import List, Dict, Tuple
 
+import numpy as np
 
-def mute_mask_repr(mask):
+from rng import song_random
+
+
+def mute_mask_repr(mask, config: SimConfig = SIM_CONFIG):
     reprs = []
 
     i = 0
-    for instrument in reversed(RANDOM_SONG_INSTRUMENT_SETTINGS):
+    for instrument in reversed(config.random_song_instrument_settings):
         num_cs = 2 * instrument.num_cps
 
         instrument_mask = (mask & (((1 << num_cs) - 1) << i)) >> i
@@ -27,11 +33,11 @@ def blank_wheel(num_channels: int, num_beats: int) -> List[List[int]]:
     return song
 
 
-def get_random_note_counts(num_cs: int, npb: float, ratio: float):
-    notes_per_cycle = npb * BEATS_PER_WHEEL
+def get_random_note_counts(num_cs: int, npb: float, ratio: float, beats_per_wheel: int = BEATS_PER_WHEEL, rng=random):
+    notes_per_cycle = npb * beats_per_wheel
 
     c_weights: List[float] = [
-        randf(1, ratio) for c in range(num_cs)]
+        randf(1, ratio, rng) for c in range(num_cs)]
     t_weight: float = sum(c_weights)
     c_counts: List[int] = [math.floor(
         (weight/t_weight)*notes_per_cycle) for weight in c_weights]
@@ -39,28 +45,85 @@ def get_random_note_counts(num_cs: int, npb: float, ratio: float):
     return c_counts
 
 
-def make_highres_wheel_from_counts(c_counts: List[int]):
-    wheel = blank_wheel(len(c_counts), BEATS_PER_WHEEL*RANDOM_SONG_WRITING_RESOLUTION)
+def make_highres_wheel_from_counts(c_counts: List[int], config: SimConfig = SIM_CONFIG, rng=random):
+    num_points = config.beats_per_wheel*config.random_song_writing_resolution
+    # Bits covering every point too close to a note at bit min_distance_between_notes-1
+    too_close = (1 << (2*config.min_distance_between_notes - 1)) - 1
+
+    wheel = blank_wheel(len(c_counts), num_points)
     for c in range(len(c_counts)):
-        # A probably very slow way of finding places for new notes:
-        remaining_points = list(range(BEATS_PER_WHEEL*RANDOM_SONG_WRITING_RESOLUTION))
+        # Bit i is set while a note can still go at point i.
+        # Trying random points until one is free picks uniformly among the free points.
+        free = (1 << num_points) - 1
         for _ in range(c_counts[c]):
-            i = remaining_points[random.randrange(len(remaining_points))]
-            for j in range(i-MIN_DISTANCE_BETWEEN_NOTES+1, i+MIN_DISTANCE_BETWEEN_NOTES):
-                if j in remaining_points:
-                    remaining_points.remove(j)
+            if not free:
+                raise ValueError("No room left on the wheel for another note")
+            i = rng.randrange(num_points)
+            while not (free >> i) & 1:
+                i = rng.randrange(num_points)
+
+            shift = i - config.min_distance_between_notes + 1
+            free &= ~(too_close << shift if shift >= 0 else too_close >> -shift)
             wheel[c][i] = 1
     
     return wheel
 
 
+# Many random wheels at once, drawn the same way as MMXSong.make_random() does, as a
+# (num_wheels, num_channels, beats_per_wheel) array
+def make_random_wheels(num_wheels: int, config: SimConfig = SIM_CONFIG, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    resolution = config.random_song_writing_resolution
+    num_points = config.beats_per_wheel*resolution
+    too_close = np.arange(-config.min_distance_between_notes+1, config.min_distance_between_notes)
+
+    wheels = []
+    for instrument in config.random_song_instrument_settings:
+        num_cps = instrument.num_cps
+
+        # get_random_note_counts() for every wheel
+        weights = 1 + (instrument.ratio - 1) * rng.random((num_wheels, num_cps))
+        cp_counts = np.floor(weights / weights.sum(axis=1, keepdims=True) *
+                             (instrument.npb/2 * config.beats_per_wheel)).astype(np.int64)
+
+        # make_highres_wheel_from_counts() twice for every wheel, as the rows of one (num_wheels*2*num_cps, num_points) matrix
+        counts = np.repeat(cp_counts[:, None, :], 2, axis=1).reshape(-1)
+        free = np.ones((counts.size, num_points), dtype=bool)
+        notes = np.zeros((counts.size, num_points), dtype=np.int64)
+        for k in range(counts.max(initial=0)):
+            waiting = np.flatnonzero(counts > k)
+            while waiting.size:
+                if not free[waiting].any(axis=1).all():
+                    raise ValueError("No room left on the wheel for another note")
+                points = rng.integers(0, num_points, waiting.size)
+                placed = free[waiting, points]
+                rows, points = waiting[placed], points[placed]
+                notes[rows, points] = 1
+
+                cols = points[:, None] + too_close
+                valid = (cols >= 0) & (cols < num_points)
+                free[np.broadcast_to(rows[:, None], cols.shape)[valid], cols[valid]] = False
+                waiting = waiting[~placed]
+
+        # Hand the merged notes of each pair out alternately to its two channels
+        merged = notes.reshape(num_wheels, 2, num_cps, num_points).sum(axis=1)
+        before = np.cumsum(merged, axis=2) - merged
+        first = (merged + (before % 2 == 0)) // 2
+        highres = np.stack((first, merged - first), axis=2).reshape(num_wheels, 2*num_cps, num_points)
+
+        wheels.append(highres.reshape(num_wheels, 2*num_cps, config.beats_per_wheel, resolution).sum(axis=3))
+
+    return np.concatenate(wheels, axis=1).astype(np.uint8)
+
+
 # Compress a wheel from song writing to simulation resolution
-def compress_wheel(highres_wheel):
+def compress_wheel(highres_wheel, config: SimConfig = SIM_CONFIG):
+    resolution = config.random_song_writing_resolution
     wheel = []
     for line in highres_wheel:
         wheel.append([])
-        for i in range(BEATS_PER_WHEEL):
-            wheel[-1].append(sum(line[(i*RANDOM_SONG_WRITING_RESOLUTION):((i+1)*RANDOM_SONG_WRITING_RESOLUTION)]))
+        for i in range(config.beats_per_wheel):
+            wheel[-1].append(sum(line[(i*resolution):((i+1)*resolution)]))
     return wheel
 
 def wheel_to_text(wheel):
@@ -68,90 +131,133 @@ def wheel_to_text(wheel):
         yield "".join([str(notes) if notes > 0 else "-" for notes in c_notes])
 
 def wheel_from_text(wheel_text: List[str], num_channels=NUM_CHANNELS, num_beats=BEATS_PER_WHEEL):
-    wheel = blank_wheel(num_channels, num_beats)
+    wheel = np.zeros((num_channels, num_beats), dtype=np.uint8)
     for i, line in enumerate(wheel_text):
-        for j, char in enumerate(line):
-            wheel[i][j] = 0 if char == "-" else int(char)
-    return wheel
+        # Anything but a digit (or "-") ends up above 9, since the subtraction wraps around below "0"
+        notes = np.frombuffer(line.replace("-", "0").encode("ascii", "replace"), dtype=np.uint8) - ord("0")
+        if (notes > 9).any():
+            raise ValueError("Invalid note count '{0}' on line {1} of the wheel, expected a digit or '-'".format(
+                line[np.argmax(notes > 9)], i + 1))
+        wheel[i, :len(line)] = notes
+    return wheel.tolist()
+
+
+# idle_beats(...)[i] is how many beats in a row, starting at beat i, play no notes (wrapping around the song),
+# for a schedule like MMXSong.beat_offsets
+def idle_beats(beat_offsets):
+    beat_count = len(beat_offsets) - 1
+    if beat_offsets[-1] == 0:
+        return array("I", [beat_count] * beat_count)
+    # The next beat that plays something, from each beat of the song played twice in a row
+    busy = np.tile(np.diff(np.frombuffer(beat_offsets, dtype=np.uint32)) > 0, 2)
+    i = np.arange(2 * beat_count)
+    next_busy = np.minimum.accumulate(np.where(busy, i, 2 * beat_count)[::-1])[::-1]
+    return array("I", (next_busy - i)[:beat_count].astype(np.uint32).tobytes())
 
 
 class MMXSong:
-    def __init__(self, wheel, mute_instructions):
-        self.wheel: List[List[int]] = wheel
+    def __init__(self, wheel, mute_instructions, config: SimConfig = SIM_CONFIG):
+        self.config: SimConfig = config
+        self.wheel: List[List[int]] = wheel   # Or a (channels, beats per wheel) array
         self.mute_instructions: List[SongMuteInstruction] = mute_instructions
         self.mute_masks: List[Tuple[int, int, str]] = []
 
-        beat_count = 0
-        for i, mute_instruction in enumerate(self.mute_instructions):
+        # Which channels every mute group (and so every song section) unmutes, channel 0 being the mask's top bit.
+        # The masks are unpacked as 64 bit ints, which holds a bit for every channel and every mute group.
+        num_channels = self.config.num_channels
+        num_groups = len(self.config.mute_groups)
+        if num_channels > 64 or num_groups > 64:
+            raise ValueError("Songs can have at most 64 channels and 64 mute groups, got {0} and {1}".format(
+                num_channels, num_groups))
+        shifts = np.arange(num_channels - 1, -1, -1, dtype=np.uint64)
+        group_masks = np.array(self.config.mute_groups, dtype=np.uint64)
+        group_channels = np.bitwise_and(np.right_shift(group_masks[:, None], shifts), 1).astype(np.int64)
+        instruction_masks = np.array([mi.mask for mi in self.mute_instructions], dtype=np.uint64)
+        instruction_groups = np.bitwise_and(np.right_shift(instruction_masks[:, None],
+                                                           np.arange(num_groups, dtype=np.uint64)), 1).astype(np.int64)
+        section_enabled = (instruction_groups @ group_channels) > 0
+
+        lengths = np.array([mi.length for mi in self.mute_instructions], dtype=np.int64)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        for mute_instruction, enabled, start_beat in zip(self.mute_instructions, section_enabled, starts):
             # Expand the instruction mask into a full mask
-            mask = 0
-            for j, MUTE_GROUP in enumerate(MUTE_GROUPS):
-                if mute_instruction.mask & (1 << j):
-                    mask |= MUTE_GROUP
-            self.mute_masks.append((mask, beat_count, mute_instruction.length, mute_instruction.name))
-            beat_count += mute_instruction.length
-        self.beat_count = beat_count
-        
-        # WARNING: Caching
-        self.__cached_notes = [None for i in range(self.beat_count)]
+            mask = int.from_bytes(np.packbits(enabled[::-1], bitorder="little").tobytes(), "little")
+            self.mute_masks.append((mask, int(start_beat), mute_instruction.length, mute_instruction.name))
+        self.beat_count = int(lengths.sum())
+
+        # enabled[i, c]: is channel c unmuted on beat i
+        # effective_notes[i, c]: how many notes channel c plays on beat i (the wheel turned to beat i, if unmuted)
+        self.enabled = np.repeat(section_enabled.reshape(-1, num_channels), lengths, axis=0)
+        wheel = np.asarray(self.wheel, dtype=np.uint8).reshape(num_channels, -1)
+        self.effective_notes = wheel.T[np.arange(self.beat_count) % self.config.beats_per_wheel] * self.enabled
 
-        self.note_count = 0
-        for i in range(self.beat_count):
-            self.note_count += len(list(self.notes_on_beat(i)))
+        self.compile_schedule()
+
+        self.note_count = len(self.beat_channels)
         self.npb = self.note_count / self.beat_count
 
+    # Work out once which channels fire on every beat of the song, stored CSR style:
+    #   beat_channels[beat_offsets[i]:beat_offsets[i+1]] are the channels fired on beat i
+    #     (a channel appears once per note, so twice if it plays 2 notes on that beat)
+    #   beat_note_counts[i*num_channels + c] is how many notes channel c plays on beat i
+    def compile_schedule(self):
+        num_channels = self.config.num_channels
+        notes = self.effective_notes.reshape(-1)
+        self.beat_offsets = array("I", np.concatenate(([0], np.cumsum(self.effective_notes.sum(axis=1, dtype=np.uint32))))
+                                  .astype(np.uint32).tobytes())
+        self.beat_channels = array("B", np.repeat(np.tile(np.arange(num_channels, dtype=np.uint8), self.beat_count),
+                                                  notes).tobytes())
+        self.beat_note_counts = array("B", notes.tobytes())
 
-    def is_unmuted_on_beat(self, i, channel):
-        i %= self.beat_count
+        self.idle_beats = idle_beats(self.beat_offsets)
 
-        for x, (mute_mask, start_beat, length, *_) in enumerate(self.mute_masks):
-            if start_beat <= i < start_beat + length:
-                return not not (mute_mask & (1 << (NUM_CHANNELS - 1 - channel)))
+
+    def is_unmuted_on_beat(self, i, channel):
+        return bool(self.enabled[i % self.beat_count, channel])
 
 
     def notes_on_beat(self, i):
         i %= self.beat_count
-
-        # WARNING: Caching
-        if self.__cached_notes[i] is not None:
-            for c in self.__cached_notes[i]:
-                yield c
-            return
-        self.__cached_notes[i] = []
-        for c in range(NUM_CHANNELS):
-            if self.is_unmuted_on_beat(i, c):
-                for _ in range(self.wheel[c][i % BEATS_PER_WHEEL]):
-                    self.__cached_notes[i].append(c)
-                    yield c
+        return self.beat_channels[self.beat_offsets[i]:self.beat_offsets[i+1]]
     
+    # rng is a random.Random (e.g. rng.song_random(seed) for a song that can be made again), or the random module
     @staticmethod
-    def make_random():
+    def make_random(config: SimConfig = SIM_CONFIG, rng=random):
+        highres_beats = config.beats_per_wheel*config.random_song_writing_resolution
         wheel = []
-        for instrument in RANDOM_SONG_INSTRUMENT_SETTINGS:
-            instrument_cp_counts = get_random_note_counts(instrument.num_cps, instrument.npb/2, instrument.ratio)
+        for instrument in config.random_song_instrument_settings:
+            instrument_cp_counts = get_random_note_counts(instrument.num_cps, instrument.npb/2, instrument.ratio,
+                                                          config.beats_per_wheel, rng)
             # Make a wheel for both channels in each pair
             # (so that min dist between notes requirement is definitely upheld)
-            highres_wheel1 = make_highres_wheel_from_counts(instrument_cp_counts)
-            highres_wheel2 = make_highres_wheel_from_counts(instrument_cp_counts)
+            highres_wheel1 = make_highres_wheel_from_counts(instrument_cp_counts, config, rng)
+            highres_wheel2 = make_highres_wheel_from_counts(instrument_cp_counts, config, rng)
 
             highres_wheel_merged = [[(x1+x2) for (x1,x2) in zip(line1, line2)] for (line1, line2) in zip(highres_wheel1, highres_wheel2)]
             
-            highres_wheel = blank_wheel(instrument.num_cps*2, BEATS_PER_WHEEL*RANDOM_SONG_WRITING_RESOLUTION)
+            highres_wheel = blank_wheel(instrument.num_cps*2, highres_beats)
             for cp in range(instrument.num_cps):
                 total = 0
-                for i in range(BEATS_PER_WHEEL*RANDOM_SONG_WRITING_RESOLUTION):
+                for i in range(highres_beats):
                     for x in range(highres_wheel_merged[cp][i]):
                         highres_wheel[2*cp + (total % 2)][i] += 1
                         total += 1
-            wheel += compress_wheel(highres_wheel)
+            wheel += compress_wheel(highres_wheel, config)
         
-        return MMXSong(wheel, RANDOM_SONG_MUTE_INSTRUCTIONS)
+        return MMXSong(wheel, list(config.random_song_mute_instructions), config)
 
     @staticmethod
-    def from_json(json_str):
+    def make_random_batch(num_songs: int, config: SimConfig = SIM_CONFIG, rng=None):
+        return [
+            MMXSong(wheel.tolist(), list(config.random_song_mute_instructions), config)
+            for wheel in make_random_wheels(num_songs, config, rng)
+        ]
+
+    @staticmethod
+    def from_json(json_str, config: SimConfig = SIM_CONFIG):
         data = json.loads(json_str)
 
-        wheel = wheel_from_text(data["wheel"])
+        wheel = wheel_from_text(data["wheel"], config.num_channels, config.beats_per_wheel)
         
         mute_instructions = []
         for (mask_str, length, name) in data["mute_instructions"]:
@@ -162,18 +268,21 @@ class MMXSong:
                 mask = int(mask_str, base=2)
             mute_instructions.append(SongMuteInstruction(mask, length, name))
 
-        return MMXSong(wheel, mute_instructions)
+        return MMXSong(wheel, mute_instructions, config)
 
     @staticmethod
-    def from_file(json_fp):
+    def from_file(json_fp, config: SimConfig = SIM_CONFIG):
         with open(json_fp, "r") as f:
             json_str = f.read()
-        return MMXSong.from_json(json_str)
+        return MMXSong.from_json(json_str, config)
 
     def to_json(self):
         data = {
-            "wheel": wheel_to_text(self.wheel),
-            "mute_instructions": [(mi.mask, mi.length, mi.name) for mi in self.mute_instructions]
+            "wheel": list(wheel_to_text(self.wheel)),
+            "mute_instructions": [
+                ("0b" + bin(mi.mask)[2:].zfill(len(self.config.mute_groups)), mi.length, mi.name)
+                for mi in self.mute_instructions
+            ]
         }
         return json.dumps(data)
 
@@ -185,20 +294,38 @@ class MMXSong:
     def __repr__(self):
         return (
             "Wheel:\n" + 
-            "\n".join(f"{i+1:02d} {c_text} {sum(c_notes)}" for i, (c_notes, c_text) in enumerate(zip(self.wheel, wheel_to_text(self.wheel))))
+            "\n".join(f"{i+1:02d} {c_text} {int(np.sum(c_notes))}" for i, (c_notes, c_text) in enumerate(zip(self.wheel, wheel_to_text(self.wheel))))
             + "\n\n" +
             "Mute Masks:\n" + 
-            "\n".join([str((mute_mask_repr(mask), start_beat, length, name)) for (mask, start_beat, length, name) in self.mute_masks])
+            "\n".join([str((mute_mask_repr(mask, self.config), start_beat, length, name)) for (mask, start_beat, length, name) in self.mute_masks])
             + "\n\n" + 
             "Notes Count:        {0}\n".format(self.note_count) +
             "Beats Length:       {0}\n".format(self.beat_count) +
             "Notes per Beat:     {0:.2f}\n".format(self.npb) + 
-            "Max Notes per Beat: {0:.2f}\n".format(sum(map(sum, self.wheel)) / BEATS_PER_WHEEL)
+            "Max Notes per Beat: {0:.2f}\n".format(int(np.sum(self.wheel)) / self.config.beats_per_wheel)
         )
         
 
-if __name__ == "__main__":
+# The song to simulate when none is given: SONG_PATH, or a random song if that's None (made with
+# rng.song_random(seed) if there's a seed, so it's the same song every time)
+def load_default_song(config: SimConfig = SIM_CONFIG, seed=None) -> MMXSong:
     if SONG_PATH == None:
-        print(repr(MMXSong.make_random()))
+        return MMXSong.make_random(config, random if seed is None else song_random(seed))
+    return MMXSong.from_file(SONG_PATH, config)
+
+
+# Does song come back the same from its JSON?
+def check_json_round_trip(song: MMXSong) -> bool:
+    loaded = MMXSong.from_json(song.to_json(), song.config)
+    return (np.array_equal(loaded.wheel, song.wheel) and loaded.mute_instructions == list(song.mute_instructions)
+            and loaded.beat_offsets == song.beat_offsets and loaded.beat_channels == song.beat_channels)
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+    print(repr(song))
+
+    if check_json_round_trip(song):
+        print("Song survives a round trip through JSON")
     else:
-        print(repr(MMXSong.from_file(SONG_PATH)))
\ No newline at end of file
+        print("Song changes in a round trip through JSON")
\ No newline at end of file
@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from settings import *
+from song import MMXSong, load_default_song
+from mmx import SimResult
+from batch import run_batch
+from corpus import open_corpus
+from rng import replica_seeds
+
+
+# function(*task, chunk) for every task and every chunk of chunk_size seeds, yielding (index of the task, result)
+# in order of task then chunk. The calls are spread over a process pool (started with initializer(*initargs), if
+# given), or made in this process if max_workers is 1 or there's only one. Stopping early cancels the calls that
+# haven't started yet.
+def run_chunked(function: Callable, seeds: Sequence[int], chunk_size: int, tasks: Sequence[tuple] = ((),),
+                max_workers=None, initializer=None, initargs=()) -> Iterator[Tuple[int, object]]:
+    chunks = [seeds[i:i+chunk_size] for i in range(0, len(seeds), max(1, chunk_size))]
+    work = [(t, chunk) for t in range(len(tasks)) for chunk in chunks]
+    if not work:
+        return
+    args = zip(*(tasks[t] + (chunk,) for t, chunk in work))
+    task_indices = [t for t, _ in work]
+
+    if max_workers == 1 or len(work) == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from zip(task_indices, map(function, *args))
+        return
+
+    executor = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=initializer,
+                                   initargs=initargs)
+    try:
+        yield from zip(task_indices, executor.map(function, *args))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _run_chunk(song: MMXSong, marble_goal: int, config: SimConfig, seeds: Sequence[int]) -> List[SimResult]:
+    return run_batch(song, seeds, marble_goal, config)
+
+
+# Workers pick their song out of the memory-mapped corpus themselves, rather than being sent it
+def _run_corpus_chunk(corpus_path: str, index: int, marble_goal: int, config: SimConfig,
+                      seeds: Sequence[int]) -> List[SimResult]:
+    return run_batch(open_corpus(corpus_path).song(index, config), seeds, marble_goal, config)
+
+
+# Kaplan-Meier estimate of P(not run dry by beat t).
+# Replicas that reached the marble goal without running dry are censored at their last beat.
+def survival_curve(results: Sequence[SimResult]):
+    beats = np.array([r.beats for r in results])
+    ran_dry = np.array([r.ran_dry for r in results])
+
+    dry_beats = np.unique(beats[ran_dry])
+    at_risk = np.array([(beats >= b).sum() for b in dry_beats])
+    dried = np.array([(beats[ran_dry] == b).sum() for b in dry_beats])
+    survival = np.cumprod(1 - dried / np.maximum(at_risk, 1))
+    return dry_beats, survival
+
+
+# All the results of a sweep, in replica order, with summary statistics on top
+class SweepResult:
+    PERCENTILES = (5, 25, 50, 75, 95)
+
+    def __init__(self, results: List[SimResult], song_beat_count: int):
+        self.results = results
+        self.song_beat_count = song_beat_count
+
+    def column(self, field: str):
+        return np.array([getattr(r, field) for r in self.results])
+
+    # Percentiles of a SimResult field, over the replicas where it isn't None
+    def percentiles(self, field: str, percentiles=PERCENTILES) -> Optional[List[float]]:
+        values = [v for v in self.column(field) if v is not None]
+        if not values:
+            return None
+        return list(np.percentile(values, percentiles))
+
+    @property
+    def dry_beats(self):
+        return np.array([r.beats for r in self.results if r.ran_dry])
+
+    @property
+    def dry_fraction(self) -> float:
+        return float(np.mean(self.column("ran_dry")))
+
+    def survival_curve(self):
+        return survival_curve(self.results)
+
+    def summary(self):
+        dry_beats = self.dry_beats
+        return {
+            "replicas": len(self.results),
+            "dry_fraction": self.dry_fraction,
+            "dry_beat_percentiles": list(np.percentile(dry_beats, self.PERCENTILES)) if dry_beats.size else None,
+            "fishstair_overflow_fraction": float(np.mean([r.fishstair_overflow_beat is not None for r in self.results])),
+            "fishstair_overflow_beat_percentiles": self.percentiles("fishstair_overflow_beat"),
+            "conveyor_overflow_fraction": float(np.mean([r.conveyor_overflow_beat is not None for r in self.results])),
+            "conveyor_overflow_beat_percentiles": self.percentiles("conveyor_overflow_beat"),
+            "conveyor_waiting_percentiles": self.percentiles("conveyor_waiting"),
+            "fishstair_waiting_percentiles": self.percentiles("fishstair_waiting"),
+        }
+
+    def __repr__(self):
+        def fmt(values):
+            return "-" if values is None else ", ".join("{0:.1f}".format(v) for v in values)
+
+        summary = self.summary()
+        lines = [
+            "Replicas:                 {0}".format(summary["replicas"]),
+            "Percentiles:              {0}".format(", ".join(map(str, self.PERCENTILES))),
+            "Ran dry:                  {0:.2%}".format(summary["dry_fraction"]),
+            "Dry-out beat:             {0}".format(fmt(summary["dry_beat_percentiles"])),
+            "Fishstair overflowed:     {0:.2%}".format(summary["fishstair_overflow_fraction"]),
+            "Fishstair overflow beat:  {0}".format(fmt(summary["fishstair_overflow_beat_percentiles"])),
+            "Conveyor overflowed:      {0:.2%}".format(summary["conveyor_overflow_fraction"]),
+            "Conveyor overflow beat:   {0}".format(fmt(summary["conveyor_overflow_beat_percentiles"])),
+            "Final conveyor waiting:   {0}".format(fmt(summary["conveyor_waiting_percentiles"])),
+            "Final fishstair waiting:  {0}".format(fmt(summary["fishstair_waiting_percentiles"])),
+        ]
+
+        dry_beats, survival = self.survival_curve()
+        if dry_beats.size:
+            lines.append("Survival (plays of the song -> P(not dry yet)):")
+            for plays in range(1, int(dry_beats[-1] / self.song_beat_count) + 2):
+                survived = survival[dry_beats <= plays * self.song_beat_count]
+                lines.append("\t{0:3d}: {1:.3f}".format(plays, survived[-1] if survived.size else 1.0))
+        return "\n".join(lines)
+
+
+# Simulate num_replicas machines spread over a process pool.
+# The result only depends on master_seed, not on the number of workers or how they are scheduled.
+def run_sweep(song: MMXSong, num_replicas=SWEEP_REPLICAS, master_seed=SWEEP_SEED,
+              marble_goal=SWEEP_MARBLE_GOAL, chunk_size=SWEEP_CHUNK_SIZE, max_workers=None,
+              config: SimConfig = SIM_CONFIG) -> SweepResult:
+    seeds = replica_seeds(master_seed, num_replicas)
+    results: List[SimResult] = []
+    for _, chunk_results in run_chunked(_run_chunk, seeds, chunk_size, [(song, marble_goal, config)], max_workers):
+        results += chunk_results
+
+    return SweepResult(results, song.beat_count)
+
+
+# run_sweep() for every song (or the songs at indices) in the corpus at corpus_path, all in one process pool.
+# Every song is simulated with the same replica seeds, so song i's result is exactly run_sweep(corpus[i]).
+def run_corpus_sweep(corpus_path: str, indices: Sequence[int] = None, num_replicas=SWEEP_REPLICAS,
+                     master_seed=SWEEP_SEED, marble_goal=SWEEP_MARBLE_GOAL, chunk_size=SWEEP_CHUNK_SIZE,
+                     max_workers=None, config: SimConfig = SIM_CONFIG) -> List[SweepResult]:
+    corpus = open_corpus(corpus_path)
+    indices = range(len(corpus)) if indices is None else indices
+    seeds = replica_seeds(master_seed, num_replicas)
+    tasks = [(corpus.path, index, marble_goal, config) for index in indices]
+
+    results = {index: [] for index in indices}
+    for t, chunk_results in run_chunked(_run_corpus_chunk, seeds, chunk_size, tasks, max_workers):
+        results[indices[t]] += chunk_results
+
+    return [SweepResult(results[index], corpus.song(index, config).beat_count) for index in indices]
+
+
+if __name__ == "__main__":
+    song = load_default_song()
+
+    print(run_sweep(song))
@@ -0,0 +1,50 @@
+import numpy as np
+
+from settings import *
+from song import MMXSong, blank_wheel
+from batch import BatchMMX
+from analysis import screen
+
+
+# One note per channel per turn of the wheel, in the sections of the song that comes with the repository
+def sparse_song(song_path, config: SimConfig) -> MMXSong:
+    wheel = blank_wheel(config.num_channels, config.beats_per_wheel)
+    for c in range(config.num_channels):
+        wheel[c][(5 * c) % config.beats_per_wheel] = 1
+    return MMXSong(wheel, MMXSong.from_file(song_path, config).mute_instructions, config)
+
+
+def test_easy_config_is_ok(song_path):
+    config = SIM_CONFIG._replace(max_marbles_per_channel=64)
+    verdict, flow, risks = screen(sparse_song(song_path, config), config)
+    assert flow.return_flow < flow.return_capacity / 10
+    assert verdict == "ok"
+
+
+def test_over_capacity_config_fails(song_path):
+    # The conveyor can lift 4 marbles per beat, the song plays about 7
+    config = SIM_CONFIG._replace(return_settings=SIM_CONFIG.return_settings._replace(channel_accept_p=0.5))
+    verdict, flow, risks = screen(MMXSong.from_file(song_path, config), config)
+    assert flow.return_flow > flow.return_capacity
+    assert verdict == "fail"
+
+
+def test_supply_leaves_no_channel_exactly_at_demand(song_path):
+    verdict, flow, risks = screen(MMXSong.from_file(song_path))
+    assert len(flow.starved_channels) == 0
+    assert min(r.supply_ratio for r in risks) > 1.01
+
+
+# Machines start with nothing on the conveyor, so the song that comes with the repository runs dry within its first
+# play (channel 7 or 4 first): the screen has to see that as well as the batch engine does
+def test_dry_out_matches_batch_engine(song_path):
+    song = MMXSong.from_file(song_path)
+    seeds = list(range(32))
+    results = BatchMMX(song, seeds).run(max_beats=song.beat_count)
+    dry_fraction = sum(r is not None and r.ran_dry for r in results) / len(seeds)
+
+    verdict, flow, risks = screen(song)
+    any_dry = 1 - np.prod([1 - r.dry_probability for r in risks])
+    assert abs(any_dry - dry_fraction) < 0.1
+    assert {r.channel for r in sorted(risks, key=lambda r: r.dry_probability)[-2:]} == {3, 6}
+    assert verdict == "fail"
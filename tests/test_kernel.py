@@ -0,0 +1,21 @@
+import pytest
+
+from song import MMXSong
+import kernel
+
+SEEDS = (0, 1, 2)
+
+
+# The beat loop compiled with numba against the MMX classes
+def test_compiled_kernel_matches_classes(song_path):
+    if kernel.numba is None:
+        pytest.skip("numba isn't installed")
+    assert kernel.check_parity(MMXSong.from_file(song_path), SEEDS, 3000, beats=3000)
+
+
+# As it runs without numba: run_sim() falls back to the MMX classes, and run_beats() runs the beat loop as plain
+# Python (which is slow, so for fewer beats)
+def test_python_kernel_matches_classes(song_path, monkeypatch):
+    monkeypatch.setattr(kernel, "numba", None)
+    monkeypatch.setattr(kernel, "_run_beats", getattr(kernel._run_beats, "py_func", kernel._run_beats))
+    assert kernel.check_parity(MMXSong.from_file(song_path), SEEDS, 2000, beats=1000)
@@ -1,7 +1,18 @@
 import random
 
-def randf(a,b):
-    return a + (b-a)*random.random()
+def randf(a,b,rng=random):
+    return a + (b-a)*rng.random()
 
-def bernoulli(p):
-    return randf(0,1) <= p
\ No newline at end of file
+def bernoulli(p,rng=random):
+    return rng.random() <= p
+
+# random.Random objects can be pickled but the random module itself can't, so its state is saved instead
+def rng_to_state(rng):
+    return ("random", random.getstate()) if rng is random else ("rng", rng)
+
+def rng_from_state(state):
+    kind, value = state
+    if kind == "random":
+        random.setstate(value)
+        return random
+    return value